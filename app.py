@@ -1,36 +1,32 @@
 # app.py
 import streamlit as st
 
-from data_loader import load_taxi_trip_data
-
 # --- DÒNG NÀY PHẢI LÀ LỆNH STREAMLIT ĐẦU TIÊN ---
 st.set_page_config(page_title="Ứng dụng Dự đoán ETA Manhattan", layout="wide", initial_sidebar_state="collapsed")
 # -------------------------------------------------
 
 import pandas as pd
 import numpy as np
-import osmnx as ox
-import joblib
 import folium 
 from streamlit_folium import st_folium 
 
 try:
-    from config import DEFAULT_TARGET_HOUR, DEFAULT_TARGET_DAY_NUMERIC, PLACE_NAME, YELLOW_TAXI_DATA_FILE
-    from data_loader import load_road_network, load_taxi_zones 
-    from data_processor import (
-        filter_taxi_zones_by_borough,
-        initial_trip_data_cleaning,
-        filter_trips_by_location_ids,
-        calculate_median_speed_by_time,
-        create_ml_training_data
+    from config import (
+        DEFAULT_TARGET_HOUR, DEFAULT_TARGET_DAY_NUMERIC, PLACE_NAME, YELLOW_TAXI_DATA_FILE, USE_CONTRACTION_HIERARCHY,
+        MODEL_BACKEND, RETRAINING_STATUS_POLL_SECONDS, TIME_DEPENDENT_ROUTING, DEPARTURE_SWEEP_STEP_MINUTES
     )
-    from routing_utils import (
-        add_travel_times_to_graph,
-        calculate_eta_for_route
+    from data_loader import load_road_network, load_taxi_zones
+    from data_processor import filter_taxi_zones_by_borough
+    from compact_graph import (
+        CompactGraph, calculate_eta_on_compact_graph, calculate_time_dependent_eta, calculate_departure_profile
     )
-    from sklearn.compose import ColumnTransformer
-    from sklearn.preprocessing import OneHotEncoder
-    from sklearn.ensemble import RandomForestRegressor
+    from weight_layers import TravelTimeLayers
+    from graph_store import open_graph_store, save_graph_store
+    from contraction_hierarchy import load_or_build_contraction_hierarchy, calculate_eta_with_hierarchy
+    from eta_service import EtaService
+    from geocoding import geocode, reverse_geocode
+    from speed_table import load_or_build_speed_table, load_fallback_speeds, default_fallback_speeds
+    from retraining import RetrainingJob
 except ImportError as e:
     st.error(f"Lỗi import module cục bộ: {e}. Đảm bảo bạn đang chạy 'streamlit run app.py' từ thư mục gốc của dự án và tất cả các file .py cần thiết đều có mặt.")
     st.stop()
@@ -41,7 +37,7 @@ except ImportError as e:
 @st.cache_resource(show_spinner="Đang tải dữ liệu bản đồ và mô hình ML...")
 def load_core_data_cached():
     print("Thực thi: load_core_data_cached()")
-    g_manhattan, taxi_zones, model, preprocessor = None, None, None, None
+    g_manhattan, taxi_zones, speed_table = None, None, None
     error_messages = []
     try:
         g_manhattan = load_road_network(place_name=PLACE_NAME)
@@ -52,43 +48,84 @@ def load_core_data_cached():
         if taxi_zones is None: error_messages.append("Lỗi: Không tải được dữ liệu Taxi Zones.")
     except Exception as e: error_messages.append(f"Lỗi nghiêm trọng khi tải Taxi Zones: {e}")
     if not error_messages:
+        # Chỉ giữ bảng tốc độ tính sẵn trong bộ nhớ, không giữ RandomForest khi phục vụ
         try:
-            model = joblib.load('trained_rf_model.joblib')
-            preprocessor = joblib.load('data_preprocessor.joblib')
+            speed_table = load_or_build_speed_table(taxi_zones['LocationID'])
         except FileNotFoundError:
-            error_messages.append("LƯU Ý: Không tìm thấy file model/preprocessor. Sẽ thử huấn luyện lại.")
-            model, preprocessor = None, None
+            error_messages.append("LƯU Ý: Không tìm thấy bảng tốc độ hoặc file model/preprocessor. Sẽ thử huấn luyện lại.")
+            speed_table = None
         except Exception as e: 
-            error_messages.append(f"Lỗi khi tải model/preprocessor: {e}")
-            model, preprocessor = None, None
-    return g_manhattan, taxi_zones, model, preprocessor, error_messages
+            error_messages.append(f"Lỗi khi tải bảng tốc độ/model/preprocessor: {e}")
+            speed_table = None
+    return g_manhattan, taxi_zones, speed_table, error_messages
 
-@st.cache_data(show_spinner="Đang tính toán tốc độ fallback...")
-def get_fallback_speeds_cached(taxi_trip_file_path_param, manhattan_loc_ids_list_param):
+@st.cache_data(show_spinner="Đang tải tốc độ fallback...")
+def get_fallback_speeds_cached():
+    """Tốc độ trung vị theo giờ do train_model.py lưu sẵn (file JSON nhỏ) - không đọc dữ liệu chuyến đi."""
     print("Thực thi: get_fallback_speeds_cached()")
-    fallback_speeds, error_msg = pd.Series([10.0]*24, index=range(24)), "Sử dụng tốc độ fallback mặc định ban đầu."
-    if not manhattan_loc_ids_list_param:
-        error_msg = "Không có LocationID của Manhattan cho fallback speeds. " + error_msg
-        return fallback_speeds, error_msg
-    try:
-        import os
-        if not os.path.exists(taxi_trip_file_path_param):
-            raise FileNotFoundError(f"File dữ liệu taxi '{taxi_trip_file_path_param}' không tồn tại.")
-        raw_taxi_trips = pd.read_parquet(taxi_trip_file_path_param)
-        for col in ['tpep_pickup_datetime', 'tpep_dropoff_datetime']:
-            raw_taxi_trips[col] = pd.to_datetime(raw_taxi_trips[col])
-        cleaned_taxi_trips = initial_trip_data_cleaning(raw_taxi_trips)
-        manhattan_trips = pd.DataFrame()
-        if cleaned_taxi_trips is not None and not cleaned_taxi_trips.empty:
-            manhattan_trips = filter_trips_by_location_ids(cleaned_taxi_trips, manhattan_loc_ids_list_param)
-        if not manhattan_trips.empty:
-            median_hr, _ = calculate_median_speed_by_time(manhattan_trips)
-            if not median_hr.empty: fallback_speeds, error_msg = median_hr, None
-            else: error_msg = "Không tính được median_speed_by_hour từ dữ liệu. " + error_msg
-        else: error_msg = "Không có chuyến đi Manhattan nào để tính fallback speed. " + error_msg
-    except FileNotFoundError as e_fnf: error_msg = str(e_fnf)
-    except Exception as e: error_msg = f"Lỗi khi tính fallback speeds: {e}. " + error_msg
-    return fallback_speeds, error_msg
+    fallback_speeds = load_fallback_speeds()
+    if fallback_speeds is None:
+        return default_fallback_speeds(), "Chưa có file tốc độ fallback (chạy train_model.py). Sử dụng tốc độ fallback mặc định."
+    return fallback_speeds, None
+
+@st.cache_resource(show_spinner="Đang mở kho đồ thị dùng chung...")
+def open_graph_store_cached():
+    """Mở kho đồ thị + 168 lớp travel_time bằng mmap: nhanh và dùng chung bộ nhớ giữa các worker."""
+    print("Thực thi: open_graph_store_cached()")
+    return open_graph_store()
+
+@st.cache_resource(show_spinner="Đang tiền xử lý contraction hierarchy...")
+def load_eta_service_cached(_travel_time_layers, layers_fingerprint):
+    """
+    Dịch vụ ETA dùng chung giữa các phiên: phần tiền xử lý CH (không phụ thuộc trọng số) làm một lần
+    cho mỗi đồ thị; đổi khung giờ chỉ customize lại (giữ sẵn các khung giờ gần nhất).
+    Khoá cache theo dấu vân tay của bộ lớp (đồ thị + tốc độ): các CH đã customize và ma trận ETA
+    phụ thuộc trọng số, nên bộ lớp mới (ví dụ sau khi huấn luyện lại) phải có dịch vụ riêng.
+    """
+    print("Thực thi: load_eta_service_cached()")
+    hierarchy = load_or_build_contraction_hierarchy(_travel_time_layers.compact_graph) if USE_CONTRACTION_HIERARCHY else None
+    return EtaService(_travel_time_layers, hierarchy)
+
+@st.cache_resource(show_spinner="Đang dựng đồ thị CSR và các lớp travel_time cho việc tính ETA...")
+def load_travel_time_layers_cached(_g_manhattan, _taxi_zones, _speed_table, fallback_speed_items, map_bounds):
+    """
+    Đồ thị CSR và bộ vector travel_time theo (giờ, ngày), dùng chung (chỉ đọc) giữa mọi phiên.
+    Khi chưa có bảng tốc độ (_speed_table=None), các lớp chỉ dùng tốc độ fallback theo giờ để vẫn phục vụ
+    được trong lúc huấn luyện lại; bộ lớp tạm này không được lưu thành kho dùng chung.
+    """
+    print("Thực thi: load_travel_time_layers_cached()")
+    compact_graph = CompactGraph.from_networkx(_g_manhattan, _taxi_zones)
+    fallback_speeds = pd.Series(dict(fallback_speed_items), dtype='float64')
+    travel_time_layers = TravelTimeLayers(compact_graph, fallback_speeds, speed_table=_speed_table)
+    travel_time_layers.load_or_build_all() # 168 lớp (giờ, ngày) -> mọi thời điểm khởi hành đều tra được ngay
+    if _speed_table is not None:
+        try:
+            # Lưu kho dùng chung để các worker khởi động sau chỉ cần mở bằng mmap
+            save_graph_store(travel_time_layers, bounds=map_bounds)
+        except OSError as e:
+            print(f"Cảnh báo: Không lưu được kho đồ thị dùng chung: {e}")
+    return travel_time_layers
+
+@st.cache_resource
+def get_retraining_job():
+    """Job huấn luyện lại chạy nền, dùng chung cho mọi phiên (mỗi lúc chỉ một lần chạy)."""
+    return RetrainingJob()
+
+@st.fragment(run_every=RETRAINING_STATUS_POLL_SECONDS)
+def render_retraining_status(retraining_job):
+    """Tiến độ huấn luyện lại, tự làm mới định kỳ; chạy lại toàn app khi mô hình mới sẵn sàng để đổi sang dùng."""
+    status = retraining_job.status()
+    if status['state'] == 'running':
+        st.info("Đang phục vụ bằng tốc độ fallback theo giờ trong lúc huấn luyện lại mô hình ML ở nền.")
+        st.progress(float(status.get('fraction') or 0.0), text=status.get('message') or "Đang huấn luyện lại...")
+    elif status['state'] == 'done' and st.session_state.get('reloaded_model_version') != status.get('version'):
+        st.session_state.reloaded_model_version = status.get('version')
+        st.rerun()
+    elif status['state'] == 'failed':
+        st.error(f"Lỗi trong quá trình huấn luyện lại mô hình: {status.get('error')}")
+        if st.button("Thử huấn luyện lại"):
+            retraining_job.start(YELLOW_TAXI_DATA_FILE, MODEL_BACKEND)
+            st.rerun()
 
 # --- Khởi tạo Session State ---
 default_map_center = [40.7679, -73.9822]
@@ -102,65 +139,64 @@ for key, default_val in [
     ('origin_input', "Times Square, New York, NY"), 
     ('destination_input', "Wall Street, New York, NY"),
     ('hour_input', DEFAULT_TARGET_HOUR),
+    ('minute_input', 0),
+    ('time_dependent_input', TIME_DEPENDENT_ROUTING),
     ('day_input', DEFAULT_TARGET_DAY_NUMERIC),
     ('click_mode', 'Điểm xuất phát')
 ]:
     if key not in st.session_state:
         st.session_state[key] = default_val
 
+# --- Đổi sang mô hình vừa huấn luyện lại ---
+# Job nền đã ghi kho đồ thị mới (con trỏ CURRENT đổi nguyên tử): xoá các tài nguyên cache cũ một lần, mọi phiên
+# mở kho mới bằng mmap ở lần chạy kế tiếp; phiên nào còn giữ bộ lớp cũ vẫn dùng được tới khi chạy lại
+retraining_job = get_retraining_job()
+retrained_version = retraining_job.take_result()
+if retrained_version is not None:
+    open_graph_store_cached.clear()
+    load_core_data_cached.clear()
+    load_travel_time_layers_cached.clear()
+    load_eta_service_cached.clear() # CH đã customize và ma trận ETA theo tốc độ của mô hình cũ
+    get_fallback_speeds_cached.clear()
+    st.toast(f"Đã chuyển sang mô hình mới '{retrained_version}'.", icon="✅")
+
 # --- Tải dữ liệu khởi tạo ---
-G_manhattan, taxi_zones_gdf, ml_model, ml_preprocessor, initial_errors = load_core_data_cached()
-if initial_errors:
-    for err in initial_errors:
-        if "LƯU Ý" in err: st.info(err)
-        else: st.error(err)
-
-manhattan_zones_gdf_filtered = None
-if taxi_zones_gdf is not None:
-    manhattan_zones_gdf_filtered, manhattan_location_ids_for_fallback = filter_taxi_zones_by_borough(taxi_zones_gdf)
-else:
-    manhattan_location_ids_for_fallback = []
-
-fallback_median_speed_by_hour, fallback_errors = get_fallback_speeds_cached(
-    YELLOW_TAXI_DATA_FILE, manhattan_location_ids_for_fallback
-)
-if fallback_errors: st.warning(fallback_errors)
-
-# --- Logic Huấn luyện lại Model ---
-if ml_model is None and G_manhattan is not None and taxi_zones_gdf is not None and not any("Lỗi nghiêm trọng" in str(err) for err in initial_errors if err is not None):
-    st.info("Mô hình ML chưa được tải. Đang thử huấn luyện lại...")
-    with st.spinner("Đang huấn luyện lại mô hình ML... (có thể mất vài phút)"):
-        # ... (Code huấn luyện lại giữ nguyên) ...
-        try:
-            raw_taxi_trips_for_retrain = load_taxi_trip_data(YELLOW_TAXI_DATA_FILE)
-            if raw_taxi_trips_for_retrain is None: st.error("Không thể tải dữ liệu taxi để huấn luyện lại mô hình.")
-            else:
-                cleaned_taxi_for_retrain = initial_trip_data_cleaning(raw_taxi_trips_for_retrain)
-                manhattan_trips_for_retrain = filter_trips_by_location_ids(cleaned_taxi_for_retrain, manhattan_location_ids_for_fallback)
-                if manhattan_trips_for_retrain.empty: st.error("Không có dữ liệu Manhattan để huấn luyện lại mô hình.")
-                else:
-                    ml_training_df_retrain = create_ml_training_data(manhattan_trips_for_retrain)
-                    if ml_training_df_retrain.empty: st.error("Không thể tạo dữ liệu huấn luyện ML cho việc huấn luyện lại.")
-                    else:
-                        X_retrain = ml_training_df_retrain[['PULocationID', 'pickup_hour', 'pickup_day_of_week']]
-                        y_retrain = ml_training_df_retrain['target_median_speed_mph']
-                        preprocessor_retrain = ColumnTransformer(
-                            transformers=[('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=False), ['PULocationID'])],
-                            remainder='passthrough')
-                        X_processed_retrain = preprocessor_retrain.fit_transform(X_retrain)
-                        ml_model_retrain = RandomForestRegressor(
-                            n_estimators=100, random_state=42, n_jobs=-1, oob_score=True, 
-                            max_depth=20, min_samples_split=5, min_samples_leaf=2)
-                        ml_model_retrain.fit(X_processed_retrain, y_retrain)
-                        joblib.dump(ml_model_retrain, 'trained_rf_model.joblib')
-                        joblib.dump(preprocessor_retrain, 'data_preprocessor.joblib')
-                        st.success("Đã huấn luyện lại và lưu mô hình, preprocessor thành công! Vui lòng làm mới trang để sử dụng.")
-                        ml_model, ml_preprocessor = ml_model_retrain, preprocessor_retrain
-        except Exception as e_retrain: st.error(f"Lỗi trong quá trình huấn luyện lại mô hình: {e_retrain}")
+# Ưu tiên kho đồ thị dùng chung (mmap); chỉ tải dữ liệu nguồn, tính fallback speed, huấn luyện lại... khi chưa có kho
+# hoặc kho được dựng từ bảng tốc độ cũ hơn bảng trên đĩa (ví dụ sau khi chạy train_model.py)
+travel_time_layers, graph_store_meta = open_graph_store_cached()
+manhattan_bounds = graph_store_meta.get('bounds') if graph_store_meta else None
+initial_errors = []
+if travel_time_layers is None:
+    G_manhattan, taxi_zones_gdf, speed_table, initial_errors = load_core_data_cached()
+    if initial_errors:
+        for err in initial_errors:
+            if "LƯU Ý" in err: st.info(err)
+            else: st.error(err)
+
+    manhattan_zones_gdf_filtered = None
+    if taxi_zones_gdf is not None:
+        manhattan_zones_gdf_filtered, _ = filter_taxi_zones_by_borough(taxi_zones_gdf)
 
+    fallback_median_speed_by_hour, fallback_errors = get_fallback_speeds_cached()
+    if fallback_errors: st.warning(fallback_errors)
+
+    # --- Logic Huấn luyện lại Model ---
+    # Huấn luyện lại ở tiến trình nền (không chặn phiên); trong lúc chờ vẫn phục vụ bằng tốc độ fallback
+    if speed_table is None and G_manhattan is not None and taxi_zones_gdf is not None and not any("Lỗi nghiêm trọng" in str(err) for err in initial_errors if err is not None):
+        if retraining_job.status()['state'] == 'idle':
+            retraining_job.start(YELLOW_TAXI_DATA_FILE, MODEL_BACKEND)
+        render_retraining_status(retraining_job)
+
+    if G_manhattan is not None and taxi_zones_gdf is not None:
+        if manhattan_zones_gdf_filtered is not None and not manhattan_zones_gdf_filtered.empty:
+            bounds_array = manhattan_zones_gdf_filtered.to_crs("EPSG:4326").total_bounds
+            manhattan_bounds = [[float(bounds_array[1]), float(bounds_array[0])], [float(bounds_array[3]), float(bounds_array[2])]]
+        travel_time_layers = load_travel_time_layers_cached(
+            G_manhattan, taxi_zones_gdf, speed_table, tuple(fallback_median_speed_by_hour.items()), manhattan_bounds
+        )
 
 # --- Hàm tạo và cập nhật bản đồ ---
-def render_map(graph_map, origin_coords, dest_coords, route_nodes, map_bounds):
+def render_map(compact_graph, origin_coords, dest_coords, route_nodes, map_bounds):
     map_center = st.session_state.map_center
     map_zoom = st.session_state.map_zoom
     if isinstance(map_center, dict): map_location = [map_center.get('lat'), map_center.get('lng')]
@@ -168,13 +204,15 @@ def render_map(graph_map, origin_coords, dest_coords, route_nodes, map_bounds):
     m = folium.Map(location=map_location, zoom_start=map_zoom, tiles="CartoDB positron", max_bounds=map_bounds, min_zoom=11)
     if origin_coords: folium.Marker(location=origin_coords, popup="Điểm xuất phát", icon=folium.Icon(color='green', icon='play')).add_to(m)
     if dest_coords: folium.Marker(location=dest_coords, popup="Điểm đến", icon=folium.Icon(color='red', icon='stop')).add_to(m)
-    if route_nodes and graph_map and len(route_nodes) > 1:
+    if route_nodes and compact_graph is not None and len(route_nodes) > 1:
         try:
-            route_gdf = ox.routing.route_to_gdf(graph_map, route_nodes)
-            folium.GeoJson(route_gdf, style_function=lambda x: {'color': "#007bff", 'weight': 5, 'opacity': 0.7}).add_to(m)
-            if not route_gdf.empty:
-                bounds = route_gdf.total_bounds
-                m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+            # Hình học lộ trình lấy thẳng từ mảng CSR, không cần đồ thị networkx
+            route_coords = compact_graph.route_coordinates(route_nodes)
+            folium.PolyLine(route_coords, color="#007bff", weight=5, opacity=0.7).add_to(m)
+            if route_coords:
+                lats = [pt[0] for pt in route_coords]
+                lons = [pt[1] for pt in route_coords]
+                m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
         except Exception as e: st.warning(f"Lỗi khi vẽ lộ trình: {e}.")
     return m
 
@@ -186,7 +224,7 @@ control_col, map_col = st.columns([1, 2])
 with control_col:
     st.header("Nhập thông tin lộ trình")
     
-    if all(obj is not None for obj in [G_manhattan, ml_model, ml_preprocessor, fallback_median_speed_by_hour, taxi_zones_gdf]):
+    if travel_time_layers is not None:
         
         st.radio("Chế độ Chọn trên Bản đồ:", ('Điểm xuất phát', 'Điểm đến'), key='click_mode', horizontal=True)
         st.caption("Sau khi chọn chế độ, hãy click vào một điểm trên bản đồ để đặt marker.")
@@ -197,7 +235,7 @@ with control_col:
             address = st.session_state[address_key]
             if address:
                 try:
-                    lat, lon = ox.geocode(address)
+                    lat, lon = geocode(address)
                     st.session_state[coords_key] = (lat, lon)
                     st.session_state.route_nodes = None # Xóa route cũ khi địa chỉ thay đổi
                     st.toast(f"Đã tìm thấy: {address}", icon="📍")
@@ -213,11 +251,16 @@ with control_col:
         st.write("🕒 Thời gian khởi hành")
         
         days_options = {0: "Thứ Hai", 1: "Thứ Ba", 2: "Thứ Tư", 3: "Thứ Năm", 4: "Thứ Sáu", 5: "Thứ Bảy", 6: "Chủ Nhật"}
-        c1, c2 = st.columns(2)
+        c1, c2, c3 = st.columns(3)
         with c1:
             st.number_input("Giờ (0-23)", min_value=0, max_value=23, key="hour_input", step=1)
         with c2:
+            st.number_input("Phút (0-59)", min_value=0, max_value=59, key="minute_input", step=5,
+                            disabled=not st.session_state.time_dependent_input)
+        with c3:
             st.selectbox("Ngày", options=list(days_options.keys()), format_func=lambda x: days_options[x], key="day_input")
+        st.checkbox("Tính theo giờ xe đi vào từng đoạn đường (chuyến đi qua nhiều khung giờ, chậm hơn)",
+                    key="time_dependent_input")
 
         if st.button("TÍNH TOÁN ETA", use_container_width=True, type="primary"):
             if not st.session_state.origin_input or not st.session_state.destination_input:
@@ -226,21 +269,35 @@ with control_col:
                 st.warning("Vui lòng đảm bảo cả hai địa chỉ đã được geocode thành công.")
             else:
                 with st.spinner("Đang tính toán..."):
-                    origin_node = ox.nearest_nodes(G_manhattan, X=st.session_state.origin_coords[1], Y=st.session_state.origin_coords[0])
-                    dest_node = ox.nearest_nodes(G_manhattan, X=st.session_state.destination_coords[1], Y=st.session_state.destination_coords[0])
+                    compact_graph = travel_time_layers.compact_graph
+                    origin_node = compact_graph.nearest_node(*st.session_state.origin_coords)
+                    dest_node = compact_graph.nearest_node(*st.session_state.destination_coords)
                     
-                    if origin_node and dest_node:
-                        G_for_eta = G_manhattan.copy()
-                        add_travel_times_to_graph(
-                            G_for_eta, st.session_state.hour_input, st.session_state.day_input, ml_model,
-                            ml_preprocessor, taxi_zones_gdf, fallback_median_speed_by_hour
-                        )
-                        route, eta_minutes = calculate_eta_for_route(G_for_eta, origin_node, dest_node)
+                    if origin_node is not None and dest_node is not None:
+                        time_dependent = st.session_state.time_dependent_input
+                        eta_service = None if time_dependent else load_eta_service_cached(travel_time_layers, travel_time_layers.fingerprint())
+                        if time_dependent:
+                            # Mỗi cạnh tính theo lớp giờ lúc xe đi vào cạnh (chuyến đi vắt qua nhiều giờ)
+                            route, eta_minutes, total_distance_meters = calculate_time_dependent_eta(
+                                travel_time_layers, origin_node, dest_node, st.session_state.hour_input,
+                                st.session_state.day_input, st.session_state.minute_input
+                            )
+                        elif eta_service.hierarchy is not None:
+                            customized_hierarchy = eta_service.customized_hierarchy(
+                                st.session_state.hour_input, st.session_state.day_input
+                            )
+                            route, eta_minutes, total_distance_meters = calculate_eta_with_hierarchy(
+                                customized_hierarchy, origin_node, dest_node
+                            )
+                        else:
+                            # Chỉ chọn vector trọng số dùng chung, không sao chép đồ thị
+                            travel_times = travel_time_layers.get(st.session_state.hour_input, st.session_state.day_input)
+                            route, eta_minutes, total_distance_meters = calculate_eta_on_compact_graph(
+                                compact_graph, travel_times, origin_node, dest_node
+                            )
                         st.session_state.route_nodes = route
 
                         if route and eta_minutes is not None and not pd.isna(eta_minutes) and not np.isinf(eta_minutes):
-                            route_gdf = ox.routing.route_to_gdf(G_for_eta, route)
-                            total_distance_meters = route_gdf['length'].sum()
                             total_distance_km = total_distance_meters / 1000
                             
                             st.session_state.last_eta = eta_minutes
@@ -262,19 +319,43 @@ with control_col:
                 st.metric("ETA Dự kiến", f"{st.session_state.last_eta:.1f} phút")
             with res_col2:
                 st.metric("Tổng Quãng đường", f"{st.session_state.last_distance:.2f} km")
+
+        # Giờ khởi hành tốt nhất trong một khung giờ: một lần quét nhiều thời điểm khởi hành trên cùng đồ thị
+        with st.expander("⏱️ Nên khởi hành lúc nào?"):
+            window_start_hour, window_end_hour = st.slider("Khung giờ khởi hành", 0, 23, (7, 10), key="sweep_window")
+            sweep_step_minutes = st.select_slider("Bước (phút)", options=[5, 10, 15, 30, 60],
+                                                  value=DEPARTURE_SWEEP_STEP_MINUTES, key="sweep_step")
+            if st.button("Tìm giờ khởi hành tốt nhất", use_container_width=True):
+                if st.session_state.origin_coords is None or st.session_state.destination_coords is None:
+                    st.warning("Vui lòng đảm bảo cả hai địa chỉ đã được geocode thành công.")
+                else:
+                    with st.spinner("Đang tính ETA cho các thời điểm khởi hành..."):
+                        compact_graph = travel_time_layers.compact_graph
+                        departure_profile, best_departure = calculate_departure_profile(
+                            travel_time_layers,
+                            compact_graph.nearest_node(*st.session_state.origin_coords),
+                            compact_graph.nearest_node(*st.session_state.destination_coords),
+                            st.session_state.day_input, window_start_hour, window_end_hour, sweep_step_minutes
+                        )
+                    if best_departure is None:
+                        st.error("Không tìm thấy lộ trình trong khung giờ đã chọn.")
+                    else:
+                        # Bỏ các thời điểm không có lộ trình (ETA = inf) khỏi giá trị chậm nhất và biểu đồ
+                        reachable_profile = departure_profile[np.isfinite(departure_profile['eta_minutes'])]
+                        st.success(f"Khởi hành lúc {best_departure['departure']}: ETA {best_departure['eta_minutes']:.1f} phút "
+                                   f"(chậm nhất {reachable_profile['eta_minutes'].max():.1f} phút).")
+                        if len(reachable_profile) < len(departure_profile):
+                            st.warning(f"{len(departure_profile) - len(reachable_profile)} thời điểm khởi hành không có lộ trình.")
+                        st.line_chart(reachable_profile.set_index('departure')['eta_minutes'], y_label="ETA (phút)")
     else:
         st.warning("Vui lòng đợi dữ liệu và mô hình được tải xong hoặc khắc phục lỗi hiển thị ở trên.")
 
 with map_col:
     st.header("Bản đồ Lộ trình")
-    manhattan_bounds = None
-    if manhattan_zones_gdf_filtered is not None and not manhattan_zones_gdf_filtered.empty:
-        bounds_array = manhattan_zones_gdf_filtered.total_bounds
-        manhattan_bounds = [[bounds_array[1], bounds_array[0]], [bounds_array[3], bounds_array[2]]]
 
-    if G_manhattan: 
+    if travel_time_layers is not None: 
         folium_map = render_map(
-            G_manhattan, 
+            travel_time_layers.compact_graph, 
             st.session_state.origin_coords, 
             st.session_state.destination_coords,
             st.session_state.route_nodes,
@@ -293,7 +374,7 @@ with map_col:
                 coord_key_to_update = "destination_input"
             
             try:
-                address = ox.reverse_geocode(lat, lon)
+                address = reverse_geocode(lat, lon)
                 st.session_state[coord_key_to_update] = address
             except Exception as e:
                 st.warning(f"Không thể tìm thấy địa chỉ cho tọa độ đã chọn: {e}")
@@ -0,0 +1,689 @@
+# compact_graph.py
+import heapq
+import hashlib
+import numpy as np
+import pandas as pd
+import osmnx as ox
+from config import ROUTING_ENGINE, DEPARTURE_SWEEP_STEP_MINUTES
+from routing_utils import (
+    ROUTING_ENGINES,
+    ASTAR_HEURISTIC_SLACK,
+    get_edge_speed_attributes,
+    compute_base_speeds_mph,
+    compute_travel_times_from_base_speeds,
+    max_edge_speed_mps
+)
+from edge_zones import NO_ZONE_ID, get_edge_location_ids
+from weight_layers import HOURS_PER_DAY, DAYS_PER_WEEK, NUM_TIME_SLOTS, SECONDS_PER_SLOT, departure_week_seconds
+from spatial_index import SpatialIndex
+
+# departure_sweep: chỉ dựng heuristic cận dưới khi các chuyến trải qua không quá số khung giờ này
+SWEEP_HEURISTIC_MAX_SLOTS = 12
+
+
+class CompactGraph:
+    """
+    Đồ thị đường dạng mảng CSR dựng từ MultiDiGraph của OSMnx.
+    Nút được đánh chỉ số int32 theo thứ tự G.nodes; cạnh được xếp theo thứ tự G.edges
+    (networkx duyệt cạnh theo từng nút nguồn nên thứ tự này chính là thứ tự CSR),
+    vì vậy mọi mảng theo cạnh (LocationID, travel_time, ...) dùng chung một chỉ số.
+    Chỉ chuyển về OSM node id ở đầu vào/đầu ra của API.
+    """
+
+    # Tên các mảng mô tả đầy đủ đồ thị (dùng khi lưu/mở bằng mmap trong graph_store.py)
+    ARRAY_NAMES = (
+        'node_ids', 'node_x', 'node_y', 'node_sorter', 'indptr', 'edge_sources', 'edge_targets',
+        'lengths_m', 'modifiers', 'max_speeds_mps', 'edge_location_ids', 'geometry_indptr', 'geometry_xy'
+    )
+
+    def __init__(self, node_ids, node_x, node_y, indptr, edge_sources, edge_targets,
+                 lengths_m, modifiers, max_speeds_mps, edge_location_ids=None,
+                 node_sorter=None, geometry_indptr=None, geometry_xy=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.edge_sources = np.asarray(edge_sources, dtype=np.int32)
+        self.edge_targets = np.asarray(edge_targets, dtype=np.int32)
+        self.lengths_m = np.asarray(lengths_m, dtype=np.float32)
+        self.modifiers = np.asarray(modifiers, dtype=np.float32)
+        self.max_speeds_mps = np.asarray(max_speeds_mps, dtype=np.float32)
+        if edge_location_ids is None:
+            edge_location_ids = np.full(self.edge_targets.size, NO_ZONE_ID, dtype=np.int16)
+        self.edge_location_ids = np.asarray(edge_location_ids, dtype=np.int16)
+        # Hình học cạnh dạng CSR: toạ độ (x, y) của cạnh e là geometry_xy[geometry_indptr[e]:geometry_indptr[e + 1]]
+        self.geometry_indptr = None if geometry_indptr is None else np.asarray(geometry_indptr, dtype=np.int32)
+        self.geometry_xy = None if geometry_xy is None else np.asarray(geometry_xy, dtype=np.float64)
+
+        # Tra cứu OSM id -> chỉ số nút bằng tìm kiếm nhị phân (không cần dict lớn)
+        if node_sorter is None:
+            node_sorter = np.argsort(self.node_ids, kind='stable')
+        self.node_sorter = np.asarray(node_sorter, dtype=np.int32)
+        # Bản sao dạng list cho vòng lặp Dijkstra thuần Python (nhanh hơn truy cập phần tử numpy)
+        self._indptr_list = self.indptr.tolist()
+        self._targets_list = self.edge_targets.tolist()
+        self._reverse_lists = None # CSR ngược (theo nút đích), dựng khi cần cho Dijkstra hai chiều
+        self._spatial_index = None # KD-tree trên toạ độ nút, dựng một lần khi snap lần đầu
+
+    @classmethod
+    def from_networkx(cls, G, taxi_zones_gdf=None):
+        """Dựng CompactGraph từ MultiDiGraph; nếu có taxi_zones_gdf thì gắn luôn LocationID cho từng cạnh."""
+        node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+        node_index = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+        node_x = np.array([data['x'] for _, data in G.nodes(data=True)], dtype=np.float64)
+        node_y = np.array([data['y'] for _, data in G.nodes(data=True)], dtype=np.float64)
+
+        num_edges = G.number_of_edges()
+        edge_sources = np.empty(num_edges, dtype=np.int32)
+        edge_targets = np.empty(num_edges, dtype=np.int32)
+        for i, (u, v) in enumerate(G.edges()):
+            edge_sources[i] = node_index[u]
+            edge_targets[i] = node_index[v]
+        if num_edges and np.any(np.diff(edge_sources) < 0):
+            raise ValueError("Thứ tự cạnh của đồ thị không được nhóm theo nút nguồn, không thể dựng CSR.")
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(edge_sources, minlength=len(node_ids)), out=indptr[1:])
+
+        # Hình học của cạnh (LineString nếu có, nếu không thì đoạn thẳng u -> v) để vẽ lộ trình không cần G
+        geometry_counts = np.empty(num_edges, dtype=np.int32)
+        geometry_coords = []
+        for i, (u, v, data) in enumerate(G.edges(data=True)):
+            geometry = data.get('geometry')
+            if geometry is not None:
+                coords = list(geometry.coords)
+            else:
+                coords = [(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])]
+            geometry_counts[i] = len(coords)
+            geometry_coords.extend(coords)
+        geometry_indptr = np.zeros(num_edges + 1, dtype=np.int32)
+        np.cumsum(geometry_counts, out=geometry_indptr[1:])
+        geometry_xy = np.array(geometry_coords, dtype=np.float64).reshape(-1, 2)
+
+        lengths_m, modifiers, max_speeds_mps = get_edge_speed_attributes(G)
+        edge_location_ids = None
+        if taxi_zones_gdf is not None:
+            edge_location_ids = get_edge_location_ids(G, taxi_zones_gdf)
+
+        print(f"Đã dựng đồ thị CSR: {len(node_ids)} nút, {num_edges} cạnh.")
+        return cls(node_ids, node_x, node_y, indptr, edge_sources, edge_targets,
+                   lengths_m, modifiers, max_speeds_mps, edge_location_ids,
+                   geometry_indptr=geometry_indptr, geometry_xy=geometry_xy)
+
+    @property
+    def num_nodes(self):
+        return self.node_ids.size
+
+    @property
+    def num_edges(self):
+        return self.edge_targets.size
+
+    def fingerprint(self):
+        """Dấu vân tay (sha1) của topo và các thuộc tính cạnh, dùng để khóa các dữ liệu dẫn xuất trên đĩa."""
+        if getattr(self, '_fingerprint', None) is None:
+            hasher = hashlib.sha1()
+            for array in (self.node_ids, self.indptr, self.edge_targets, self.lengths_m,
+                          self.modifiers, self.max_speeds_mps, self.edge_location_ids):
+                hasher.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
+    def node_index(self, osm_node_id):
+        """Chỉ số nút (int) của một OSM node id, None nếu không có trong đồ thị."""
+        position = np.searchsorted(self.node_ids, osm_node_id, sorter=self.node_sorter)
+        if position < self.num_nodes:
+            index = int(self.node_sorter[position])
+            if self.node_ids[index] == osm_node_id:
+                return index
+        return None
+
+    @property
+    def spatial_index(self):
+        """Chỉ mục không gian (KD-tree) của đồ thị, dựng một lần và dùng chung cho mọi lần snap."""
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex(self)
+        return self._spatial_index
+
+    def nearest_node(self, lat, lon):
+        """OSM node id gần toạ độ (lat, lon) nhất."""
+        node_ids, _ = self.spatial_index.snap_points([lat], [lon])
+        return int(node_ids[0])
+
+    def snap_points(self, lats, lons):
+        """Snap nhiều toạ độ cùng lúc: (mảng OSM node id, mảng khoảng cách snap tính bằng mét)."""
+        return self.spatial_index.snap_points(lats, lons)
+
+    def route_coordinates(self, route):
+        """
+        Danh sách toạ độ [lat, lon] dọc lộ trình (danh sách OSM node id) để vẽ bản đồ.
+        Giữa hai nút liên tiếp chọn cạnh song song ngắn nhất, giống ox.routing.route_to_gdf.
+        """
+        node_path = [self.node_index(node_id) for node_id in route]
+        coordinates = []
+        for u, v in zip(node_path[:-1], node_path[1:]):
+            candidate_edges = [e for e in range(self._indptr_list[u], self._indptr_list[u + 1]) if self._targets_list[e] == v]
+            if not candidate_edges:
+                continue
+            e = min(candidate_edges, key=lambda edge: self.lengths_m[edge])
+            if self.geometry_indptr is not None:
+                edge_xy = self.geometry_xy[self.geometry_indptr[e]:self.geometry_indptr[e + 1]]
+            else:
+                edge_xy = np.array([[self.node_x[u], self.node_y[u]], [self.node_x[v], self.node_y[v]]])
+            edge_coordinates = [[float(y), float(x)] for x, y in edge_xy]
+            coordinates.extend(edge_coordinates[1:] if coordinates else edge_coordinates)
+        return coordinates
+
+    def to_osm_ids(self, node_indices):
+        """Chuyển danh sách chỉ số nút về danh sách OSM node id."""
+        return self.node_ids[np.asarray(node_indices, dtype=np.int64)].tolist()
+
+    def compute_travel_times(self, target_hour, target_day_numeric, fallback_median_speed_by_hour, speed_table=None):
+        """Tính vector travel_time (giây, float32) cho mọi cạnh, cùng công thức với add_travel_times_to_graph."""
+        base_speed_mph_by_edge, _ = compute_base_speeds_mph(
+            self.edge_location_ids, target_hour, target_day_numeric, fallback_median_speed_by_hour,
+            speed_table=speed_table
+        )
+        travel_times = compute_travel_times_from_base_speeds(
+            base_speed_mph_by_edge,
+            self.lengths_m.astype(np.float64),
+            self.modifiers.astype(np.float64),
+            self.max_speeds_mps.astype(np.float64)
+        )
+        return travel_times.astype(np.float32)
+
+    def shortest_path(self, source, target, weights, method=ROUTING_ENGINE):
+        """
+        Lộ trình ngắn nhất trên mảng CSR giữa hai chỉ số nút theo thuật toán được chọn
+        ("dijkstra", "bidirectional" hoặc "astar"; cả ba cho cùng tổng trọng số).
+        Trả về (danh sách chỉ số nút, danh sách chỉ số cạnh, tổng trọng số) hoặc (None, None, inf).
+        """
+        edge_weights = weights.tolist() if isinstance(weights, np.ndarray) else list(weights)
+        if method == "dijkstra":
+            return self._dijkstra(source, target, edge_weights)
+        if method == "bidirectional":
+            return self._bidirectional_dijkstra(source, target, edge_weights)
+        if method == "astar":
+            return self._astar(source, target, edge_weights, self.astar_heuristic(target, weights))
+        raise ValueError(f"Thuật toán tìm đường không hợp lệ: '{method}'. Chọn một trong {ROUTING_ENGINES}.")
+
+    def astar_heuristic(self, target, weights):
+        """
+        Cận dưới thời gian (giây) từ mọi nút tới target: khoảng cách đường chim bay chia cho
+        tốc độ lớn nhất có trong lớp trọng số hiện tại (nên không bao giờ vượt chi phí thật).
+        """
+        max_speed_mps = max_edge_speed_mps(self.lengths_m, weights) / ASTAR_HEURISTIC_SLACK
+        straight_line_m = ox.distance.great_circle(self.node_y, self.node_x, self.node_y[target], self.node_x[target])
+        return (straight_line_m / max_speed_mps).tolist()
+
+    def _dijkstra(self, source, target, edge_weights):
+        """Dijkstra một chiều."""
+        indptr = self._indptr_list
+        targets = self._targets_list
+        inf = float('inf')
+
+        dist = [inf] * self.num_nodes
+        pred_edge = [-1] * self.num_nodes
+        settled = [False] * self.num_nodes
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            settled[u] = True
+            if u == target:
+                break
+            for e in range(indptr[u], indptr[u + 1]):
+                v = targets[e]
+                nd = d + edge_weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    pred_edge[v] = e
+                    heapq.heappush(heap, (nd, v))
+
+        if dist[target] == inf:
+            return None, None, inf
+        return self._unwind_path(source, target, pred_edge) + (dist[target],)
+
+    def time_dependent_shortest_path(self, source, target, layer_for_slot, departure_seconds):
+        """
+        Dijkstra phụ thuộc thời gian trên các lớp travel_time theo giờ: mỗi cạnh được tính theo lớp của khung giờ
+        lúc xe đi vào cạnh; nếu đang đi trên cạnh mà sang khung giờ mới thì phần còn lại của cạnh đi với tốc độ
+        của khung mới. Tốc độ hằng số từng khúc nên thoả FIFO (vào cạnh muộn hơn không bao giờ ra sớm hơn),
+        do đó Dijkstra theo thời điểm đến vẫn cho lộ trình tối ưu.
+        layer_for_slot(slot): vector travel_time của khung slot (0..167, xem time_slot_index), chỉ được gọi
+        cho các khung mà tìm kiếm thực sự chạm tới; departure_seconds: giây kể từ 0h Thứ Hai.
+        Trả về (danh sách chỉ số nút, danh sách chỉ số cạnh, tổng thời gian giây) hoặc (None, None, inf).
+        """
+        return self._time_dependent_search(source, target, self._slot_weights(layer_for_slot), departure_seconds)
+
+    def departure_sweep(self, source, target, layer_for_slot, departures_seconds):
+        """
+        Thời gian đi từ source tới target cho nhiều thời điểm khởi hành (cùng mô hình cạnh với
+        time_dependent_shortest_path, kết quả như nhau). Các lượt tìm dùng chung cấu trúc thay vì chạy lại từ đầu:
+        - Chạy trước thời điểm khởi hành muộn nhất; theo FIFO mọi lượt khác đến nơi không muộn hơn, nên chỉ
+          dùng các khung giờ tới lúc đó. Cận dưới thời gian còn lại tới target (một lần Dijkstra ngược trên
+          travel_time nhỏ nhất của từng cạnh trong các khung này) làm heuristic A* cho mọi lượt còn lại.
+        - Lượt nào đến nơi trước khi hết khung giờ khởi hành thì đó là lộ trình tĩnh tối ưu của khung: mọi
+          thời điểm khởi hành khác trong khung vẫn đến kịp trước khi hết khung dùng lại kết quả, không cần tìm.
+        - Các lớp giờ chỉ được lấy và chuyển đổi một lần.
+        Trả về list (danh sách chỉ số nút, danh sách chỉ số cạnh, tổng thời gian giây) theo thứ tự departures_seconds.
+        """
+        departures = [float(departure) for departure in departures_seconds]
+        if not departures:
+            return []
+        weights_for = self._slot_weights(layer_for_slot)
+        latest = max(range(len(departures)), key=departures.__getitem__)
+        results = [None] * len(departures)
+        results[latest] = self._time_dependent_search(source, target, weights_for, departures[latest])
+        if results[latest][0] is None:
+            return [(None, None, float('inf'))] * len(departures) # FIFO: khởi hành sớm hơn cũng không tới được
+
+        first_slot = int(min(departures) // SECONDS_PER_SLOT)
+        last_slot = int((departures[latest] + results[latest][2]) // SECONDS_PER_SLOT)
+        heuristic = None
+        if last_slot - first_slot < SWEEP_HEURISTIC_MAX_SLOTS: # Khoảng quá dài: cận dưới lỏng, không đáng dựng
+            lower_bound_weights = np.asarray(weights_for(first_slot), dtype=np.float64)
+            for slot in range(first_slot + 1, last_slot + 1):
+                lower_bound_weights = np.minimum(lower_bound_weights, weights_for(slot))
+            heuristic = self._backward_costs(target, lower_bound_weights.tolist())
+
+        within_slot = {} # Khung giờ -> kết quả của một lượt đến nơi trước khi hết khung (lộ trình tĩnh tối ưu)
+        for k in sorted(range(len(departures)), key=departures.__getitem__):
+            departure = departures[k]
+            slot = int(departure // SECONDS_PER_SLOT)
+            slot_end = (slot + 1) * SECONDS_PER_SLOT
+            reusable = within_slot.get(slot)
+            if results[k] is None and reusable is not None and departure + reusable[2] <= slot_end:
+                results[k] = reusable
+                continue
+            if results[k] is None:
+                results[k] = self._time_dependent_search(source, target, weights_for, departure, heuristic)
+            if results[k][0] is not None and departure + results[k][2] <= slot_end:
+                within_slot.setdefault(slot, results[k])
+        return results
+
+    @staticmethod
+    def _slot_weights(layer_for_slot):
+        """Hàm slot -> travel_time dạng list (slot tính liên tục qua các tuần), mỗi khung chỉ lấy và chuyển đổi một lần."""
+        slot_weights = {}
+
+        def weights_for(slot):
+            slot %= NUM_TIME_SLOTS
+            edge_weights = slot_weights.get(slot)
+            if edge_weights is None:
+                layer = layer_for_slot(slot)
+                edge_weights = layer.tolist() if isinstance(layer, np.ndarray) else list(layer)
+                slot_weights[slot] = edge_weights
+            return edge_weights
+        return weights_for
+
+    def _time_dependent_search(self, source, target, weights_for, departure_seconds, heuristic=None):
+        """
+        Dijkstra theo thời điểm đến (A* nếu có heuristic: cận dưới thời gian còn lại tới target, nhất quán với
+        mọi khung giờ mà lượt tìm có thể chạm tới).
+        """
+        indptr = self._indptr_list
+        targets = self._targets_list
+        inf = float('inf')
+
+        departure_seconds = float(departure_seconds)
+        arrival = [inf] * self.num_nodes
+        pred_edge = [-1] * self.num_nodes
+        settled = [False] * self.num_nodes
+        arrival[source] = departure_seconds
+        heap = [(departure_seconds + (heuristic[source] if heuristic else 0.0), source)]
+        while heap:
+            _, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            settled[u] = True
+            if u == target:
+                break
+            t = arrival[u]
+            slot = int(t // SECONDS_PER_SLOT)
+            slot_end = (slot + 1) * SECONDS_PER_SLOT
+            edge_weights = weights_for(slot)
+            for e in range(indptr[u], indptr[u + 1]):
+                v = targets[e]
+                at = t + edge_weights[e]
+                if at > slot_end:
+                    at = self._cross_slot_arrival(e, t, slot, weights_for)
+                if at < arrival[v]:
+                    arrival[v] = at
+                    pred_edge[v] = e
+                    heapq.heappush(heap, (at + heuristic[v] if heuristic else at, v))
+
+        if arrival[target] == inf:
+            return None, None, inf
+        return self._unwind_path(source, target, pred_edge) + (arrival[target] - departure_seconds,)
+
+    def _backward_costs(self, target, edge_weights):
+        """Chi phí nhỏ nhất từ mọi nút tới target (Dijkstra ngược trên CSR ngược), list theo chỉ số nút."""
+        reverse_indptr, reverse_edges, sources = self._reverse_csr()
+        inf = float('inf')
+        dist = [inf] * self.num_nodes
+        dist[target] = 0.0
+        heap = [(0.0, target)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in range(reverse_indptr[u], reverse_indptr[u + 1]):
+                e = reverse_edges[k]
+                v = sources[e]
+                nd = d + edge_weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    @staticmethod
+    def _cross_slot_arrival(e, t, slot, weights_for):
+        """Thời điểm ra khỏi cạnh e khi vào lúc t mà chưa đi hết cạnh trong khung slot (đi tiếp sang các khung sau)."""
+        remaining = 1.0 # Phần chiều dài cạnh chưa đi
+        while True:
+            edge_seconds = weights_for(slot)[e]
+            if not edge_seconds < float('inf'):
+                return float('inf')
+            slot_end = (slot + 1) * SECONDS_PER_SLOT
+            if t + remaining * edge_seconds <= slot_end:
+                return t + remaining * edge_seconds
+            remaining -= (slot_end - t) / edge_seconds
+            t = slot_end
+            slot += 1
+
+    def shortest_path_tree(self, source, weights, targets=None, max_cost=float('inf')):
+        """
+        Dijkstra một nguồn tới nhiều đích: dừng khi đã chốt mọi nút trong targets (nếu có)
+        hoặc khi khoảng cách vượt max_cost. Trả về (dist, pred_edge, length_m) dạng list theo chỉ số nút;
+        nút chưa được chốt có dist = inf, length_m là chiều dài (mét) của đường đi nhanh nhất.
+        """
+        indptr = self._indptr_list
+        targets_list = self._targets_list
+        edge_weights = weights.tolist() if isinstance(weights, np.ndarray) else list(weights)
+        edge_lengths = self._lengths_list()
+        inf = float('inf')
+
+        dist = [inf] * self.num_nodes
+        length_m = [inf] * self.num_nodes
+        pred_edge = [-1] * self.num_nodes
+        settled = [False] * self.num_nodes
+        remaining = set(targets) if targets is not None else None
+        dist[source] = 0.0
+        length_m[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            if d > max_cost:
+                break
+            settled[u] = True
+            if remaining is not None:
+                remaining.discard(u)
+                if not remaining:
+                    break
+            for e in range(indptr[u], indptr[u + 1]):
+                v = targets_list[e]
+                nd = d + edge_weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    length_m[v] = length_m[u] + edge_lengths[e]
+                    pred_edge[v] = e
+                    heapq.heappush(heap, (nd, v))
+
+        for node in range(self.num_nodes):
+            if not settled[node]:
+                dist[node] = inf
+                length_m[node] = inf
+        return dist, pred_edge, length_m
+
+    def _lengths_list(self):
+        """Chiều dài cạnh dạng list (dựng khi cần, dùng trong vòng lặp Python)."""
+        if getattr(self, '_edge_lengths_list', None) is None:
+            self._edge_lengths_list = self.lengths_m.astype(np.float64).tolist()
+        return self._edge_lengths_list
+
+    def _astar(self, source, target, edge_weights, heuristic):
+        """A*: Dijkstra ưu tiên theo dist + heuristic; heuristic chấp nhận được nên kết quả vẫn tối ưu."""
+        indptr = self._indptr_list
+        targets = self._targets_list
+        inf = float('inf')
+
+        dist = [inf] * self.num_nodes
+        pred_edge = [-1] * self.num_nodes
+        dist[source] = 0.0
+        heap = [(heuristic[source], 0.0, source)]
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue # Mục cũ trong heap (nút đã được cập nhật khoảng cách tốt hơn)
+            if u == target:
+                break
+            for e in range(indptr[u], indptr[u + 1]):
+                v = targets[e]
+                nd = d + edge_weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    pred_edge[v] = e
+                    heapq.heappush(heap, (nd + heuristic[v], nd, v))
+
+        if dist[target] == inf:
+            return None, None, inf
+        return self._unwind_path(source, target, pred_edge) + (dist[target],)
+
+    def _reverse_csr(self):
+        """CSR ngược: với mỗi nút, danh sách cạnh đi vào nó (chỉ số cạnh gốc)."""
+        if self._reverse_lists is None:
+            reverse_edges = np.argsort(self.edge_targets, kind='stable').astype(np.int32)
+            reverse_indptr = np.zeros(self.num_nodes + 1, dtype=np.int32)
+            np.cumsum(np.bincount(self.edge_targets, minlength=self.num_nodes), out=reverse_indptr[1:])
+            self._reverse_lists = (reverse_indptr.tolist(), reverse_edges.tolist(), self.edge_sources.tolist())
+        return self._reverse_lists
+
+    def _bidirectional_dijkstra(self, source, target, edge_weights):
+        """
+        Dijkstra hai chiều: tìm xuôi từ source và ngược từ target xen kẽ, dừng khi tổng hai
+        đỉnh heap không nhỏ hơn chi phí tốt nhất đã gặp.
+        """
+        indptr = self._indptr_list
+        targets = self._targets_list
+        reverse_indptr, reverse_edges, sources = self._reverse_csr()
+        inf = float('inf')
+        if source == target:
+            return [source], [], 0.0
+
+        dist_forward = [inf] * self.num_nodes
+        dist_backward = [inf] * self.num_nodes
+        pred_edge = [-1] * self.num_nodes
+        succ_edge = [-1] * self.num_nodes
+        dist_forward[source] = 0.0
+        dist_backward[target] = 0.0
+        heap_forward = [(0.0, source)]
+        heap_backward = [(0.0, target)]
+        best_cost, meeting_node = inf, -1
+
+        while heap_forward and heap_backward:
+            if heap_forward[0][0] + heap_backward[0][0] >= best_cost:
+                break
+            if heap_forward[0][0] <= heap_backward[0][0]:
+                d, u = heapq.heappop(heap_forward)
+                if d > dist_forward[u]:
+                    continue
+                for e in range(indptr[u], indptr[u + 1]):
+                    v = targets[e]
+                    nd = d + edge_weights[e]
+                    if nd < dist_forward[v]:
+                        dist_forward[v] = nd
+                        pred_edge[v] = e
+                        heapq.heappush(heap_forward, (nd, v))
+                        if nd + dist_backward[v] < best_cost:
+                            best_cost, meeting_node = nd + dist_backward[v], v
+            else:
+                d, u = heapq.heappop(heap_backward)
+                if d > dist_backward[u]:
+                    continue
+                for k in range(reverse_indptr[u], reverse_indptr[u + 1]):
+                    e = reverse_edges[k]
+                    v = sources[e]
+                    nd = d + edge_weights[e]
+                    if nd < dist_backward[v]:
+                        dist_backward[v] = nd
+                        succ_edge[v] = e
+                        heapq.heappush(heap_backward, (nd, v))
+                        if dist_forward[v] + nd < best_cost:
+                            best_cost, meeting_node = dist_forward[v] + nd, v
+
+        if meeting_node < 0:
+            return None, None, inf
+        node_path, edge_path = self._unwind_path(source, meeting_node, pred_edge)
+        node = meeting_node
+        while node != target:
+            e = succ_edge[node]
+            edge_path.append(e)
+            node = targets[e]
+            node_path.append(node)
+        return node_path, edge_path, best_cost
+
+    def _unwind_path(self, source, target, pred_edge):
+        """Dựng lại danh sách nút/cạnh từ mảng cạnh tiền nhiệm."""
+        edge_path = []
+        node = target
+        while node != source:
+            e = pred_edge[node]
+            edge_path.append(e)
+            node = int(self.edge_sources[e])
+        edge_path.reverse()
+        node_path = [source] + [self._targets_list[e] for e in edge_path]
+        return node_path, edge_path
+
+
+def calculate_eta_on_compact_graph(compact_graph, travel_times, origin_node, destination_node, method=ROUTING_ENGINE):
+    """
+    Tìm lộ trình nhanh nhất trên CompactGraph với vector travel_time cho trước.
+    Đầu vào/đầu ra dùng OSM node id. Trả về (route, eta_minutes, distance_m).
+    """
+    if compact_graph is None or travel_times is None or origin_node is None or destination_node is None:
+        print("Lỗi: Thiếu thông tin đồ thị hoặc điểm đầu/cuối để tính ETA.")
+        return None, None, None
+    source = compact_graph.node_index(origin_node)
+    target = compact_graph.node_index(destination_node)
+    if source is None or target is None:
+        print(f"LỖI: Nút xuất phát {origin_node} hoặc nút đích {destination_node} không tồn tại trong đồ thị.")
+        return None, None, None
+
+    print(f"Đang tìm lộ trình từ {origin_node} đến {destination_node} trên đồ thị CSR...")
+    node_path, edge_path, total_travel_time_seconds = compact_graph.shortest_path(
+        source, target, travel_times, method=method
+    )
+    if node_path is None:
+        print("Không tìm thấy lộ trình giữa hai điểm đã chọn.")
+        return None, None, None
+
+    eta_minutes = total_travel_time_seconds / 60
+    distance_m = float(compact_graph.lengths_m[edge_path].sum(dtype=np.float64))
+    print(f"Thời gian di chuyển dự kiến (ETA): {total_travel_time_seconds:.2f} giây ({eta_minutes:.2f} phút)")
+    return compact_graph.to_osm_ids(node_path), eta_minutes, distance_m
+
+
+def calculate_time_dependent_eta(travel_time_layers, origin_node, destination_node, target_hour, target_day_numeric,
+                                 departure_minute=0):
+    """
+    Như calculate_eta_on_compact_graph nhưng khởi hành lúc target_hour:departure_minute và mỗi cạnh được tính
+    theo khung giờ lúc xe đi vào cạnh (chuyến đi vắt qua nhiều giờ dùng đúng tốc độ của từng giờ).
+    Các lớp travel_time lấy từ TravelTimeLayers (chỉ tính các khung giờ cần tới).
+    Đầu vào/đầu ra dùng OSM node id. Trả về (route, eta_minutes, distance_m).
+    """
+    compact_graph = travel_time_layers.compact_graph if travel_time_layers is not None else None
+    if compact_graph is None or origin_node is None or destination_node is None:
+        print("Lỗi: Thiếu thông tin đồ thị hoặc điểm đầu/cuối để tính ETA.")
+        return None, None, None
+    source = compact_graph.node_index(origin_node)
+    target = compact_graph.node_index(destination_node)
+    if source is None or target is None:
+        print(f"LỖI: Nút xuất phát {origin_node} hoặc nút đích {destination_node} không tồn tại trong đồ thị.")
+        return None, None, None
+
+    print(f"Đang tìm lộ trình phụ thuộc thời gian từ {origin_node} đến {destination_node} "
+          f"(khởi hành {int(target_hour):02d}:{int(departure_minute):02d}, ngày {target_day_numeric})...")
+    node_path, edge_path, total_travel_time_seconds = compact_graph.time_dependent_shortest_path(
+        source, target,
+        lambda slot: travel_time_layers.get(slot % HOURS_PER_DAY, slot // HOURS_PER_DAY),
+        departure_week_seconds(target_hour, target_day_numeric, departure_minute)
+    )
+    if node_path is None:
+        print("Không tìm thấy lộ trình giữa hai điểm đã chọn.")
+        return None, None, None
+
+    eta_minutes = total_travel_time_seconds / 60
+    distance_m = float(compact_graph.lengths_m[edge_path].sum(dtype=np.float64))
+    print(f"Thời gian di chuyển dự kiến (ETA): {total_travel_time_seconds:.2f} giây ({eta_minutes:.2f} phút)")
+    return compact_graph.to_osm_ids(node_path), eta_minutes, distance_m
+
+
+def calculate_departure_profile(travel_time_layers, origin_node, destination_node, target_day_numeric,
+                                window_start_hour, window_end_hour, step_minutes=DEPARTURE_SWEEP_STEP_MINUTES):
+    """
+    ETA cho mọi thời điểm khởi hành từ window_start_hour:00 tới window_end_hour:00 (tính cả hai đầu, cách nhau
+    step_minutes; window_end_hour < window_start_hour nghĩa là sang ngày hôm sau, window_end_hour == window_start_hour
+    là một khung một giờ từ window_start_hour:00 tới window_start_hour + 1:00) của ngày target_day_numeric,
+    bằng một lần CompactGraph.departure_sweep (lộ trình phụ thuộc thời gian như calculate_time_dependent_eta).
+    Trả về (profile, best): profile là DataFrame (departure 'HH:MM', departure_day, eta_minutes, arrival 'HH:MM',
+    distance_m) theo thứ tự thời gian; best là dict (departure, departure_day, eta_minutes, route theo OSM node id,
+    distance_m) của thời điểm khởi hành có ETA nhỏ nhất. (None, None) nếu lỗi hoặc không có lộ trình.
+    """
+    compact_graph = travel_time_layers.compact_graph if travel_time_layers is not None else None
+    if compact_graph is None or origin_node is None or destination_node is None:
+        print("Lỗi: Thiếu thông tin đồ thị hoặc điểm đầu/cuối để tính ETA.")
+        return None, None
+    source = compact_graph.node_index(origin_node)
+    target = compact_graph.node_index(destination_node)
+    if source is None or target is None:
+        print(f"LỖI: Nút xuất phát {origin_node} hoặc nút đích {destination_node} không tồn tại trong đồ thị.")
+        return None, None
+    if step_minutes <= 0:
+        print(f"Lỗi: Bước thời gian khởi hành phải dương (nhận {step_minutes} phút).")
+        return None, None
+
+    window_start = departure_week_seconds(window_start_hour, target_day_numeric)
+    window_minutes = ((int(window_end_hour) - int(window_start_hour)) % HOURS_PER_DAY or 1) * 60
+    departures = [window_start + minute * 60 for minute in range(0, window_minutes + 1, int(step_minutes))]
+    print(f"Đang tính ETA cho {len(departures)} thời điểm khởi hành từ {int(window_start_hour):02d}:00 "
+          f"tới {(int(window_start_hour) + window_minutes // 60) % HOURS_PER_DAY:02d}:00 (ngày {target_day_numeric}) từ {origin_node} đến {destination_node}...")
+    results = compact_graph.departure_sweep(
+        source, target,
+        lambda slot: travel_time_layers.get(slot % HOURS_PER_DAY, slot // HOURS_PER_DAY),
+        departures
+    )
+
+    def clock(week_seconds):
+        minute_of_day = int(round(week_seconds / 60)) % (HOURS_PER_DAY * 60)
+        return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+    rows = []
+    for departure, (_, edge_path, travel_seconds) in zip(departures, results):
+        reachable = edge_path is not None
+        rows.append({
+            'departure': clock(departure),
+            'departure_day': int(departure // (HOURS_PER_DAY * SECONDS_PER_SLOT)) % DAYS_PER_WEEK,
+            'eta_minutes': travel_seconds / 60 if reachable else float('inf'),
+            'arrival': clock(departure + travel_seconds) if reachable else None,
+            'distance_m': float(compact_graph.lengths_m[edge_path].sum(dtype=np.float64)) if reachable else float('inf'),
+        })
+    profile = pd.DataFrame(rows)
+    if not np.isfinite(profile['eta_minutes']).any():
+        print("Không tìm thấy lộ trình giữa hai điểm đã chọn.")
+        return profile, None
+
+    best_index = int(profile['eta_minutes'].idxmin())
+    best_row = rows[best_index]
+    best = {
+        'departure': best_row['departure'],
+        'departure_day': best_row['departure_day'],
+        'eta_minutes': float(best_row['eta_minutes']),
+        'route': compact_graph.to_osm_ids(results[best_index][0]),
+        'distance_m': best_row['distance_m'],
+    }
+    print(f"Khởi hành tốt nhất: {best['departure']} (ETA {best['eta_minutes']:.2f} phút; "
+          f"chậm nhất {profile.loc[np.isfinite(profile['eta_minutes']), 'eta_minutes'].max():.2f} phút).")
+    return profile, best
@@ -4,12 +4,36 @@
 PLACE_NAME = "Manhattan, New York City, New York, USA"
 TAXI_ZONES_SHAPEFILE_PATH = "data/nyc_taxi_zones/taxi_zones.shp" # Điều chỉnh nếu cần
 # Đặt tên file dữ liệu taxi của bạn ở đây
+# Có thể là một file, một thư mục hoặc một glob (ví dụ "data/yellow_tripdata_*.parquet") gồm nhiều tháng
 YELLOW_TAXI_DATA_FILE = "data/yellow_tripdata_2025-01.parquet" # Điều chỉnh nếu cần
+# Chỉ đọc các tháng trong khoảng này (theo tên file yellow_tripdata_YYYY-MM.parquet), ví dụ ("2024-01", "2024-12"); None = mọi tháng
+TRIP_DATA_MONTHS = None
+# Số dòng mỗi lô khi đọc dữ liệu taxi theo luồng (bộ nhớ đỉnh tỉ lệ với lô, không với kích thước file)
+TRIP_DATA_BATCH_SIZE = 500_000
+# Số tiến trình chuẩn bị dữ liệu huấn luyện (mỗi tiến trình xử lý một phần row group); None = số lõi CPU, 1 = tuần tự
+DATA_PREPARATION_WORKERS = None
+
+# Thư mục lưu đồ thị đã tải và các dữ liệu dẫn xuất từ đồ thị (ánh xạ cạnh -> LocationID, ...)
+GRAPH_CACHE_DIR = "graph_cache"
+ROAD_NETWORK_CACHE_VERSION = 1 # Tăng khi thay đổi định dạng file đồ thị networkx lưu cục bộ (pickle)
+# Kho mảng (đồ thị CSR, ánh xạ cạnh -> LocationID, 168 lớp travel_time) mở bằng mmap, dùng chung giữa các worker
+GRAPH_STORE_DIR = "graph_cache/store"
+GRAPH_STORE_VERSION = 1 # Tăng khi thay đổi cấu trúc thư mục/file của kho mmap
+GRAPH_STORE_KEEP_VERSIONS = 3 # Số phiên bản kho giữ lại trên đĩa (mỗi lần huấn luyện lại ghi thêm một bản 168 lớp)
 
 # --- Cấu hình Phân tích ---
 TARGET_BOROUGH = "Manhattan"
 DEFAULT_TARGET_HOUR = 10  # Giờ mặc định để tính ETA (ví dụ: 10 giờ sáng)
 DEFAULT_TARGET_DAY_NUMERIC = 1  # Ngày mặc định (0=Thứ Hai, 1=Thứ Ba, ..., 6=Chủ Nhật)
+# Thuật toán tìm đường: "dijkstra", "bidirectional" (Dijkstra hai chiều) hoặc "astar" (A* với heuristic khoảng cách đường chim bay)
+ROUTING_ENGINE = "bidirectional"
+# Ứng dụng web: trả lời truy vấn ETA bằng contraction hierarchy (tiền xử lý một lần, customize theo từng lớp giờ/ngày)
+USE_CONTRACTION_HIERARCHY = True
+# Tìm đường phụ thuộc thời gian: mỗi cạnh tính theo lớp giờ lúc xe đi vào cạnh (chuyến đi vắt qua nhiều giờ
+# không bị tính hết theo tốc độ của giờ khởi hành). Dùng Dijkstra trên đồ thị CSR (chậm hơn contraction hierarchy),
+# nên mặc định tắt; trong ứng dụng web người dùng bật riêng cho từng truy vấn, giá trị này là lựa chọn mặc định
+TIME_DEPENDENT_ROUTING = False
+DEPARTURE_SWEEP_STEP_MINUTES = 15 # Bước giữa các thời điểm khởi hành khi tìm giờ khởi hành tốt nhất trong một khung
 
 # --- Cấu hình Xử lý Dữ liệu ---
 MIN_TRIP_DURATION_MINUTES = 1
@@ -41,5 +65,31 @@ ROAD_TYPE_SPEED_MODIFIERS = {
 }
 
 
+# --- Cấu hình Geocoding ---
+GEOCODE_CACHE_PATH = "cache/geocode_cache.sqlite" # Cache kết quả geocoding trên đĩa (cạnh HTTP cache của OSMnx)
+GEOCODE_LRU_SIZE = 4096 # Số kết quả giữ trong bộ nhớ
+GAZETTEER_PATH = "data/manhattan_gazetteer.csv" # Địa chỉ/địa điểm ở Manhattan cho chế độ offline (tạo bằng 'python geocoding.py')
+GEOCODING_OFFLINE = False # True: không bao giờ gọi Nominatim, chỉ tra cache và gazetteer
+
+
+# Mô hình dự đoán tốc độ: "random_forest" (one-hot zone) hoặc "hist_gradient_boosting" (zone là biến phân loại gốc,
+# file nhỏ, nạp và dự đoán nhanh). Có thể truyền nhiều backend cho train_model.py để so sánh và tự chọn.
+MODEL_BACKEND = "random_forest"
+# Khi so sánh nhiều backend: chọn mô hình nhanh nhất trong số các mô hình có MAE kiểm thử không kém mô hình tốt nhất quá ngưỡng này
+MODEL_MAE_BUDGET_MPH = 0.1
+# Registry bundle mô hình có phiên bản (mô hình + preprocessor + tốc độ fallback + schema đặc trưng + hash),
+# xem model_registry.py; file CURRENT trong thư mục chỉ tới phiên bản đang dùng
+MODEL_REGISTRY_DIR = "models"
+MODEL_MMAP_MODE = "r" # joblib mmap_mode khi nạp bundle (None = đọc toàn bộ vào bộ nhớ)
+MODEL_VERIFY_HASH = True # Kiểm tra sha256 các file trong bundle trước khi nạp
+# Trạng thái/tiến độ của lần huấn luyện lại chạy nền trong app (xem retraining.py)
+RETRAINING_STATUS_PATH = "models/retraining_status.json"
+RETRAINING_STATUS_POLL_SECONDS = 5 # Chu kỳ app làm mới tiến độ huấn luyện lại
+# File mô hình/preprocessor rời theo định dạng cũ, chỉ đọc khi registry chưa có bundle nào
 MODEL_PATH = "trained_rf_model.joblib"
-PREPROCESSOR_PATH = "data_preprocessor.joblib"
\ No newline at end of file
+PREPROCESSOR_PATH = "data_preprocessor.joblib"
+SPEED_TABLE_PATH = "speed_table.npz" # Bảng tốc độ zone × giờ × ngày tính sẵn từ mô hình
+# Tốc độ trung vị theo giờ (24 giá trị) dùng làm fallback, lưu cùng mô hình khi huấn luyện để app/main không cần đọc dữ liệu chuyến đi
+FALLBACK_SPEEDS_PATH = "fallback_speeds.json"
+# Kho histogram tốc độ theo (zone, giờ, ngày) của từng file tháng đã gộp: tính trung vị không cần đọc lại chuyến đi thô
+SPEED_AGGREGATES_PATH = "speed_aggregates.npz"
\ No newline at end of file
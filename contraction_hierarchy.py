@@ -0,0 +1,438 @@
+# contraction_hierarchy.py
+import os
+import numpy as np
+from config import GRAPH_CACHE_DIR
+
+# Hướng của một cung CH (u, v) với rank[u] < rank[v]: đi lên (u -> v) hoặc đi xuống (v -> u)
+UP = 0
+DOWN = 1
+
+# Tên các mảng của phần tiền xử lý (không phụ thuộc trọng số) lưu trên đĩa
+HIERARCHY_ARRAY_NAMES = (
+    'rank', 'parent', 'arc_indptr', 'arc_tails', 'arc_heads', 'edge_arcs', 'edge_directions',
+    'triangle_lower', 'triangle_upper', 'triangle_target', 'triangle_level_indptr'
+)
+
+
+# Phần đồ thị nhỏ hơn ngưỡng này không chia tiếp trong nested dissection
+DISSECTION_LEAF_SIZE = 16
+
+
+def _nested_dissection_order(node_x, node_y, edge_sources, edge_targets):
+    """
+    Thứ tự co nút theo nested dissection hình học: chia đôi tập nút theo trung vị toạ độ trên trục
+    trải rộng hơn, các nút biên của nửa nhỏ hơn làm separator và được co sau cùng (rank cao nhất).
+    Thứ tự chỉ phụ thuộc topo/toạ độ (không phụ thuộc trọng số) và cho cây khử nông - điều kiện để
+    truy vấn CCH chỉ duyệt ít nút.
+    """
+    num_nodes = node_x.size
+    x_scaled = node_x * np.cos(np.radians(np.nanmean(node_y))) if num_nodes else node_x
+    non_loop = edge_sources != edge_targets
+    edge_u = edge_sources[non_loop].astype(np.int64)
+    edge_v = edge_targets[non_loop].astype(np.int64)
+    side = np.zeros(num_nodes, dtype=np.int8)
+
+    def dissect(nodes, edge_ids):
+        if nodes.size <= DISSECTION_LEAF_SIZE:
+            return [nodes]
+        xs, ys = x_scaled[nodes], node_y[nodes]
+        coordinates = xs if np.ptp(xs) >= np.ptp(ys) else ys
+        first_half = coordinates <= np.median(coordinates)
+        if first_half.all() or not first_half.any():
+            return [nodes]
+        side[nodes[first_half]] = 0
+        side[nodes[~first_half]] = 1
+        u, v = edge_u[edge_ids], edge_v[edge_ids]
+        crossing = side[u] != side[v]
+        # Separator: các nút có cạnh sang nửa bên kia, lấy ở phía có ít nút biên hơn
+        boundary_first = np.unique(np.where(side[u[crossing]] == 0, u[crossing], v[crossing]))
+        boundary_second = np.unique(np.where(side[u[crossing]] == 1, u[crossing], v[crossing]))
+        separator = boundary_first if boundary_first.size <= boundary_second.size else boundary_second
+        side[separator] = 2
+        # Tính cả hai nửa trước khi đệ quy vì lời gọi đệ quy ghi đè mảng side
+        halves = [(nodes[side[nodes] == half], edge_ids[(side[u] == half) & (side[v] == half)]) for half in (0, 1)]
+        parts = []
+        for half_nodes, half_edges in halves:
+            if half_nodes.size:
+                parts.extend(dissect(half_nodes, half_edges))
+        parts.append(separator)
+        return parts
+
+    order_parts = dissect(np.arange(num_nodes, dtype=np.int64), np.arange(edge_u.size, dtype=np.int64))
+    return np.concatenate(order_parts).tolist() if order_parts else []
+
+
+def _eliminate(order, num_nodes, edge_sources, edge_targets):
+    """
+    Khử nút theo thứ tự cho trước trên đồ thị vô hướng, thêm cạnh lấp đầy (fill-in) giữa mọi cặp
+    láng giềng còn lại - không cần witness search. Trả về tập láng giềng phía trên của từng nút.
+    """
+    adjacency = [set() for _ in range(num_nodes)]
+    for u, v in zip(edge_sources.tolist(), edge_targets.tolist()):
+        if u != v:
+            adjacency[u].add(v)
+            adjacency[v].add(u)
+    for node in order:
+        neighbors = adjacency[node] # Từ đây tập này cố định: là các láng giềng phía trên của node
+        for x in neighbors:
+            adjacency_x = adjacency[x]
+            adjacency_x.discard(node)
+            adjacency_x.update(neighbors)
+            adjacency_x.discard(x)
+    return adjacency
+
+
+class ContractionHierarchy:
+    """
+    Customizable Contraction Hierarchy (CCH) trên CompactGraph.
+    Tiền xử lý (thứ tự co, cung tắt, các tam giác dưới) chỉ phụ thuộc topo của đồ thị và làm một lần;
+    mỗi lớp travel_time (giờ, ngày) chỉ cần customize() lại trọng số, không phải co lại đồ thị.
+    Cung CH được lưu một lần cho mỗi cặp nút (u, v), rank[u] < rank[v], kèm trọng số hai hướng.
+    """
+
+    def __init__(self, compact_graph, rank, parent, arc_indptr, arc_tails, arc_heads, edge_arcs, edge_directions,
+                 triangle_lower, triangle_upper, triangle_target, triangle_level_indptr):
+        self.compact_graph = compact_graph
+        self.rank = np.asarray(rank, dtype=np.int32)
+        self.parent = np.asarray(parent, dtype=np.int32) # Cha trong cây khử (elimination tree), -1 nếu là gốc
+        self.arc_indptr = np.asarray(arc_indptr, dtype=np.int32) # Cung CH theo nút dưới (CSR)
+        self.arc_tails = np.asarray(arc_tails, dtype=np.int32)
+        self.arc_heads = np.asarray(arc_heads, dtype=np.int32)
+        self.edge_arcs = np.asarray(edge_arcs, dtype=np.int32) # Cung CH của từng cạnh gốc, -1 với vòng lặp
+        self.edge_directions = np.asarray(edge_directions, dtype=np.int8)
+        # Tam giác dưới (m, p, q): cung (m, p), (m, q) và cung đích (p, q), nhóm theo tầng của m
+        self.triangle_lower = np.asarray(triangle_lower, dtype=np.int32)
+        self.triangle_upper = np.asarray(triangle_upper, dtype=np.int32)
+        self.triangle_target = np.asarray(triangle_target, dtype=np.int32)
+        self.triangle_level_indptr = np.asarray(triangle_level_indptr, dtype=np.int64)
+
+        self._parent_list = self.parent.tolist()
+        self._arc_indptr_list = self.arc_indptr.tolist()
+        self._arc_heads_list = self.arc_heads.tolist()
+        self._arc_tails_list = self.arc_tails.tolist()
+        self._order_list = np.argsort(self.rank, kind='stable').tolist()
+
+    @classmethod
+    def build(cls, compact_graph):
+        """Tiền xử lý không phụ thuộc trọng số: thứ tự co, cung CH, cây khử và danh sách tam giác dưới."""
+        num_nodes = compact_graph.num_nodes
+        order = _nested_dissection_order(
+            compact_graph.node_x, compact_graph.node_y, compact_graph.edge_sources, compact_graph.edge_targets
+        )
+        upward_neighbors = _eliminate(order, num_nodes, compact_graph.edge_sources, compact_graph.edge_targets)
+        rank = np.empty(num_nodes, dtype=np.int32)
+        rank[np.asarray(order, dtype=np.int64)] = np.arange(num_nodes, dtype=np.int32)
+        rank_list = rank.tolist()
+
+        # Cung CH: (nút dưới, nút trên), sắp theo nút dưới rồi nút trên để tra cứu bằng tìm kiếm nhị phân
+        upward_sorted = [sorted(neighbors, key=rank_list.__getitem__) for neighbors in upward_neighbors]
+        arc_counts = np.fromiter((len(neighbors) for neighbors in upward_sorted), dtype=np.int64, count=num_nodes)
+        arc_indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(arc_counts, out=arc_indptr[1:])
+        arc_tails = np.repeat(np.arange(num_nodes, dtype=np.int64), arc_counts)
+        arc_heads = np.fromiter((x for neighbors in upward_sorted for x in neighbors), dtype=np.int64,
+                                count=int(arc_indptr[-1]))
+        arc_keys = arc_tails * num_nodes + arc_heads
+        arc_order = np.argsort(arc_keys, kind='stable')
+        sorted_arc_keys = arc_keys[arc_order]
+
+        def arc_ids(lower_nodes, upper_nodes):
+            return arc_order[np.searchsorted(sorted_arc_keys, lower_nodes * num_nodes + upper_nodes)]
+
+        # Cây khử: cha là láng giềng phía trên có rank nhỏ nhất
+        parent = np.array([neighbors[0] if neighbors else -1 for neighbors in upward_sorted], dtype=np.int32)
+
+        # Ánh xạ cạnh gốc -> cung CH và hướng
+        sources = compact_graph.edge_sources.astype(np.int64)
+        targets = compact_graph.edge_targets.astype(np.int64)
+        edge_directions = np.where(rank[sources] < rank[targets], UP, DOWN).astype(np.int8)
+        lower_nodes = np.where(edge_directions == UP, sources, targets)
+        upper_nodes = np.where(edge_directions == UP, targets, sources)
+        edge_arcs = np.full(sources.size, -1, dtype=np.int32)
+        non_loop = sources != targets
+        edge_arcs[non_loop] = arc_ids(lower_nodes[non_loop], upper_nodes[non_loop])
+
+        # Tầng của nút: 1 + tầng lớn nhất của các láng giềng phía dưới -> các tam giác cùng tầng độc lập nhau
+        level = [0] * num_nodes
+        for node in order:
+            for x in upward_sorted[node]:
+                if level[x] <= level[node]:
+                    level[x] = level[node] + 1
+        triangle_m, triangle_p, triangle_q = [], [], []
+        for m, neighbors in enumerate(upward_sorted):
+            for i, p in enumerate(neighbors):
+                for q in neighbors[i + 1:]:
+                    triangle_m.append(m)
+                    triangle_p.append(p)
+                    triangle_q.append(q)
+        triangle_m = np.asarray(triangle_m, dtype=np.int64)
+        triangle_p = np.asarray(triangle_p, dtype=np.int64)
+        triangle_q = np.asarray(triangle_q, dtype=np.int64)
+        triangle_levels = np.asarray(level, dtype=np.int64)[triangle_m]
+        level_order = np.argsort(triangle_levels, kind='stable')
+        triangle_m, triangle_p, triangle_q = triangle_m[level_order], triangle_p[level_order], triangle_q[level_order]
+        triangle_level_indptr = np.zeros(max(level) + 2 if num_nodes else 1, dtype=np.int64)
+        np.cumsum(np.bincount(triangle_levels, minlength=triangle_level_indptr.size - 1), out=triangle_level_indptr[1:])
+
+        print(f"Đã dựng contraction hierarchy: {arc_tails.size} cung, {triangle_m.size} tam giác, "
+              f"{triangle_level_indptr.size - 1} tầng.")
+        return cls(compact_graph, rank, parent, arc_indptr, arc_tails, arc_heads, edge_arcs, edge_directions,
+                   arc_ids(triangle_m, triangle_p), arc_ids(triangle_m, triangle_q), arc_ids(triangle_p, triangle_q),
+                   triangle_level_indptr)
+
+    @property
+    def num_arcs(self):
+        return self.arc_heads.size
+
+    def customize(self, weights):
+        """
+        Gán trọng số (vector travel_time theo cạnh, ví dụ một lớp của TravelTimeLayers) cho mọi cung CH.
+        Cạnh gốc song song lấy giá trị nhỏ nhất; sau đó duyệt tam giác dưới theo từng tầng
+        (vector hoá bằng numpy). Chiều dài (mét) của đường đi mà mỗi cung đại diện được tính kèm.
+        Trả về CustomizedHierarchy dùng để truy vấn.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        edge_lengths = self.compact_graph.lengths_m.astype(np.float64)
+        arc_weights = np.full((2, self.num_arcs), np.inf)
+        arc_lengths = np.full((2, self.num_arcs), np.inf)
+        arc_edges = np.full((2, self.num_arcs), -1, dtype=np.int32)
+        arc_triangles = np.full((2, self.num_arcs), -1, dtype=np.int32)
+
+        edge_ids = np.flatnonzero(self.edge_arcs >= 0)
+        for direction in (UP, DOWN):
+            direction_edges = edge_ids[self.edge_directions[edge_ids] == direction]
+            best_arcs, best_edges, best_weights = _min_per_target(
+                self.edge_arcs[direction_edges], weights[direction_edges], direction_edges
+            )
+            arc_weights[direction, best_arcs] = best_weights
+            arc_lengths[direction, best_arcs] = edge_lengths[best_edges]
+            arc_edges[direction, best_arcs] = best_edges
+
+        up_weights, down_weights = arc_weights[UP], arc_weights[DOWN]
+        up_lengths, down_lengths = arc_lengths[UP], arc_lengths[DOWN]
+        for level in range(self.triangle_level_indptr.size - 1):
+            start, end = self.triangle_level_indptr[level], self.triangle_level_indptr[level + 1]
+            if start == end:
+                continue
+            lower = self.triangle_lower[start:end]
+            upper = self.triangle_upper[start:end]
+            target = self.triangle_target[start:end]
+            triangle_ids = np.arange(start, end, dtype=np.int32)
+            # p -> q đi qua m: (p -> m) + (m -> q); q -> p: (q -> m) + (m -> p)
+            for direction, first, second in ((UP, lower, upper), (DOWN, upper, lower)):
+                candidates = down_weights[first] + up_weights[second]
+                best_arcs, best_triangles, best_weights = _min_per_target(target, candidates, triangle_ids)
+                improved = best_weights < arc_weights[direction, best_arcs]
+                improved_arcs, improved_triangles = best_arcs[improved], best_triangles[improved] - start
+                arc_weights[direction, improved_arcs] = best_weights[improved]
+                arc_lengths[direction, improved_arcs] = (down_lengths[first[improved_triangles]]
+                                                         + up_lengths[second[improved_triangles]])
+                arc_triangles[direction, improved_arcs] = improved_triangles + start
+
+        return CustomizedHierarchy(self, arc_weights, arc_lengths, arc_edges, arc_triangles)
+
+
+def _min_per_target(targets, values, payload):
+    """Với mỗi giá trị target khác nhau: (target, payload, value) của phần tử có value nhỏ nhất."""
+    order = np.lexsort((values, targets))
+    sorted_targets = targets[order]
+    first = np.ones(sorted_targets.size, dtype=bool)
+    first[1:] = sorted_targets[1:] != sorted_targets[:-1]
+    selected = order[first]
+    return targets[selected], payload[selected], values[selected]
+
+
+class CustomizedHierarchy:
+    """Contraction hierarchy đã gán trọng số cho một lớp travel_time; chỉ đọc, dùng chung giữa các truy vấn."""
+
+    def __init__(self, hierarchy, arc_weights, arc_lengths, arc_edges, arc_triangles):
+        self.hierarchy = hierarchy
+        self.compact_graph = hierarchy.compact_graph
+        self.arc_weights = arc_weights
+        self.arc_lengths = arc_lengths
+        self.arc_edges = arc_edges
+        self.arc_triangles = arc_triangles
+        self._up_weights = arc_weights[UP].tolist()
+        self._down_weights = arc_weights[DOWN].tolist()
+
+    def upward_search(self, node, direction):
+        """
+        Tìm kiếm đi lên theo cây khử từ node (UP: khoảng cách từ node, DOWN: khoảng cách tới node).
+        Không gian tìm kiếm chính là các tổ tiên của node nên duyệt theo thứ tự rank, không cần heap.
+        Trả về (dict nút -> khoảng cách, dict nút -> cung tiền nhiệm, danh sách tổ tiên theo thứ tự).
+        """
+        hierarchy = self.hierarchy
+        parent = hierarchy._parent_list
+        arc_indptr = hierarchy._arc_indptr_list
+        arc_heads = hierarchy._arc_heads_list
+        arc_weights = self._up_weights if direction == UP else self._down_weights
+        inf = float('inf')
+
+        dist = {node: 0.0}
+        pred_arc = {}
+        ancestors = []
+        x = node
+        while x != -1:
+            ancestors.append(x)
+            d = dist.get(x, inf)
+            if d < inf:
+                for a in range(arc_indptr[x], arc_indptr[x + 1]):
+                    v = arc_heads[a]
+                    nd = d + arc_weights[a]
+                    if nd < dist.get(v, inf):
+                        dist[v] = nd
+                        pred_arc[v] = a
+            x = parent[x]
+        return dist, pred_arc, ancestors
+
+    def upward_search_many(self, nodes, direction, with_lengths=False):
+        """
+        upward_search cho nhiều nút cùng lúc: duyệt mọi nút theo thứ tự rank, mỗi bước cập nhật
+        cả khối cột bằng numpy. Trả về ma trận khoảng cách (num_nodes × len(nodes), inf nếu không tới)
+        và ma trận chiều dài (mét) tương ứng nếu with_lengths=True.
+        """
+        hierarchy = self.hierarchy
+        arc_indptr = hierarchy._arc_indptr_list
+        arc_heads = hierarchy.arc_heads
+        arc_weights = self.arc_weights[direction]
+        arc_lengths = self.arc_lengths[direction]
+        nodes = np.asarray(nodes, dtype=np.int64)
+        columns = np.arange(nodes.size)
+        dist = np.full((hierarchy.rank.size, nodes.size), np.inf)
+        dist[nodes, columns] = 0.0
+        lengths = None
+        if with_lengths:
+            lengths = np.full(dist.shape, np.inf)
+            lengths[nodes, columns] = 0.0
+        reached = np.zeros(hierarchy.rank.size, dtype=bool)
+        reached[nodes] = True
+
+        lowest_rank = int(hierarchy.rank[nodes].min()) if nodes.size else hierarchy.rank.size
+        for x in hierarchy._order_list[lowest_rank:]:
+            if not reached[x]:
+                continue
+            a0, a1 = arc_indptr[x], arc_indptr[x + 1]
+            if a0 == a1:
+                continue
+            heads = arc_heads[a0:a1]
+            candidates = dist[x] + arc_weights[a0:a1, None]
+            current = dist[heads]
+            improved = candidates < current
+            dist[heads] = np.where(improved, candidates, current)
+            if with_lengths:
+                lengths[heads] = np.where(improved, lengths[x] + arc_lengths[a0:a1, None], lengths[heads])
+            reached[heads] = True
+        return dist, lengths
+
+    def shortest_path(self, source, target):
+        """
+        Truy vấn điểm - điểm: tìm kiếm đi lên từ source và target, gặp nhau ở tổ tiên chung.
+        Trả về (danh sách chỉ số nút, danh sách chỉ số cạnh gốc, tổng trọng số) như CompactGraph.shortest_path.
+        """
+        inf = float('inf')
+        if source == target:
+            return [source], [], 0.0
+        dist_forward, pred_forward, _ = self.upward_search(source, UP)
+        dist_backward, pred_backward, target_ancestors = self.upward_search(target, DOWN)
+        best_cost, meeting_node = inf, -1
+        for x in target_ancestors:
+            cost = dist_forward.get(x, inf) + dist_backward.get(x, inf)
+            if cost < best_cost:
+                best_cost, meeting_node = cost, x
+        if meeting_node < 0:
+            return None, None, inf
+        edge_path = self.unpack_arcs(self._arc_path(source, meeting_node, pred_forward, UP)
+                                     + self._arc_path(target, meeting_node, pred_backward, DOWN)[::-1])
+        node_path = [source] + [self.compact_graph._targets_list[e] for e in edge_path]
+        return node_path, edge_path, best_cost
+
+    def _arc_path(self, start, end, pred_arc, direction):
+        """Danh sách (cung, hướng) từ start đi lên tới end theo cung tiền nhiệm (thứ tự từ start)."""
+        arc_tails = self.hierarchy._arc_tails_list
+        arcs = []
+        node = end
+        while node != start:
+            a = pred_arc[node]
+            arcs.append((a, direction))
+            node = arc_tails[a]
+        arcs.reverse()
+        return arcs
+
+    def unpack_arcs(self, arcs):
+        """Bung danh sách (cung CH, hướng) thành danh sách cạnh gốc theo đúng thứ tự đi."""
+        hierarchy = self.hierarchy
+        edge_path = []
+        stack = list(reversed(arcs))
+        while stack:
+            a, direction = stack.pop()
+            t = self.arc_triangles[direction, a]
+            if t < 0:
+                edge_path.append(int(self.arc_edges[direction, a]))
+                continue
+            lower, upper = int(hierarchy.triangle_lower[t]), int(hierarchy.triangle_upper[t])
+            if direction == UP:
+                first, second = (lower, DOWN), (upper, UP) # p -> m -> q
+            else:
+                first, second = (upper, DOWN), (lower, UP) # q -> m -> p
+            stack.append(second)
+            stack.append(first)
+        return edge_path
+
+
+def save_contraction_hierarchy(hierarchy, path):
+    """Lưu phần tiền xử lý (không phụ thuộc trọng số) ra file .npz."""
+    arrays = {name: getattr(hierarchy, name) for name in HIERARCHY_ARRAY_NAMES}
+    tmp_path = f"{path}.tmp{os.getpid()}.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_or_build_contraction_hierarchy(compact_graph, cache_dir=GRAPH_CACHE_DIR):
+    """
+    Contraction hierarchy của compact_graph: tải từ cache trên đĩa (theo dấu vân tay đồ thị) nếu có,
+    nếu không thì dựng và lưu lại.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"contraction_hierarchy_{compact_graph.fingerprint()[:16]}.npz")
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            arrays = {name: data[name] for name in HIERARCHY_ARRAY_NAMES}
+        print(f"Đã tải contraction hierarchy từ cache: {cache_path}")
+        return ContractionHierarchy(compact_graph, **arrays)
+
+    hierarchy = ContractionHierarchy.build(compact_graph)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_contraction_hierarchy(hierarchy, cache_path)
+            print(f"Đã lưu contraction hierarchy vào cache: {cache_path}")
+        except OSError as e:
+            print(f"Cảnh báo: Không lưu được cache contraction hierarchy: {e}")
+    return hierarchy
+
+
+def calculate_eta_with_hierarchy(customized_hierarchy, origin_node, destination_node):
+    """
+    Tìm lộ trình nhanh nhất bằng contraction hierarchy đã customize cho lớp travel_time cần dùng.
+    Đầu vào/đầu ra dùng OSM node id. Trả về (route, eta_minutes, distance_m) như calculate_eta_on_compact_graph.
+    """
+    if customized_hierarchy is None or origin_node is None or destination_node is None:
+        print("Lỗi: Thiếu contraction hierarchy hoặc điểm đầu/cuối để tính ETA.")
+        return None, None, None
+    compact_graph = customized_hierarchy.compact_graph
+    source = compact_graph.node_index(origin_node)
+    target = compact_graph.node_index(destination_node)
+    if source is None or target is None:
+        print(f"LỖI: Nút xuất phát {origin_node} hoặc nút đích {destination_node} không tồn tại trong đồ thị.")
+        return None, None, None
+
+    node_path, edge_path, total_travel_time_seconds = customized_hierarchy.shortest_path(source, target)
+    if node_path is None:
+        print("Không tìm thấy lộ trình giữa hai điểm đã chọn.")
+        return None, None, None
+
+    eta_minutes = total_travel_time_seconds / 60
+    distance_m = float(compact_graph.lengths_m[edge_path].sum(dtype=np.float64))
+    print(f"Thời gian di chuyển dự kiến (ETA): {total_travel_time_seconds:.2f} giây ({eta_minutes:.2f} phút)")
+    return compact_graph.to_osm_ids(node_path), eta_minutes, distance_m
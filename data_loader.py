@@ -1,19 +1,101 @@
 # data_loader.py
+import os
+import re
+import glob
+import pickle
+import hashlib
 import pandas as pd
 import geopandas as gpd
 import osmnx as ox
-from config import PLACE_NAME, TAXI_ZONES_SHAPEFILE_PATH, YELLOW_TAXI_DATA_FILE
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from config import (
+    PLACE_NAME, TAXI_ZONES_SHAPEFILE_PATH, YELLOW_TAXI_DATA_FILE,
+    GRAPH_CACHE_DIR, ROAD_NETWORK_CACHE_VERSION, TRIP_DATA_BATCH_SIZE,
+    TRIP_DATA_MONTHS, MIN_TRIP_DISTANCE_MILES
+)
+from data_processor import initial_trip_data_cleaning
+
+# Các cột dữ liệu taxi mà pipeline thực sự dùng (đọc riêng các cột này thay vì cả file)
+TRIP_DATA_COLUMNS = [
+    'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'trip_distance', 'PULocationID', 'DOLocationID'
+]
+# Tháng của file dữ liệu lấy từ tên file, ví dụ yellow_tripdata_2025-01.parquet -> "2025-01"
+_TRIP_DATA_MONTH_PATTERN = re.compile(r'(\d{4})-(\d{2})\.parquet$')
+
+def get_road_network_cache_path(place_name=PLACE_NAME, network_type="drive", cache_dir=GRAPH_CACHE_DIR):
+    """Đường dẫn file đồ thị đã lưu, theo phiên bản định dạng, tên địa điểm và network_type."""
+    place_slug = re.sub(r'[^a-z0-9]+', '_', place_name.lower()).strip('_')[:40]
+    place_hash = hashlib.sha1(f"{place_name}|{network_type}".encode('utf-8')).hexdigest()[:10]
+    file_name = f"road_network_v{ROAD_NETWORK_CACHE_VERSION}_{place_slug}_{network_type}_{place_hash}.pickle"
+    return os.path.join(cache_dir, file_name)
+
+def _read_road_network_cache(cache_path, place_name, network_type):
+    """Đọc đồ thị từ file cache; trả về None nếu file không tồn tại, hỏng hoặc khác phiên bản."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            stored = pickle.load(f)
+    except Exception as e:
+        print(f"Cảnh báo: Không đọc được đồ thị đã lưu ({cache_path}): {e}")
+        return None
+    # File cũ (ví dụ đồ thị pickle trực tiếp, không bọc trong dict) cũng coi như không khớp
+    if (not isinstance(stored, dict) or 'graph' not in stored
+            or stored.get('version') != ROAD_NETWORK_CACHE_VERSION or stored.get('place_name') != place_name
+            or stored.get('network_type') != network_type):
+        print(f"Cảnh báo: Đồ thị đã lưu tại {cache_path} không khớp phiên bản/địa điểm, sẽ tải lại.")
+        return None
+    return stored['graph']
+
+def _write_road_network_cache(G, cache_path, place_name, network_type):
+    """Ghi đồ thị ra file cache (ghi vào file tạm rồi đổi tên để tránh file dở dang)."""
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        stored = {
+            'version': ROAD_NETWORK_CACHE_VERSION,
+            'place_name': place_name,
+            'network_type': network_type,
+            'osmnx_version': ox.__version__,
+            'graph': G,
+        }
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        print(f"Đã lưu đồ thị vào cache cục bộ: {cache_path}")
+    except Exception as e:
+        # Lỗi ghi file hoặc lỗi pickle (PicklingError, RecursionError...) không được làm hỏng lần tải vừa xong
+        print(f"Cảnh báo: Không lưu được đồ thị vào cache cục bộ: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def load_road_network(place_name=PLACE_NAME, network_type="drive", use_cache=True, cache_dir=GRAPH_CACHE_DIR):
+    """
+    Tải dữ liệu mạng lưới đường. Ưu tiên file đồ thị đã lưu cục bộ (không cần mạng),
+    chỉ tải từ OpenStreetMap khi chưa có cache hoặc use_cache=False.
+    """
+    cache_path = get_road_network_cache_path(place_name, network_type, cache_dir)
+    if use_cache:
+        G = _read_road_network_cache(cache_path, place_name, network_type)
+        if G is not None:
+            print(f"Đã tải mạng lưới đường cho {place_name} từ cache cục bộ: {cache_path}")
+            return G
 
-def load_road_network(place_name=PLACE_NAME, network_type="drive"):
-    """Tải dữ liệu mạng lưới đường từ OpenStreetMap."""
     print(f"Đang tải dữ liệu mạng lưới đường cho {place_name}...")
     try:
         G = ox.graph_from_place(place_name, network_type=network_type, retain_all=True)
         print("Tải dữ liệu mạng lưới đường hoàn tất!")
-        return G
     except Exception as e:
         print(f"Lỗi khi tải mạng lưới đường: {e}")
         return None
+    if use_cache:
+        _write_road_network_cache(G, cache_path, place_name, network_type)
+    return G
 
 def load_taxi_zones(shapefile_path=TAXI_ZONES_SHAPEFILE_PATH):
     """Tải dữ liệu shapefile của các Khu vực Taxi."""
@@ -31,11 +113,11 @@ def load_taxi_zones(shapefile_path=TAXI_ZONES_SHAPEFILE_PATH):
         print(f"Lỗi khi đọc Shapefile Khu vực Taxi: {e}")
         return None
 
-def load_taxi_trip_data(parquet_file_path=YELLOW_TAXI_DATA_FILE):
-    """Tải dữ liệu chuyến đi taxi từ file Parquet."""
+def load_taxi_trip_data(parquet_file_path=YELLOW_TAXI_DATA_FILE, columns=TRIP_DATA_COLUMNS):
+    """Tải dữ liệu chuyến đi taxi từ file Parquet (chỉ các cột trong columns; columns=None để đọc mọi cột)."""
     print(f"Đang đọc file dữ liệu taxi: {parquet_file_path}...")
     try:
-        df_taxi = pd.read_parquet(parquet_file_path)
+        df_taxi = pd.read_parquet(parquet_file_path, columns=columns)
         print("Đọc file dữ liệu taxi hoàn tất!")
         # Chuyển đổi cột thời gian cơ bản
         df_taxi['tpep_pickup_datetime'] = pd.to_datetime(df_taxi['tpep_pickup_datetime'])
@@ -48,6 +130,123 @@ def load_taxi_trip_data(parquet_file_path=YELLOW_TAXI_DATA_FILE):
         print(f"Lỗi khi đọc file dữ liệu taxi: {e}")
         return None
 
+def _trip_data_filter(location_ids):
+    """
+    Điều kiện lọc đẩy xuống tầng đọc Parquet: pyarrow bỏ qua cả row group theo thống kê min/max
+    và chỉ giải mã các dòng thoả điều kiện. Thời lượng chuyến được lọc khi làm sạch từng lô.
+    """
+    condition = ds.field('trip_distance') >= MIN_TRIP_DISTANCE_MILES
+    if location_ids:
+        location_ids = sorted({int(location_id) for location_id in location_ids})
+        condition = condition & ds.field('PULocationID').isin(location_ids) & ds.field('DOLocationID').isin(location_ids)
+    return condition
+
+def _iter_cleaned_batches(scanner):
+    for record_batch in scanner.to_batches():
+        if record_batch.num_rows == 0:
+            continue
+        df_batch = initial_trip_data_cleaning(record_batch.to_pandas(), verbose=False)
+        if not df_batch.empty:
+            yield df_batch
+
+def trip_data_month(file_path):
+    """Tháng "YYYY-MM" của file dữ liệu taxi theo tên file; None nếu tên file không có tháng."""
+    match = _TRIP_DATA_MONTH_PATTERN.search(os.path.basename(file_path))
+    return f"{match.group(1)}-{match.group(2)}" if match else None
+
+def resolve_trip_data_files(trip_data_path=YELLOW_TAXI_DATA_FILE, months=TRIP_DATA_MONTHS):
+    """
+    Danh sách file Parquet (đã sắp xếp) từ một file, một thư mục hoặc một glob.
+    months=(tháng đầu, tháng cuối) dạng "YYYY-MM" (tính cả hai đầu): bỏ qua các file ngoài khoảng ngay
+    từ tên file, không cần mở file; khi đó file không có tháng trong tên cũng bị bỏ qua.
+    """
+    if os.path.isdir(trip_data_path):
+        file_paths = glob.glob(os.path.join(trip_data_path, '*.parquet'))
+    elif glob.has_magic(trip_data_path):
+        file_paths = glob.glob(trip_data_path)
+    else:
+        file_paths = [trip_data_path] if os.path.exists(trip_data_path) else []
+    if months is not None:
+        first_month, last_month = months
+        file_paths = [
+            file_path for file_path in file_paths
+            if trip_data_month(file_path) is not None and first_month <= trip_data_month(file_path) <= last_month
+        ]
+    return sorted(file_paths)
+
+def iter_taxi_trip_batches(trip_data_path=YELLOW_TAXI_DATA_FILE, location_ids=None, batch_size=TRIP_DATA_BATCH_SIZE,
+                           months=TRIP_DATA_MONTHS):
+    """
+    Đọc dữ liệu taxi theo luồng: chỉ các cột TRIP_DATA_COLUMNS, theo từng lô (tối đa batch_size dòng),
+    lọc quãng đường và LocationID (điểm đón VÀ trả thuộc location_ids, nếu có) ngay khi đọc.
+    trip_data_path có thể là file, thư mục hoặc glob; mọi file (sau khi lọc theo months) được quét như một dataset.
+    Trả về generator các DataFrame đã làm sạch như initial_trip_data_cleaning (lô rỗng bị bỏ qua),
+    hoặc None nếu không có file nào để đọc.
+    """
+    file_paths = resolve_trip_data_files(trip_data_path, months)
+    if not file_paths:
+        print(f"LỖI: Không tìm thấy file taxi nào tại {trip_data_path}" + (f" trong các tháng {months}." if months else "."))
+        return None
+    print(f"Sẽ đọc {len(file_paths)} file dữ liệu taxi: {', '.join(os.path.basename(p) for p in file_paths[:3])}"
+          + (" ..." if len(file_paths) > 3 else ""))
+    try:
+        dataset = ds.dataset(file_paths, format='parquet')
+        scanner = dataset.scanner(
+            columns=TRIP_DATA_COLUMNS, filter=_trip_data_filter(location_ids), batch_size=batch_size
+        )
+    except Exception as e:
+        print(f"Lỗi khi mở file dữ liệu taxi: {e}")
+        return None
+    return _iter_cleaned_batches(scanner)
+
+def trip_data_row_group_counts(file_paths):
+    """Số row group của từng file Parquet (chỉ đọc metadata); file không đọc được bị bỏ qua kèm cảnh báo."""
+    row_group_counts = {}
+    for file_path in file_paths:
+        try:
+            row_group_counts[file_path] = pq.read_metadata(file_path).num_row_groups
+        except Exception as e:
+            print(f"Cảnh báo: Không đọc được metadata của file taxi {file_path}: {e}")
+    return row_group_counts
+
+def iter_row_group_batches(file_path, row_groups, location_ids=None, batch_size=TRIP_DATA_BATCH_SIZE):
+    """
+    Như iter_taxi_trip_batches nhưng chỉ đọc các row group row_groups của một file (một phần việc khi
+    chuẩn bị dữ liệu song song). Trả về generator các DataFrame đã làm sạch; lỗi đọc file được ném ra.
+    """
+    dataset = ds.dataset(file_path, format='parquet')
+    fragment = next(iter(dataset.get_fragments())).subset(row_group_ids=list(row_groups))
+    scanner = ds.Scanner.from_fragment(
+        fragment, schema=dataset.schema, columns=TRIP_DATA_COLUMNS,
+        filter=_trip_data_filter(location_ids), batch_size=batch_size
+    )
+    return _iter_cleaned_batches(scanner)
+
+def load_clean_taxi_trips(trip_data_path=YELLOW_TAXI_DATA_FILE, location_ids=None, batch_size=TRIP_DATA_BATCH_SIZE,
+                          months=TRIP_DATA_MONTHS):
+    """
+    Đọc theo luồng (iter_taxi_trip_batches) rồi ghép các lô đã làm sạch và lọc LocationID thành một DataFrame.
+    Chỉ các chuyến hợp lệ được giữ lại trong bộ nhớ (với nhiều tháng, nên dùng speed_aggregates để gộp dần).
+    Trả về None nếu không đọc được file.
+    """
+    print(f"Đang đọc dữ liệu taxi theo lô: {trip_data_path}...")
+    batches = iter_taxi_trip_batches(trip_data_path, location_ids, batch_size, months)
+    if batches is None:
+        return None
+    try:
+        cleaned_batches = list(batches)
+    except Exception as e:
+        print(f"Lỗi khi đọc file dữ liệu taxi: {e}")
+        return None
+    if not cleaned_batches:
+        print("Cảnh báo: Không có chuyến đi nào hợp lệ trong dữ liệu taxi.")
+        return pd.DataFrame(columns=TRIP_DATA_COLUMNS + [
+            'trip_duration_seconds', 'trip_duration_minutes', 'average_speed_mph', 'pickup_hour', 'pickup_day_of_week'
+        ])
+    df_trips = pd.concat(cleaned_batches, ignore_index=True)
+    print(f"Số chuyến đi sau khi lọc và làm sạch: {len(df_trips)}")
+    return df_trips
+
 if __name__ == '__main__':
     # Chạy thử các hàm load (chỉ khi chạy trực tiếp file này)
     G_test = load_road_network()
@@ -1,4 +1,5 @@
 # data_processor.py
+import numpy as np
 import pandas as pd
 from config import (
     TARGET_BOROUGH, MIN_TRIP_DURATION_MINUTES, MAX_TRIP_DURATION_MINUTES,
@@ -14,62 +15,90 @@ def filter_taxi_zones_by_borough(taxi_zones_gdf, borough_name=TARGET_BOROUGH):
     print(f"Số lượng khu vực taxi ở {borough_name}: {len(manhattan_zones)}")
     return manhattan_zones, manhattan_location_ids
 
-def initial_trip_data_cleaning(df_taxi):
-    """Làm sạch dữ liệu chuyến đi ban đầu và tính toán thời gian/tốc độ."""
+# Kiểu dữ liệu gọn cho các cột dẫn xuất (LocationID của TLC nằm trong 1..265)
+LOCATION_ID_DTYPE = np.int16
+SPEED_DTYPE = np.float32
+TIME_PART_DTYPE = np.int8
+_NANOSECONDS_PER_SECOND = 1_000_000_000
+
+def _datetime_values(series):
+    """Mảng datetime64[ns] của một cột thời gian (chỉ phân tích lại khi cột chưa ở dạng datetime)."""
+    if not pd.api.types.is_datetime64_any_dtype(series):
+        series = pd.to_datetime(series)
+    return series.to_numpy(dtype='datetime64[ns]')
+
+def initial_trip_data_cleaning(df_taxi, verbose=True):
+    """
+    Làm sạch dữ liệu chuyến đi ban đầu và tính toán thời gian/tốc độ (verbose=False: không in số chuyến,
+    dùng khi làm sạch theo từng lô). Mọi cột dẫn xuất và một mặt nạ lọc chung được tính một lượt bằng numpy
+    trên các mảng của df_taxi; chỉ các dòng hợp lệ được sao chép vào DataFrame kết quả, với kiểu gọn:
+    LocationID int16, thời lượng/tốc độ float32, pickup_hour/pickup_day_of_week int8.
+    """
     if df_taxi is None:
         return None
-    
-    df_cleaned = df_taxi.copy()
-    df_cleaned['trip_duration_seconds'] = \
-        (df_cleaned['tpep_dropoff_datetime'] - df_cleaned['tpep_pickup_datetime']).dt.total_seconds()
-    df_cleaned['trip_duration_minutes'] = df_cleaned['trip_duration_seconds'] / 60
-
-    # Lọc cơ bản
-    df_filtered = df_cleaned[
-        (df_cleaned['trip_duration_minutes'] >= MIN_TRIP_DURATION_MINUTES) &
-        (df_cleaned['trip_duration_minutes'] <= MAX_TRIP_DURATION_MINUTES) &
-        (df_cleaned['trip_distance'] >= MIN_TRIP_DISTANCE_MILES)
-    ].copy() # Sử dụng .copy()
-
-    # Tính tốc độ trung bình (mph)
-    # Đảm bảo trip_duration_seconds > 0 để tránh chia cho 0
-    valid_duration_mask = df_filtered['trip_duration_seconds'] > 0
-    df_filtered.loc[valid_duration_mask, 'average_speed_mph'] = \
-        df_filtered.loc[valid_duration_mask, 'trip_distance'] / \
-        (df_filtered.loc[valid_duration_mask, 'trip_duration_seconds'] / 3600)
-    
-    # Lọc tốc độ bất thường
-    if 'average_speed_mph' in df_filtered.columns:
-        df_filtered = df_filtered[
-            (df_filtered['average_speed_mph'] >= MIN_AVG_SPEED_MPH) &
-            (df_filtered['average_speed_mph'] <= MAX_AVG_SPEED_MPH)
-        ]
-    else: # Nếu không có chuyến nào thỏa mãn để tính average_speed_mph
-        print("Cảnh báo: Không có chuyến đi nào đủ điều kiện để tính average_speed_mph sau lọc cơ bản.")
-        # Tạo cột với giá trị NaN để tránh lỗi sau này nếu df_filtered không rỗng
-        if not df_filtered.empty:
-             df_filtered['average_speed_mph'] = pd.NA
-
-
-    print(f"Số chuyến đi sau khi lọc cơ bản và lọc tốc độ: {len(df_filtered)}")
+
+    pickup_times = _datetime_values(df_taxi['tpep_pickup_datetime'])
+    dropoff_times = _datetime_values(df_taxi['tpep_dropoff_datetime'])
+    pickup_ns, dropoff_ns = pickup_times.view(np.int64), dropoff_times.view(np.int64)
+    trip_distance = df_taxi['trip_distance'].to_numpy(dtype=np.float64, na_value=np.nan)
+    pickup_location_ids = df_taxi['PULocationID'].to_numpy(dtype=np.float64, na_value=np.nan)
+    dropoff_location_ids = df_taxi['DOLocationID'].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    # NaT (int64 nhỏ nhất) cho thời lượng âm/khổng lồ nên tự bị loại bởi điều kiện thời lượng
+    duration_seconds = (dropoff_ns - pickup_ns) / _NANOSECONDS_PER_SECOND
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_speed_mph = trip_distance / (duration_seconds / 3600)
+
+    # Lọc cơ bản, lọc tốc độ bất thường và bỏ dòng thiếu LocationID trong một mặt nạ
+    keep = (
+        (duration_seconds >= MIN_TRIP_DURATION_MINUTES * 60) &
+        (duration_seconds <= MAX_TRIP_DURATION_MINUTES * 60) &
+        (duration_seconds > 0) &
+        (trip_distance >= MIN_TRIP_DISTANCE_MILES) &
+        (average_speed_mph >= MIN_AVG_SPEED_MPH) &
+        (average_speed_mph <= MAX_AVG_SPEED_MPH) &
+        np.isfinite(pickup_location_ids) &
+        np.isfinite(dropoff_location_ids)
+    )
+    rows = np.flatnonzero(keep)
+
+    derived_columns = {
+        'tpep_pickup_datetime': pickup_times[rows],
+        'tpep_dropoff_datetime': dropoff_times[rows],
+        'trip_distance': trip_distance[rows],
+        'PULocationID': pickup_location_ids[rows].astype(LOCATION_ID_DTYPE),
+        'DOLocationID': dropoff_location_ids[rows].astype(LOCATION_ID_DTYPE),
+        'trip_duration_seconds': duration_seconds[rows].astype(SPEED_DTYPE),
+        'trip_duration_minutes': (duration_seconds[rows] / 60).astype(SPEED_DTYPE),
+        'average_speed_mph': average_speed_mph[rows].astype(SPEED_DTYPE),
+        'pickup_hour': ((pickup_ns[rows] // (3600 * _NANOSECONDS_PER_SECOND)) % 24).astype(TIME_PART_DTYPE),
+        # 1970-01-01 là Thứ Năm (3 khi Monday=0)
+        'pickup_day_of_week': ((pickup_ns[rows] // (86400 * _NANOSECONDS_PER_SECOND) + 3) % 7).astype(TIME_PART_DTYPE),
+    }
+    # Giữ thứ tự cột gốc; các cột khác (nếu đọc cả file) chỉ lấy các dòng hợp lệ, cột dẫn xuất mới thêm vào cuối
+    columns = {
+        column: derived_columns.pop(column) if column in derived_columns else df_taxi[column].array.take(rows)
+        for column in df_taxi.columns
+    }
+    columns.update(derived_columns)
+    df_filtered = pd.DataFrame(columns, index=df_taxi.index[rows])
+
+    if verbose:
+        print(f"Số chuyến đi sau khi lọc cơ bản và lọc tốc độ: {len(df_filtered)}")
     return df_filtered
 
 def filter_trips_by_location_ids(df_taxi_filtered, location_ids):
     """Lọc các chuyến đi có điểm đón VÀ trả trong danh sách LocationID đã cho."""
     if df_taxi_filtered is None or not location_ids:
         return pd.DataFrame() # Trả về DataFrame rỗng nếu đầu vào không hợp lệ
-        
-    # Đảm bảo kiểu dữ liệu của ID là int để khớp
-    df_filtered = df_taxi_filtered.copy()
-    if 'PULocationID' in df_filtered.columns:
-        df_filtered['PULocationID'] = df_filtered['PULocationID'].astype(int)
-    if 'DOLocationID' in df_filtered.columns:
-        df_filtered['DOLocationID'] = df_filtered['DOLocationID'].astype(int)
-
-    df_borough_trips = df_filtered[
-        df_filtered['PULocationID'].isin(location_ids) &
-        df_filtered['DOLocationID'].isin(location_ids)
-    ]
+
+    # So khớp trực tiếp trên mảng ID (không cần ép kiểu/sao chép cả DataFrame), chỉ sao chép các dòng được giữ
+    location_ids = np.asarray(list(location_ids), dtype=np.int64)
+    in_borough = (
+        np.isin(df_taxi_filtered['PULocationID'].to_numpy(), location_ids) &
+        np.isin(df_taxi_filtered['DOLocationID'].to_numpy(), location_ids)
+    )
+    df_borough_trips = df_taxi_filtered[in_borough]
     print(f"Số chuyến đi hoàn toàn trong các khu vực đã chọn: {len(df_borough_trips)}")
     return df_borough_trips
 
@@ -79,12 +108,15 @@ def calculate_median_speed_by_time(df_borough_trips):
         print("Cảnh báo: Không có dữ liệu chuyến đi của quận hoặc thiếu cột 'average_speed_mph' để tính tốc độ trung vị.")
         return pd.Series(dtype='float64'), pd.Series(dtype='float64')
 
-    df_analysis = df_borough_trips.copy()
-    df_analysis['pickup_hour'] = df_analysis['tpep_pickup_datetime'].dt.hour
-    df_analysis['pickup_day_of_week'] = df_analysis['tpep_pickup_datetime'].dt.dayofweek # Monday=0, Sunday=6
+    # initial_trip_data_cleaning đã tính sẵn pickup_hour/pickup_day_of_week
+    pickup_hours = df_borough_trips['pickup_hour'] if 'pickup_hour' in df_borough_trips.columns \
+        else df_borough_trips['tpep_pickup_datetime'].dt.hour
+    pickup_days = df_borough_trips['pickup_day_of_week'] if 'pickup_day_of_week' in df_borough_trips.columns \
+        else df_borough_trips['tpep_pickup_datetime'].dt.dayofweek # Monday=0, Sunday=6
+    speeds = df_borough_trips['average_speed_mph'].astype('float64')
 
-    median_speed_by_hour = df_analysis.groupby('pickup_hour')['average_speed_mph'].median()
-    median_speed_by_day_of_week = df_analysis.groupby('pickup_day_of_week')['average_speed_mph'].median()
+    median_speed_by_hour = speeds.groupby(pickup_hours.rename('pickup_hour')).median()
+    median_speed_by_day_of_week = speeds.groupby(pickup_days.rename('pickup_day_of_week')).median()
     
     # Đổi tên index cho ngày trong tuần
     days = ['Thứ Hai', 'Thứ Ba', 'Thứ Tư', 'Thứ Năm', 'Thứ Sáu', 'Thứ Bảy', 'Chủ Nhật']
@@ -0,0 +1,110 @@
+# edge_zones.py
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import osmnx as ox
+from config import GRAPH_CACHE_DIR
+
+# Chọn một Projected CRS phù hợp cho NYC (ví dụ: UTM Zone 18N, đơn vị mét)
+PROJECTED_CRS = "EPSG:32618"
+NO_ZONE_ID = -1 # Giá trị cho các cạnh không nằm trong khu vực taxi nào
+
+# Cache trong bộ nhớ: (dấu vân tay đồ thị, dấu vân tay shapefile) -> mảng LocationID theo thứ tự G.edges
+_edge_location_ids_cache = {}
+
+
+def graph_edges_fingerprint(G):
+    """Dấu vân tay (sha1) của danh sách cạnh (u, v, key) theo đúng thứ tự G.edges."""
+    edge_keys = np.array(list(G.edges(keys=True)), dtype=np.int64).reshape(-1, 3)
+    return hashlib.sha1(edge_keys.tobytes()).hexdigest()
+
+
+def taxi_zones_fingerprint(taxi_zones_gdf):
+    """Dấu vân tay (sha1) của LocationID, hình học và CRS của các khu vực taxi."""
+    hasher = hashlib.sha1()
+    hasher.update(str(taxi_zones_gdf.crs).encode())
+    hasher.update(taxi_zones_gdf['LocationID'].to_numpy(dtype=np.int64).tobytes())
+    for geometry_wkb in taxi_zones_gdf.geometry.to_wkb():
+        hasher.update(geometry_wkb)
+    return hasher.hexdigest()
+
+
+def compute_edge_location_ids(G, taxi_zones_gdf_input):
+    """
+    Gán LocationID cho từng cạnh dựa trên centroid của cạnh (spatial join trên CRS đã chiếu).
+    Trả về mảng int16 theo thứ tự G.edges, NO_ZONE_ID cho các cạnh không thuộc khu vực nào.
+    """
+    # Lấy GeoDataFrame của các cạnh từ đồ thị G
+    # G.graph['crs'] thường là EPSG:4326 (WGS84 Geographic)
+    current_graph_crs = G.graph.get('crs')
+    if current_graph_crs is None:
+        print("Cảnh báo: Đồ thị G không có thông tin CRS. Giả định là EPSG:4326.")
+        current_graph_crs = "EPSG:4326"
+
+    # Chuyển đổi G sang GeoDataFrames cho các cạnh
+    # Quan trọng: không lấy nodes ở đây để tránh thay đổi G.graph['crs'] nếu G được chiếu
+    gdf_edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
+    gdf_edges = gdf_edges.set_crs(current_graph_crs, allow_override=True) # Đảm bảo gdf_edges có CRS
+
+    # Reproject gdf_edges và taxi_zones_gdf_input sang PROJECTED_CRS
+    print(f"Đang reproject dữ liệu sang CRS: {PROJECTED_CRS}...")
+    gdf_edges_proj = gdf_edges[['geometry']].to_crs(PROJECTED_CRS)
+    taxi_zones_gdf_proj = taxi_zones_gdf_input.to_crs(PROJECTED_CRS)
+    print("Reproject hoàn tất.")
+
+    # Tính tâm điểm (centroid) trên dữ liệu đã reproject -> sẽ chính xác hơn
+    edges_centroids_gdf_proj = gpd.GeoDataFrame(
+        geometry=gdf_edges_proj.geometry.centroid,
+        crs=PROJECTED_CRS
+    )
+
+    # Spatial Join, chỉ lấy các cột cần thiết từ taxi_zones_gdf_proj
+    zones_to_join_proj = taxi_zones_gdf_proj[['LocationID', 'geometry']]
+    print("Đang thực hiện spatial join giữa các cạnh và khu vực taxi...")
+    edges_with_zones_info = gpd.sjoin(
+        edges_centroids_gdf_proj,
+        zones_to_join_proj,
+        how='left',
+        predicate='within'
+    )
+    print("Spatial join hoàn tất.")
+
+    # sjoin có thể trả về nhiều dòng nếu centroid nằm trên biên giới của nhiều zone (hiếm) -> giữ dòng đầu tiên
+    edge_keys = pd.MultiIndex.from_tuples(list(G.edges(keys=True)), names=['u', 'v', 'key'])
+    location_id_by_edge = edges_with_zones_info['LocationID']
+    location_id_by_edge = location_id_by_edge[~location_id_by_edge.index.duplicated(keep='first')]
+    edge_location_ids = location_id_by_edge.reindex(edge_keys).to_numpy(dtype=float, na_value=np.nan)
+    return np.where(np.isnan(edge_location_ids), NO_ZONE_ID, edge_location_ids).astype(np.int16)
+
+
+def get_edge_location_ids(G, taxi_zones_gdf_input, cache_dir=GRAPH_CACHE_DIR):
+    """
+    Lấy mảng LocationID của các cạnh (theo thứ tự G.edges), chỉ tính spatial join một lần
+    cho mỗi cặp đồ thị/shapefile: ưu tiên cache trong bộ nhớ, sau đó là file .npy trên đĩa.
+    """
+    cache_key = (graph_edges_fingerprint(G), taxi_zones_fingerprint(taxi_zones_gdf_input))
+    edge_location_ids = _edge_location_ids_cache.get(cache_key)
+    if edge_location_ids is not None:
+        return edge_location_ids
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"edge_zones_{cache_key[0][:16]}_{cache_key[1][:16]}.npy")
+    if cache_path and os.path.exists(cache_path):
+        edge_location_ids = np.load(cache_path)
+        print(f"Đã tải ánh xạ cạnh -> LocationID từ cache: {cache_path}")
+    else:
+        edge_location_ids = compute_edge_location_ids(G, taxi_zones_gdf_input)
+        if cache_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.save(cache_path, edge_location_ids)
+                print(f"Đã lưu ánh xạ cạnh -> LocationID vào cache: {cache_path}")
+            except OSError as e:
+                print(f"Cảnh báo: Không lưu được cache ánh xạ cạnh -> LocationID: {e}")
+
+    edge_location_ids.flags.writeable = False # Dùng chung giữa các lần gọi, không cho phép sửa
+    _edge_location_ids_cache[cache_key] = edge_location_ids
+    return edge_location_ids
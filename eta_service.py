@@ -0,0 +1,167 @@
+# eta_service.py
+import threading
+from collections import OrderedDict
+import numpy as np
+import shapely
+from shapely.geometry import MultiPoint
+from contraction_hierarchy import UP, DOWN
+
+# Số điểm xuất phát/điểm đến xử lý mỗi lượt trong ma trận many-to-many (giới hạn bộ nhớ ma trận trung gian)
+SEARCH_BLOCK_SIZE = 256
+
+
+class EtaService:
+    """
+    Dịch vụ ETA dùng chung cho nhiều truy vấn trên một bộ lớp travel_time (TravelTimeLayers).
+    Nếu có contraction hierarchy thì giữ sẵn các bản customize gần nhất theo (giờ, ngày),
+    nếu không thì dùng Dijkstra trên CompactGraph.
+    """
+
+    def __init__(self, travel_time_layers, hierarchy=None, max_customized=24):
+        self.travel_time_layers = travel_time_layers
+        self.compact_graph = travel_time_layers.compact_graph
+        self.hierarchy = hierarchy
+        self.max_customized = max_customized
+        self._customized = OrderedDict()
+        self._lock = threading.Lock()
+
+    def customized_hierarchy(self, target_hour, target_day_numeric):
+        """CH đã customize cho lớp (giờ, ngày); giữ tối đa max_customized bản gần nhất."""
+        key = (int(target_hour), int(target_day_numeric))
+        with self._lock:
+            customized = self._customized.get(key)
+            if customized is not None:
+                self._customized.move_to_end(key)
+                return customized
+        customized = self.hierarchy.customize(self.travel_time_layers.get(*key))
+        with self._lock:
+            self._customized[key] = customized
+            while len(self._customized) > self.max_customized:
+                self._customized.popitem(last=False)
+        return customized
+
+    def _node_indices(self, osm_node_ids, label):
+        """Chỉ số nút cho danh sách OSM node id; -1 (kèm cảnh báo) cho id không có trong đồ thị."""
+        indices = [self.compact_graph.node_index(node_id) for node_id in osm_node_ids]
+        missing = [node_id for node_id, index in zip(osm_node_ids, indices) if index is None]
+        if missing:
+            print(f"Cảnh báo: {len(missing)} {label} không có trong đồ thị (ví dụ: {missing[:5]}), ETA sẽ là NaN.")
+        return [-1 if index is None else index for index in indices]
+
+    def eta_matrix(self, origins, destinations, target_hour, target_day_numeric, return_distances=False):
+        """
+        Ma trận ETA (giây, float64, kích thước len(origins) × len(destinations)) giữa các OSM node id.
+        inf nếu không có lộ trình, NaN nếu node id không có trong đồ thị.
+        Với return_distances=True trả về thêm ma trận chiều dài (mét) của các lộ trình nhanh nhất.
+        """
+        origin_indices = self._node_indices(list(origins), "điểm xuất phát")
+        destination_indices = self._node_indices(list(destinations), "điểm đến")
+        eta_seconds = np.full((len(origin_indices), len(destination_indices)), np.inf)
+        distances_m = np.full(eta_seconds.shape, np.inf) if return_distances else None
+
+        if self.hierarchy is not None:
+            self._fill_matrix_with_hierarchy(
+                self.customized_hierarchy(target_hour, target_day_numeric),
+                origin_indices, destination_indices, eta_seconds, distances_m
+            )
+        else:
+            self._fill_matrix_with_dijkstra(
+                self.travel_time_layers.get(target_hour, target_day_numeric),
+                origin_indices, destination_indices, eta_seconds, distances_m
+            )
+
+        missing_origins = np.asarray(origin_indices) < 0
+        missing_destinations = np.asarray(destination_indices) < 0
+        for matrix in (eta_seconds, distances_m):
+            if matrix is not None:
+                matrix[missing_origins, :] = np.nan
+                matrix[:, missing_destinations] = np.nan
+        if return_distances:
+            return eta_seconds, distances_m
+        return eta_seconds
+
+    def isochrones(self, origin_lat, origin_lon, target_hour, target_day_numeric, budgets_seconds, concave_ratio=None):
+        """
+        Vùng có thể tới được từ toạ độ xuất phát trong từng ngân sách thời gian (giây), chỉ với một lần
+        Dijkstra giới hạn ở ngân sách lớn nhất. Mỗi phần tử kết quả (theo thứ tự budgets_seconds) gồm:
+        'budget_seconds', 'node_ids' (OSM id), 'edges' ((u, v) OSM id của cạnh đi hết được trong ngân sách),
+        'edge_indices' (chỉ số cạnh CSR) và 'polygon' (bao lồi của các nút, toạ độ lon/lat;
+        bao lõm nếu truyền concave_ratio trong (0, 1]; None nếu ít hơn 3 nút).
+        """
+        budgets_seconds = [float(budget) for budget in budgets_seconds]
+        if not budgets_seconds:
+            return []
+        compact_graph = self.compact_graph
+        source = compact_graph.node_index(compact_graph.nearest_node(origin_lat, origin_lon))
+        travel_times = self.travel_time_layers.get(target_hour, target_day_numeric)
+        dist, _, _ = compact_graph.shortest_path_tree(source, travel_times, max_cost=max(budgets_seconds))
+        dist = np.asarray(dist)
+        edge_arrival = dist[compact_graph.edge_sources] + np.asarray(travel_times, dtype=np.float64)
+
+        results = []
+        for budget in budgets_seconds:
+            reachable_nodes = np.flatnonzero(dist <= budget)
+            reachable_edges = np.flatnonzero(edge_arrival <= budget)
+            polygon = None
+            if reachable_nodes.size >= 3:
+                points = MultiPoint(np.column_stack((compact_graph.node_x[reachable_nodes], compact_graph.node_y[reachable_nodes])))
+                polygon = points.convex_hull if concave_ratio is None else shapely.concave_hull(points, ratio=concave_ratio)
+            results.append({
+                'budget_seconds': budget,
+                'node_ids': compact_graph.to_osm_ids(reachable_nodes),
+                'edges': list(zip(compact_graph.to_osm_ids(compact_graph.edge_sources[reachable_edges]),
+                                  compact_graph.to_osm_ids(compact_graph.edge_targets[reachable_edges]))),
+                'edge_indices': reachable_edges,
+                'polygon': polygon,
+            })
+        print(f"Đã tính {len(results)} vùng đẳng thời (isochrone) từ ({origin_lat}, {origin_lon}).")
+        return results
+
+    def _fill_matrix_with_dijkstra(self, travel_times, origin_indices, destination_indices, eta_seconds, distances_m):
+        """Mỗi điểm xuất phát một lần Dijkstra một-tới-nhiều, dừng khi đã chốt mọi điểm đến."""
+        valid_columns = [j for j, index in enumerate(destination_indices) if index >= 0]
+        valid_destinations = [destination_indices[j] for j in valid_columns]
+        for i, source in enumerate(origin_indices):
+            if source < 0 or not valid_destinations:
+                continue
+            dist, _, length_m = self.compact_graph.shortest_path_tree(source, travel_times, targets=valid_destinations)
+            eta_seconds[i, valid_columns] = [dist[t] for t in valid_destinations]
+            if distances_m is not None:
+                distances_m[i, valid_columns] = [length_m[t] for t in valid_destinations]
+
+    def _fill_matrix_with_hierarchy(self, customized, origin_indices, destination_indices, eta_seconds, distances_m):
+        """
+        Many-to-many trên CH kiểu bucket: tìm kiếm đi lên (ngược) từ cả khối điểm đến cho ma trận
+        nút × điểm đến (vai trò các bucket), mỗi điểm xuất phát chỉ cần lấy min theo cột trên các nút
+        thuộc không gian tìm kiếm đi lên của nó.
+        """
+        with_lengths = distances_m is not None
+        valid_rows = [i for i, index in enumerate(origin_indices) if index >= 0]
+        valid_columns = [j for j, index in enumerate(destination_indices) if index >= 0]
+
+        # Không gian tìm kiếm đi lên (thưa, vài trăm nút) của từng điểm xuất phát
+        forward_spaces = []
+        for block_start in range(0, len(valid_rows), SEARCH_BLOCK_SIZE):
+            block_rows = valid_rows[block_start:block_start + SEARCH_BLOCK_SIZE]
+            forward_dist, forward_lengths = customized.upward_search_many(
+                [origin_indices[i] for i in block_rows], UP, with_lengths=with_lengths
+            )
+            for k in range(len(block_rows)):
+                space = np.flatnonzero(np.isfinite(forward_dist[:, k]))
+                forward_spaces.append((space, forward_dist[space, k],
+                                       forward_lengths[space, k] if with_lengths else None))
+
+        for block_start in range(0, len(valid_columns), SEARCH_BLOCK_SIZE):
+            block_columns = valid_columns[block_start:block_start + SEARCH_BLOCK_SIZE]
+            column_range = np.arange(len(block_columns))
+            backward_dist, backward_lengths = customized.upward_search_many(
+                [destination_indices[j] for j in block_columns], DOWN, with_lengths=with_lengths
+            )
+            for i, (space, space_dist, space_lengths) in zip(valid_rows, forward_spaces):
+                candidates = backward_dist[space] + space_dist[:, None]
+                best = np.argmin(candidates, axis=0)
+                block_eta = candidates[best, column_range]
+                eta_seconds[i, block_columns] = block_eta
+                if with_lengths:
+                    block_lengths = space_lengths[best] + backward_lengths[space[best], column_range]
+                    distances_m[i, block_columns] = np.where(np.isfinite(block_eta), block_lengths, np.inf)
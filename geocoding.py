@@ -0,0 +1,303 @@
+# geocoding.py
+import os
+import re
+import time
+import sqlite3
+import difflib
+import threading
+from contextlib import closing
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import requests
+import osmnx as ox
+from scipy.spatial import cKDTree
+from config import (
+    PLACE_NAME,
+    GEOCODE_CACHE_PATH,
+    GEOCODE_LRU_SIZE,
+    GAZETTEER_PATH,
+    GEOCODING_OFFLINE
+)
+
+REVERSE_GEOCODE_DECIMALS = 5 # Làm tròn toạ độ (~1 m) khi dùng làm khóa cache cho reverse geocode
+GAZETTEER_MATCH_CUTOFF = 0.85 # Độ giống tối thiểu khi tra gần đúng trong gazetteer
+GAZETTEER_REVERSE_MAX_DISTANCE_M = 150 # Reverse geocode offline: chỉ nhận địa điểm trong bán kính này
+NOMINATIM_MIN_INTERVAL_SECONDS = 1.0 # Chính sách sử dụng Nominatim: tối đa 1 yêu cầu mỗi giây
+# Phần đuôi chung của địa chỉ ở Manhattan, bỏ đi khi chuẩn hoá để "Times Square" và
+# "Times Square, New York, NY" trùng khóa
+_LOCALITY_SUFFIX_PATTERN = re.compile(
+    r"(,\s*(manhattan|new york city|new york county|new york|nyc|ny|usa|united states)?\s*(\d{5}(-\d{4})?)?)+$"
+)
+
+_memory_cache = OrderedDict() # Tầng LRU trong bộ nhớ: khóa -> kết quả
+_memory_cache_lock = threading.Lock()
+_nominatim_lock = threading.Lock()
+_last_nominatim_request = 0.0
+_gazetteer = None
+
+
+def normalize_query(query):
+    """Chuẩn hoá chuỗi địa chỉ để làm khóa cache/tra gazetteer (chữ thường, bỏ khoảng trắng thừa và đuôi thành phố)."""
+    normalized = re.sub(r"\s+", " ", str(query).strip().lower())
+    normalized = re.sub(r"\s*,\s*", ", ", normalized)
+    return _LOCALITY_SUFFIX_PATTERN.sub("", normalized).strip(" ,")
+
+
+def _reverse_key(lat, lon):
+    return f"reverse:{round(float(lat), REVERSE_GEOCODE_DECIMALS)},{round(float(lon), REVERSE_GEOCODE_DECIMALS)}"
+
+
+def _memory_get(key):
+    with _memory_cache_lock:
+        value = _memory_cache.get(key)
+        if value is not None:
+            _memory_cache.move_to_end(key)
+        return value
+
+
+def _memory_put(key, value):
+    with _memory_cache_lock:
+        _memory_cache[key] = value
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > GEOCODE_LRU_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _connect_disk_cache(cache_path):
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=10)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_cache (query_key TEXT PRIMARY KEY, lat REAL, lon REAL, address TEXT)"
+    )
+    return connection
+
+
+def _disk_get(key, cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+    try:
+        with closing(_connect_disk_cache(cache_path)) as connection:
+            return connection.execute(
+                "SELECT lat, lon, address FROM geocode_cache WHERE query_key = ?", (key,)
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Cảnh báo: Không đọc được cache geocoding '{cache_path}': {e}")
+        return None
+
+
+def _disk_put(key, lat, lon, address, cache_path):
+    if not cache_path:
+        return
+    try:
+        with closing(_connect_disk_cache(cache_path)) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO geocode_cache (query_key, lat, lon, address) VALUES (?, ?, ?, ?)",
+                (key, lat, lon, address)
+            )
+    except sqlite3.Error as e:
+        print(f"Cảnh báo: Không ghi được cache geocoding '{cache_path}': {e}")
+
+
+def load_gazetteer(gazetteer_path=GAZETTEER_PATH):
+    """
+    Đọc gazetteer địa chỉ/địa điểm (CSV: name, lat, lon) dùng cho chế độ offline.
+    Trả về dict gồm bảng dữ liệu, chỉ mục theo tên đã chuẩn hoá và KD-tree cho reverse geocode; None nếu chưa có file.
+    """
+    global _gazetteer
+    if _gazetteer is not None and _gazetteer['path'] == gazetteer_path:
+        return _gazetteer
+    if not os.path.exists(gazetteer_path):
+        print(f"Cảnh báo: Chưa có gazetteer offline tại '{gazetteer_path}'. Chạy 'python geocoding.py' để tạo.")
+        return None
+    entries = pd.read_csv(gazetteer_path, usecols=['name', 'lat', 'lon']).dropna()
+    entries['normalized'] = entries['name'].map(normalize_query)
+    entries = entries.drop_duplicates('normalized', keep='first').reset_index(drop=True)
+    cos_lat = np.cos(np.radians(entries['lat'].mean())) if not entries.empty else 1.0
+    _gazetteer = {
+        'path': gazetteer_path,
+        'entries': entries,
+        'row_by_name': dict(zip(entries['normalized'], entries.index)),
+        'tree': cKDTree(np.column_stack((entries['lat'], entries['lon'] * cos_lat))) if not entries.empty else None,
+        'cos_lat': cos_lat,
+    }
+    print(f"Đã tải gazetteer offline: {len(entries)} địa điểm.")
+    return _gazetteer
+
+
+def _gazetteer_geocode(normalized, gazetteer_path):
+    gazetteer = load_gazetteer(gazetteer_path)
+    if gazetteer is None:
+        return None
+    row = gazetteer['row_by_name'].get(normalized)
+    if row is None:
+        matches = difflib.get_close_matches(normalized, gazetteer['row_by_name'].keys(), n=1, cutoff=GAZETTEER_MATCH_CUTOFF)
+        if not matches:
+            return None
+        row = gazetteer['row_by_name'][matches[0]]
+    entry = gazetteer['entries'].loc[row]
+    return float(entry['lat']), float(entry['lon'])
+
+
+def _gazetteer_reverse_geocode(lat, lon, gazetteer_path):
+    gazetteer = load_gazetteer(gazetteer_path)
+    if gazetteer is None or gazetteer['tree'] is None:
+        return None
+    _, row = gazetteer['tree'].query([lat, lon * gazetteer['cos_lat']])
+    entry = gazetteer['entries'].loc[row]
+    if ox.distance.great_circle(lat, lon, entry['lat'], entry['lon']) > GAZETTEER_REVERSE_MAX_DISTANCE_M:
+        return None
+    return str(entry['name'])
+
+
+def _nominatim_reverse(lat, lon):
+    """
+    Gọi endpoint /reverse của Nominatim (theo cấu hình ox.settings: URL, key, user-agent, timeout).
+    /reverse trả về một object chứ không phải list như /search, nên không dùng được hàm yêu cầu của OSMnx.
+    Trả về display_name; None nếu Nominatim không có địa chỉ tại toạ độ này.
+    """
+    global _last_nominatim_request
+    params = {'lat': float(lat), 'lon': float(lon), 'format': 'json'}
+    if ox.settings.nominatim_key is not None:
+        params['key'] = ox.settings.nominatim_key
+    headers = {'User-Agent': ox.settings.http_user_agent, 'referer': ox.settings.http_referer,
+               'Accept-Language': ox.settings.http_accept_language}
+    with _nominatim_lock:
+        pause = _last_nominatim_request + NOMINATIM_MIN_INTERVAL_SECONDS - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        try:
+            response = requests.get(
+                ox.settings.nominatim_url.rstrip("/") + "/reverse", params=params, headers=headers,
+                timeout=ox.settings.requests_timeout, **ox.settings.requests_kwargs
+            )
+        finally:
+            _last_nominatim_request = time.monotonic()
+    response.raise_for_status()
+    response_json = response.json()
+    # Không có địa chỉ: Nominatim trả về {"error": "Unable to geocode"}
+    if not isinstance(response_json, dict) or 'error' in response_json:
+        return None
+    return response_json.get('display_name') or None
+
+
+def geocode(query, offline=GEOCODING_OFFLINE, cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH):
+    """
+    Thay cho ox.geocode: trả về (lat, lon) của địa chỉ, ném ValueError nếu không tìm thấy.
+    Thứ tự tra: LRU trong bộ nhớ -> cache SQLite trên đĩa -> Nominatim (hoặc gazetteer nếu offline).
+    Kết quả từ mạng/gazetteer được ghi vào cả hai tầng cache nên lần tra lặp lại không bao giờ ra mạng.
+    """
+    key = normalize_query(query)
+    if not key:
+        raise ValueError("Địa chỉ rỗng.")
+    result = _memory_get(key)
+    if result is not None:
+        return result
+    cached = _disk_get(key, cache_path)
+    if cached is not None:
+        result = (cached[0], cached[1])
+        _memory_put(key, result)
+        return result
+
+    if offline:
+        result = _gazetteer_geocode(key, gazetteer_path)
+        if result is None:
+            raise ValueError(f"Không tìm thấy '{query}' trong gazetteer offline.")
+    else:
+        try:
+            result = tuple(float(value) for value in ox.geocode(query))
+        except Exception as e:
+            raise ValueError(f"Không geocode được '{query}': {e}") from e
+    _memory_put(key, result)
+    _disk_put(key, result[0], result[1], None, cache_path)
+    return result
+
+
+def geocode_batch(queries, offline=GEOCODING_OFFLINE, cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH):
+    """
+    Geocode nhiều địa chỉ: mỗi địa chỉ (sau chuẩn hoá) chỉ tra một lần.
+    Trả về list (lat, lon) theo đúng thứ tự đầu vào, None cho địa chỉ không tìm thấy.
+    """
+    results_by_key = {}
+    for query in queries:
+        key = normalize_query(query)
+        if key in results_by_key:
+            continue
+        try:
+            results_by_key[key] = geocode(query, offline=offline, cache_path=cache_path, gazetteer_path=gazetteer_path)
+        except ValueError as e:
+            print(f"Cảnh báo: {e}")
+            results_by_key[key] = None
+    return [results_by_key[normalize_query(query)] for query in queries]
+
+
+def reverse_geocode(lat, lon, offline=GEOCODING_OFFLINE, cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH):
+    """
+    Địa chỉ (chuỗi) tại toạ độ (lat, lon), ném ValueError nếu không tìm thấy.
+    Dùng chung hai tầng cache với geocode (khóa theo toạ độ làm tròn ~1 m).
+    """
+    key = _reverse_key(lat, lon)
+    result = _memory_get(key)
+    if result is not None:
+        return result
+    cached = _disk_get(key, cache_path)
+    if cached is not None and cached[2]:
+        _memory_put(key, cached[2])
+        return cached[2]
+
+    if offline:
+        result = _gazetteer_reverse_geocode(lat, lon, gazetteer_path)
+        if result is None:
+            raise ValueError(f"Không có địa điểm nào trong gazetteer offline gần ({lat}, {lon}).")
+    else:
+        try:
+            result = _nominatim_reverse(lat, lon)
+        except (requests.RequestException, ValueError) as e:
+            raise ValueError(f"Không reverse geocode được ({lat}, {lon}): {e}") from e
+        if not result:
+            raise ValueError(f"Không tìm thấy địa chỉ tại ({lat}, {lon}).")
+    _memory_put(key, result)
+    _disk_put(key, float(lat), float(lon), result, cache_path)
+    return result
+
+
+def build_gazetteer(place_name=PLACE_NAME, gazetteer_path=GAZETTEER_PATH):
+    """
+    Tạo gazetteer offline từ OpenStreetMap: các địa điểm có tên (POI, công trình, ga...) và các địa chỉ
+    "số nhà + tên đường" trong khu vực. Ghi CSV (name, lat, lon) và trả về DataFrame.
+    """
+    global _gazetteer
+    print(f"Đang tải địa điểm và địa chỉ trong '{place_name}' từ OpenStreetMap để tạo gazetteer...")
+    features = ox.features_from_place(place_name, tags={'name': True, 'addr:housenumber': True})
+    centroids = features.geometry.to_crs("EPSG:32618").centroid.to_crs("EPSG:4326")
+    columns = [column for column in ('name', 'addr:housenumber', 'addr:street') if column in features.columns]
+    features = features[columns].assign(lat=centroids.y.to_numpy(), lon=centroids.x.to_numpy())
+
+    frames = []
+    if 'name' in features.columns:
+        frames.append(features.loc[features['name'].notna(), ['name', 'lat', 'lon']])
+    if 'addr:housenumber' in features.columns and 'addr:street' in features.columns:
+        addresses = features[features['addr:housenumber'].notna() & features['addr:street'].notna()]
+        frames.append(pd.DataFrame({
+            'name': addresses['addr:housenumber'].astype(str) + " " + addresses['addr:street'].astype(str),
+            'lat': addresses['lat'],
+            'lon': addresses['lon'],
+        }))
+    if not frames:
+        print("Không có địa điểm nào để tạo gazetteer.")
+        return None
+    gazetteer_df = pd.concat(frames, ignore_index=True).drop_duplicates('name', keep='first')
+
+    directory = os.path.dirname(gazetteer_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    gazetteer_df.to_csv(gazetteer_path, index=False)
+    _gazetteer = None # Lần tra sau đọc lại file mới
+    print(f"Đã lưu gazetteer ({len(gazetteer_df)} địa điểm) vào: {gazetteer_path}")
+    return gazetteer_df
+
+
+if __name__ == '__main__':
+    build_gazetteer()
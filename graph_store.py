@@ -0,0 +1,169 @@
+# graph_store.py
+import os
+import json
+import time
+import shutil
+import numpy as np
+from config import GRAPH_STORE_DIR, GRAPH_STORE_VERSION, GRAPH_STORE_KEEP_VERSIONS
+from compact_graph import CompactGraph
+from weight_layers import TravelTimeLayers
+from speed_table import speed_sources_fingerprint, current_speed_sources_fingerprint
+
+CURRENT_POINTER_FILE = "CURRENT"
+LAYERS_FILE_NAME = "travel_time_layers.npy"
+META_FILE_NAME = "meta.json"
+VERSION_DIR_PREFIX = "store_v"
+
+
+def save_graph_store(travel_time_layers, store_dir=GRAPH_STORE_DIR, bounds=None, keep_versions=GRAPH_STORE_KEEP_VERSIONS):
+    """
+    Ghi đồ thị CSR, ánh xạ cạnh -> LocationID và ma trận 168 lớp travel_time thành các file .npy
+    trong một thư mục phiên bản, rồi cập nhật con trỏ CURRENT (đổi tên nguyên tử).
+    bounds: [[lat_min, lon_min], [lat_max, lon_max]] của khu vực bản đồ (tuỳ chọn).
+    Chỉ giữ lại keep_versions phiên bản mới nhất (luôn gồm phiên bản hiện hành); None = không dọn.
+    """
+    compact_graph = travel_time_layers.compact_graph
+    matrix = travel_time_layers.matrix
+    if matrix is None:
+        matrix = travel_time_layers.load_or_build_all()
+
+    fingerprint = travel_time_layers.fingerprint()
+    version_name = f"{VERSION_DIR_PREFIX}{GRAPH_STORE_VERSION}_{fingerprint[:16]}"
+    version_dir = os.path.join(store_dir, version_name)
+    os.makedirs(store_dir, exist_ok=True)
+
+    if not os.path.exists(version_dir):
+        tmp_dir = f"{version_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in CompactGraph.ARRAY_NAMES:
+            array = getattr(compact_graph, name)
+            if array is not None:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        np.save(os.path.join(tmp_dir, LAYERS_FILE_NAME), np.ascontiguousarray(matrix))
+        meta = {
+            'version': GRAPH_STORE_VERSION,
+            'fingerprint': fingerprint,
+            # Nguồn tốc độ đã dùng để tính các lớp; None nếu không biết (bộ lớp dựng lại từ ma trận có sẵn)
+            'speed_sources': (
+                speed_sources_fingerprint(travel_time_layers.speed_table, travel_time_layers.fallback_median_speed_by_hour)
+                if travel_time_layers.speed_table is not None else None
+            ),
+            'num_nodes': int(compact_graph.num_nodes),
+            'num_edges': int(compact_graph.num_edges),
+            'bounds': bounds,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with open(os.path.join(tmp_dir, META_FILE_NAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        try:
+            os.replace(tmp_dir, version_dir)
+        except OSError:
+            # Một worker khác đã ghi xong cùng phiên bản trước
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        os.utime(version_dir) # Dùng lại bản đã có: đánh dấu là mới nhất để không bị dọn
+
+    pointer_tmp = os.path.join(store_dir, f"{CURRENT_POINTER_FILE}.tmp{os.getpid()}")
+    with open(pointer_tmp, 'w', encoding='utf-8') as f:
+        f.write(version_name)
+    os.replace(pointer_tmp, os.path.join(store_dir, CURRENT_POINTER_FILE))
+    print(f"Đã lưu kho đồ thị dùng chung: {version_dir}")
+    if keep_versions is not None:
+        prune_graph_store(store_dir, keep_versions, current_version_name=version_name)
+    return version_dir
+
+
+def prune_graph_store(store_dir=GRAPH_STORE_DIR, keep_versions=GRAPH_STORE_KEEP_VERSIONS, current_version_name=None):
+    """
+    Xoá các thư mục phiên bản cũ, chỉ giữ keep_versions bản mới nhất (theo thời điểm ghi) và bản hiện hành.
+    Worker nào đang mmap bản cũ vẫn đọc được tới khi đóng (hệ điều hành chỉ giải phóng file khi hết tham chiếu).
+    Trả về danh sách thư mục đã xoá.
+    """
+    version_dirs = [
+        os.path.join(store_dir, name) for name in os.listdir(store_dir)
+        if name.startswith(VERSION_DIR_PREFIX) and '.tmp' not in name
+        and os.path.isdir(os.path.join(store_dir, name))
+    ]
+    version_dirs.sort(key=os.path.getmtime, reverse=True)
+    removed_dirs = []
+    for version_dir in version_dirs[max(int(keep_versions), 1):]:
+        if os.path.basename(version_dir) == current_version_name:
+            continue
+        shutil.rmtree(version_dir, ignore_errors=True)
+        removed_dirs.append(version_dir)
+    if removed_dirs:
+        print(f"Đã xoá {len(removed_dirs)} phiên bản kho đồ thị cũ trong {store_dir}.")
+    return removed_dirs
+
+
+def open_graph_store(store_dir=GRAPH_STORE_DIR, check_speed_sources=True):
+    """
+    Mở kho đồ thị hiện hành bằng mmap (chỉ đọc): các worker cùng máy dùng chung một bản vật lý
+    qua page cache của hệ điều hành. Trả về (TravelTimeLayers, meta) hoặc (None, None) nếu chưa có kho.
+    check_speed_sources=True: cũng trả về (None, None) khi bảng tốc độ/tốc độ fallback trên đĩa đã khác lúc
+    dựng kho (ví dụ sau khi chạy train_model.py), để nơi gọi dựng lại các lớp thay vì phục vụ tốc độ cũ.
+    """
+    pointer_path = os.path.join(store_dir, CURRENT_POINTER_FILE)
+    if not os.path.exists(pointer_path):
+        return None, None
+    try:
+        with open(pointer_path, encoding='utf-8') as f:
+            version_dir = os.path.join(store_dir, f.read().strip())
+        with open(os.path.join(version_dir, META_FILE_NAME), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != GRAPH_STORE_VERSION:
+            print(f"Cảnh báo: Kho đồ thị {version_dir} khác phiên bản định dạng, bỏ qua.")
+            return None, None
+        if (check_speed_sources and meta.get('speed_sources') is not None
+                and meta['speed_sources'] != current_speed_sources_fingerprint()):
+            print(f"LƯU Ý: Kho đồ thị {version_dir} được dựng từ bảng tốc độ cũ (mô hình đã được huấn luyện lại), "
+                  "cần dựng lại các lớp travel_time.")
+            return None, None
+
+        arrays = {}
+        for name in CompactGraph.ARRAY_NAMES:
+            array_path = os.path.join(version_dir, f"{name}.npy")
+            if os.path.exists(array_path):
+                arrays[name] = np.load(array_path, mmap_mode='r')
+        compact_graph = CompactGraph(**arrays)
+        matrix = np.load(os.path.join(version_dir, LAYERS_FILE_NAME), mmap_mode='r')
+        if matrix.shape[1] != compact_graph.num_edges:
+            print(f"Cảnh báo: Kho đồ thị {version_dir} không nhất quán (số cạnh khác nhau), bỏ qua.")
+            return None, None
+    except Exception as e:
+        print(f"Cảnh báo: Không mở được kho đồ thị dùng chung: {e}")
+        return None, None
+
+    print(f"Đã mở kho đồ thị dùng chung bằng mmap: {version_dir}")
+    return TravelTimeLayers.from_matrix(compact_graph, matrix, fingerprint=meta.get('fingerprint')), meta
+
+
+if __name__ == '__main__':
+    # Dựng kho dùng chung từ dữ liệu nguồn (chạy sau train_model.py, trước khi khởi động các worker)
+    from data_loader import load_road_network, load_taxi_zones
+    from data_processor import filter_taxi_zones_by_borough
+    from speed_table import load_or_build_speed_table, load_fallback_speeds, default_fallback_speeds
+    from contraction_hierarchy import load_or_build_contraction_hierarchy
+
+    G_build = load_road_network()
+    taxi_zones_build = load_taxi_zones()
+    if G_build is None or taxi_zones_build is None:
+        raise SystemExit("Lỗi tải đồ thị hoặc taxi zones. Không thể dựng kho đồ thị.")
+
+    manhattan_zones_build, _ = filter_taxi_zones_by_borough(taxi_zones_build)
+    fallback_build = load_fallback_speeds()
+    if fallback_build is None:
+        fallback_build = default_fallback_speeds()
+
+    layers_build = TravelTimeLayers(
+        CompactGraph.from_networkx(G_build, taxi_zones_build),
+        fallback_build,
+        speed_table=load_or_build_speed_table(taxi_zones_build['LocationID'])
+    )
+    bounds_array = manhattan_zones_build.to_crs("EPSG:4326").total_bounds
+    save_graph_store(
+        layers_build,
+        bounds=[[float(bounds_array[1]), float(bounds_array[0])], [float(bounds_array[3]), float(bounds_array[2])]]
+    )
+    # Tiền xử lý contraction hierarchy luôn để các worker chỉ cần tải từ cache
+    load_or_build_contraction_hierarchy(layers_build.compact_graph)
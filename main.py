@@ -3,40 +3,34 @@ import osmnx as ox
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-import joblib # Để tải model và preprocessor
-
-from config import DEFAULT_TARGET_HOUR, DEFAULT_TARGET_DAY_NUMERIC
-from data_loader import load_road_network, load_taxi_zones, load_taxi_trip_data
-from data_processor import (
-    filter_taxi_zones_by_borough,
-    initial_trip_data_cleaning,
-    filter_trips_by_location_ids,
-    calculate_median_speed_by_time
-    # create_ml_training_data # Không cần thiết ở main.py nữa trừ khi bạn muốn tạo fallback data
-)
-from routing_utils import (
-    add_travel_times_to_graph,
-    calculate_eta_for_route
-)
+
+from config import DEFAULT_TARGET_HOUR, DEFAULT_TARGET_DAY_NUMERIC, MODEL_REGISTRY_DIR, SPEED_TABLE_PATH, TIME_DEPENDENT_ROUTING
+from data_loader import load_road_network, load_taxi_zones
+from compact_graph import CompactGraph, calculate_eta_on_compact_graph, calculate_time_dependent_eta
+from weight_layers import TravelTimeLayers
+from speed_table import load_or_build_speed_table, load_fallback_speeds, default_fallback_speeds
+from geocoding import geocode
 
 # Hàm get_user_inputs giữ nguyên như trước
-def get_user_inputs(G_graph):
+def get_user_inputs(compact_graph):
     # ... (Nội dung hàm giữ nguyên) ...
     while True:
         try:
             origin_address = input("Nhập địa chỉ điểm xuất phát ở Manhattan (ví dụ: 'Times Square, New York'): ")
-            origin_lat, origin_lon = ox.geocode(origin_address)
-            origin_node = ox.nearest_nodes(G_graph, X=origin_lon, Y=origin_lat)
-            print(f"Tìm thấy Node xuất phát gần nhất: {origin_node} cho địa chỉ '{origin_address}'")
+            origin_lat, origin_lon = geocode(origin_address)
+            origin_nodes, snap_distances = compact_graph.snap_points([origin_lat], [origin_lon])
+            origin_node = int(origin_nodes[0])
+            print(f"Tìm thấy Node xuất phát gần nhất: {origin_node} (cách {snap_distances[0]:.0f} m) cho địa chỉ '{origin_address}'")
             break
         except Exception as e:
             print(f"Lỗi geocoding địa chỉ xuất phát: {e}. Vui lòng thử lại.")
     while True:
         try:
             destination_address = input("Nhập địa chỉ điểm đến ở Manhattan (ví dụ: 'Wall Street, New York'): ")
-            dest_lat, dest_lon = ox.geocode(destination_address)
-            destination_node = ox.nearest_nodes(G_graph, X=dest_lon, Y=dest_lat)
-            print(f"Tìm thấy Node đích gần nhất: {destination_node} cho địa chỉ '{destination_address}'")
+            dest_lat, dest_lon = geocode(destination_address)
+            destination_nodes, snap_distances = compact_graph.snap_points([dest_lat], [dest_lon])
+            destination_node = int(destination_nodes[0])
+            print(f"Tìm thấy Node đích gần nhất: {destination_node} (cách {snap_distances[0]:.0f} m) cho địa chỉ '{destination_address}'")
             break
         except Exception as e:
             print(f"Lỗi geocoding địa chỉ đích: {e}. Vui lòng thử lại.")
@@ -53,6 +47,19 @@ def get_user_inputs(G_graph):
                 print("Giờ không hợp lệ. Vui lòng nhập số từ 0 đến 23.")
         except ValueError:
             print("Vui lòng nhập một số nguyên cho giờ.")
+    while True:
+        try:
+            minute_str = input("Nhập phút khởi hành (0-59, mặc định 0): ")
+            if not minute_str:
+                minute = 0
+                break
+            minute = int(minute_str)
+            if 0 <= minute <= 59:
+                break
+            else:
+                print("Phút không hợp lệ. Vui lòng nhập số từ 0 đến 59.")
+        except ValueError:
+            print("Vui lòng nhập một số nguyên cho phút.")
     while True:
         try:
             day_str = input(f"Nhập ngày khởi hành (0=Thứ Hai, ..., 6=Chủ Nhật, mặc định {DEFAULT_TARGET_DAY_NUMERIC}): ")
@@ -66,7 +73,7 @@ def get_user_inputs(G_graph):
                 print("Ngày không hợp lệ. Vui lòng nhập số từ 0 đến 6.")
         except ValueError:
             print("Vui lòng nhập một số nguyên cho ngày.")
-    return origin_node, destination_node, hour, day
+    return origin_node, destination_node, hour, minute, day
 
 
 def main():
@@ -75,78 +82,65 @@ def main():
     # --- 1. Tải dữ liệu ---
     G_manhattan = load_road_network()
     taxi_zones_gdf = load_taxi_zones() 
-    raw_taxi_trips_df = load_taxi_trip_data()
 
-    if G_manhattan is None or taxi_zones_gdf is None or raw_taxi_trips_df is None:
+    if G_manhattan is None or taxi_zones_gdf is None:
         print("Lỗi tải dữ liệu đầu vào. Kết thúc chương trình.")
         return
 
-    origin_node, destination_node, target_hour, target_day_numeric = get_user_inputs(G_manhattan)
+    # Đồ thị CSR dựng một lần: dùng cho snap toạ độ (KD-tree) và tìm đường
+    compact_graph = CompactGraph.from_networkx(G_manhattan, taxi_zones_gdf)
+    origin_node, destination_node, target_hour, departure_minute, target_day_numeric = get_user_inputs(compact_graph)
     if origin_node is None or destination_node is None:
         print("Không thể xác định điểm đầu hoặc cuối từ địa chỉ. Kết thúc chương trình.")
         return
 
-    # --- 2. Xử lý dữ liệu & Chuẩn bị dữ liệu cho fallback ---
-    # Vẫn cần tính fallback_median_speed_by_hour cho hàm add_travel_times_to_graph
-    _, manhattan_location_ids = filter_taxi_zones_by_borough(taxi_zones_gdf)
-    cleaned_taxi_trips_df = initial_trip_data_cleaning(raw_taxi_trips_df)
-    manhattan_trips_df = pd.DataFrame() 
-    if cleaned_taxi_trips_df is not None and not cleaned_taxi_trips_df.empty and manhattan_location_ids:
-        manhattan_trips_df = filter_trips_by_location_ids(cleaned_taxi_trips_df, manhattan_location_ids)
-    
-    fallback_median_speed_by_hour = pd.Series(dtype='float64') 
-    if not manhattan_trips_df.empty:
-        median_speed_by_hour_for_fallback, _ = calculate_median_speed_by_time(manhattan_trips_df)
-        if not median_speed_by_hour_for_fallback.empty:
-             fallback_median_speed_by_hour = median_speed_by_hour_for_fallback
-        else:
-            print("Cảnh báo: Không tính được fallback_median_speed_by_hour.")
-    else:
-        print("Cảnh báo: Không có dữ liệu manhattan_trips_df để tính fallback_median_speed_by_hour.")
-    
-    if fallback_median_speed_by_hour.empty: 
-        print("CẢNH BÁO: fallback_median_speed_by_hour rỗng. Tốc độ fallback sẽ là giá trị mặc định.")
-        fallback_median_speed_by_hour = pd.Series([10.0]*24, index=range(24))
+    # --- 2. Tốc độ fallback ---
+    # Tốc độ trung vị theo giờ đã được train_model.py lưu sẵn, không cần đọc dữ liệu chuyến đi
+    fallback_median_speed_by_hour = load_fallback_speeds()
+    if fallback_median_speed_by_hour is None:
+        print("CẢNH BÁO: Chưa có tốc độ fallback theo giờ. Tốc độ fallback sẽ là giá trị mặc định.")
+        fallback_median_speed_by_hour = default_fallback_speeds()
 
 
-    # --- Tải Mô hình ML và Preprocessor ĐÃ HUẤN LUYỆN ---
-    print("\n--- Tải Mô hình ML và Preprocessor ---")
-    ml_model = None
-    ml_preprocessor = None
+    # --- Tải Bảng tốc độ tính sẵn từ Mô hình ML ĐÃ HUẤN LUYỆN ---
+    print("\n--- Tải Bảng tốc độ (zone × giờ × ngày) ---")
     try:
-        ml_model = joblib.load('trained_rf_model.joblib')
-        ml_preprocessor = joblib.load('data_preprocessor.joblib')
-        print("Tải mô hình và preprocessor thành công.")
+        speed_table = load_or_build_speed_table(taxi_zones_gdf['LocationID'])
+        print("Tải bảng tốc độ thành công.")
     except FileNotFoundError:
-        print("LỖI: Không tìm thấy file model ('trained_rf_model.joblib') hoặc preprocessor ('data_preprocessor.joblib').")
+        print(f"LỖI: Không tìm thấy bảng tốc độ ('{SPEED_TABLE_PATH}') và bundle mô hình trong registry ('{MODEL_REGISTRY_DIR}').")
         print("Vui lòng chạy script 'train_model.py' để huấn luyện và lưu mô hình trước khi chạy file này.")
         return # Kết thúc nếu không có mô hình
 
-    if ml_model is None or ml_preprocessor is None:
-        print("Không tải được mô hình ML hoặc preprocessor. Kết thúc.")
+    if speed_table is None:
+        print("Không tải được bảng tốc độ. Kết thúc.")
         return
 
-    # --- 3. Tính toán ETA sử dụng Mô hình ML ---
-    add_travel_times_to_graph(
-        G_manhattan, 
-        target_hour, 
-        target_day_numeric,
-        ml_model,
-        ml_preprocessor,
-        taxi_zones_gdf,
-        fallback_median_speed_by_hour
-    )
-    G_with_times = G_manhattan 
-
-    print(f"\nSẽ tính ETA cho thời điểm: {target_hour} giờ, ngày thứ {target_day_numeric} trong tuần.")
+    # --- 3. Tính toán ETA sử dụng Bảng tốc độ của Mô hình ML trên đồ thị CSR ---
+    G_with_times = G_manhattan # Chỉ dùng để vẽ lộ trình
+
+    print(f"\nSẽ tính ETA cho thời điểm: {target_hour}:{departure_minute:02d}, ngày thứ {target_day_numeric} trong tuần.")
     print(f"Từ Node ID: {origin_node} đến Node ID: {destination_node}")
 
-    route, eta_minutes = calculate_eta_for_route(G_with_times, origin_node, destination_node)
+    if TIME_DEPENDENT_ROUTING:
+        # Các lớp travel_time theo giờ chỉ được tính khi lộ trình thực sự đi tới khung giờ đó
+        travel_time_layers = TravelTimeLayers(compact_graph, fallback_median_speed_by_hour, speed_table=speed_table)
+        route, eta_minutes, distance_m = calculate_time_dependent_eta(
+            travel_time_layers, origin_node, destination_node, target_hour, target_day_numeric, departure_minute
+        )
+    else:
+        travel_times = compact_graph.compute_travel_times(
+            target_hour, target_day_numeric, fallback_median_speed_by_hour, speed_table=speed_table
+        )
+        route, eta_minutes, distance_m = calculate_eta_on_compact_graph(
+            compact_graph, travel_times, origin_node, destination_node
+        )
 
     if route and eta_minutes is not None and not (isinstance(eta_minutes, float) and (pd.isna(eta_minutes) or np.isinf(eta_minutes))):
         print(f"\n--- KẾT QUẢ ETA CUỐI CÙNG (sử dụng ML) ---")
         print(f"Lộ trình tìm được có {len(route)} nút.")
         print(f"ETA dự kiến: {eta_minutes:.2f} phút.")
+        print(f"Tổng quãng đường: {distance_m / 1000:.2f} km.")
         try:
             print("\nĐang vẽ lộ trình...")
             fig, ax = ox.plot_graph_route(
@@ -0,0 +1,180 @@
+# model_registry.py
+import os
+import json
+import time
+import shutil
+import hashlib
+from datetime import datetime, timezone
+import pandas as pd
+import joblib
+from config import MODEL_REGISTRY_DIR, MODEL_MMAP_MODE, MODEL_VERIFY_HASH
+from speed_table import FEATURE_COLUMNS, HOURS_PER_DAY
+
+BUNDLE_FORMAT_VERSION = 1 # Tăng khi đổi cấu trúc bundle
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT" # Tên phiên bản đang dùng (ghi nguyên tử)
+ARTIFACT_FILES = {'model': "model.joblib", 'preprocessor': "preprocessor.joblib"}
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_text_atomic(path, text):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def save_model_bundle(ml_model, ml_preprocessor, fallback_speeds, training_data=None, metrics=None,
+                      backend=None, registry_dir=MODEL_REGISTRY_DIR, make_current=True):
+    """
+    Lưu một bundle mô hình có phiên bản vào registry_dir/<phiên bản>/ rồi (nếu make_current) đánh dấu là
+    phiên bản hiện tại: model.joblib và preprocessor.joblib (không nén để nạp được bằng mmap) cùng manifest.json
+    gồm schema đặc trưng, tốc độ fallback theo giờ, khoảng dữ liệu huấn luyện (training_data), các chỉ số
+    đánh giá (metrics) và sha256 của từng file. Với make_current=False, gọi activate_model_bundle sau khi các
+    dữ liệu dẫn xuất (bảng tốc độ...) đã được ghi xong. Trả về tên phiên bản.
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    created_at = datetime.now(timezone.utc)
+    tmp_dir = os.path.join(registry_dir, f".tmp{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        joblib.dump(ml_model, os.path.join(tmp_dir, ARTIFACT_FILES['model']))
+        joblib.dump(ml_preprocessor, os.path.join(tmp_dir, ARTIFACT_FILES['preprocessor']))
+        file_hashes = {name: _file_sha256(os.path.join(tmp_dir, file_name)) for name, file_name in ARTIFACT_FILES.items()}
+        bundle_hash = hashlib.sha256("".join(file_hashes[name] for name in sorted(file_hashes)).encode()).hexdigest()
+        version = f"{created_at:%Y%m%dT%H%M%SZ}-{bundle_hash[:8]}"
+        manifest = {
+            'format_version': BUNDLE_FORMAT_VERSION,
+            'version': version,
+            'created_at': created_at.isoformat(),
+            'backend': backend,
+            'model_class': type(ml_model).__name__,
+            'feature_columns': FEATURE_COLUMNS,
+            'fallback_speeds_mph': [
+                float(fallback_speeds.get(hour, float('nan'))) for hour in range(HOURS_PER_DAY)
+            ],
+            'training_data': training_data,
+            'metrics': metrics,
+            'files': {name: {'path': ARTIFACT_FILES[name], 'sha256': file_hashes[name]} for name in ARTIFACT_FILES},
+            'bundle_sha256': bundle_hash,
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        bundle_dir = os.path.join(registry_dir, version)
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+        os.replace(tmp_dir, bundle_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    print(f"Đã lưu bundle mô hình phiên bản '{version}' vào: {bundle_dir}")
+    if make_current:
+        activate_model_bundle(version, registry_dir)
+    return version
+
+
+def activate_model_bundle(version, registry_dir=MODEL_REGISTRY_DIR):
+    """Đánh dấu một bundle đã lưu là phiên bản hiện tại (ghi con trỏ CURRENT nguyên tử)."""
+    if not os.path.isfile(os.path.join(registry_dir, version, MANIFEST_FILE)):
+        raise FileNotFoundError(f"Không có bundle mô hình '{version}' trong {registry_dir}.")
+    _write_text_atomic(os.path.join(registry_dir, CURRENT_FILE), version)
+    print(f"Phiên bản mô hình hiện tại: '{version}'.")
+
+
+def current_version(registry_dir=MODEL_REGISTRY_DIR):
+    """Tên phiên bản bundle hiện tại; None nếu registry chưa có bundle nào."""
+    try:
+        with open(os.path.join(registry_dir, CURRENT_FILE), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def list_versions(registry_dir=MODEL_REGISTRY_DIR):
+    """Các phiên bản bundle trong registry, cũ trước mới sau."""
+    if not os.path.isdir(registry_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(registry_dir)
+        if os.path.isfile(os.path.join(registry_dir, name, MANIFEST_FILE))
+    )
+
+
+def read_manifest(version=None, registry_dir=MODEL_REGISTRY_DIR):
+    """Manifest (dict) của một phiên bản (mặc định: phiên bản hiện tại); None nếu không có hoặc khác định dạng."""
+    version = version or current_version(registry_dir)
+    if version is None:
+        return None
+    try:
+        with open(os.path.join(registry_dir, version, MANIFEST_FILE), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Lỗi khi đọc manifest của bundle mô hình '{version}': {e}")
+        return None
+    if not isinstance(manifest, dict) or manifest.get('format_version') != BUNDLE_FORMAT_VERSION:
+        print(f"Cảnh báo: Bundle mô hình '{version}' khác định dạng (cần format_version {BUNDLE_FORMAT_VERSION}).")
+        return None
+    return manifest
+
+
+def load_model_bundle(version=None, registry_dir=MODEL_REGISTRY_DIR, mmap_mode=MODEL_MMAP_MODE,
+                      verify=MODEL_VERIFY_HASH):
+    """
+    Nạp bundle mô hình (mặc định: phiên bản hiện tại). Mảng numpy lớn trong file được nạp bằng
+    joblib mmap_mode (chỉ đọc trang nào cần, dùng chung page cache giữa các tiến trình).
+    verify=True kiểm tra sha256 từng file với manifest trước khi nạp.
+    Trả về dict gồm 'model', 'preprocessor', 'fallback_speeds' (Series 0-23, mph), 'manifest' và
+    'load_seconds' (thời gian cold start); None nếu chưa có bundle, bundle hỏng hoặc sai hash.
+    """
+    manifest = read_manifest(version, registry_dir)
+    if manifest is None:
+        return None
+    if manifest.get('feature_columns') != FEATURE_COLUMNS:
+        print(f"Cảnh báo: Bundle mô hình '{manifest['version']}' dùng đặc trưng {manifest.get('feature_columns')}, "
+              f"khác {FEATURE_COLUMNS}.")
+        return None
+    bundle_dir = os.path.join(registry_dir, manifest['version'])
+
+    start = time.perf_counter()
+    if verify:
+        for name, file_info in manifest['files'].items():
+            if _file_sha256(os.path.join(bundle_dir, file_info['path'])) != file_info['sha256']:
+                print(f"LỖI: File '{file_info['path']}' của bundle mô hình '{manifest['version']}' sai sha256.")
+                return None
+    verify_seconds = time.perf_counter() - start
+    try:
+        ml_model = joblib.load(os.path.join(bundle_dir, manifest['files']['model']['path']), mmap_mode=mmap_mode)
+        ml_preprocessor = joblib.load(os.path.join(bundle_dir, manifest['files']['preprocessor']['path']), mmap_mode=mmap_mode)
+    except Exception as e:
+        print(f"Lỗi khi nạp bundle mô hình '{manifest['version']}': {e}")
+        return None
+    load_seconds = time.perf_counter() - start
+    print(f"Đã nạp bundle mô hình '{manifest['version']}' ({manifest.get('model_class')}) trong "
+          f"{load_seconds * 1e3:.1f} ms (kiểm tra hash {verify_seconds * 1e3:.1f} ms, mmap_mode={mmap_mode}).")
+    return {
+        'model': ml_model,
+        'preprocessor': ml_preprocessor,
+        'fallback_speeds': pd.Series(manifest['fallback_speeds_mph'], index=range(HOURS_PER_DAY), dtype='float64'),
+        'manifest': manifest,
+        'load_seconds': load_seconds,
+    }
+
+
+if __name__ == '__main__':
+    # Liệt kê các bundle và đo thời gian cold start của phiên bản hiện tại
+    active_version = current_version()
+    for bundle_version in list_versions():
+        bundle_manifest = read_manifest(bundle_version) or {}
+        marker = "*" if bundle_version == active_version else " "
+        print(f"{marker} {bundle_version}  {bundle_manifest.get('backend')}  "
+              f"dữ liệu: {bundle_manifest.get('training_data')}  chỉ số: {bundle_manifest.get('metrics')}")
+    if load_model_bundle() is None:
+        print(f"Chưa có bundle mô hình hợp lệ trong '{MODEL_REGISTRY_DIR}'. Chạy train_model.py để tạo.")
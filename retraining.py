@@ -0,0 +1,121 @@
+# retraining.py
+import os
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from config import YELLOW_TAXI_DATA_FILE, TRIP_DATA_MONTHS, MODEL_BACKEND, RETRAINING_STATUS_PATH
+
+# Các bước của một lần huấn luyện lại, kèm tỉ lệ tiến độ ước lượng khi bắt đầu bước
+RETRAINING_STAGES = {
+    'starting': (0.0, "Đang khởi động tiến trình huấn luyện lại..."),
+    'aggregating': (0.05, "Đang gộp tốc độ các chuyến đi (chỉ đọc các tháng mới)..."),
+    'training': (0.4, "Đang huấn luyện mô hình dự đoán tốc độ..."),
+    'saving': (0.6, "Đang lưu bundle mô hình và bảng tốc độ..."),
+    'building_layers': (0.7, "Đang dựng đồ thị CSR và 168 lớp travel_time mới..."),
+    'done': (1.0, "Đã huấn luyện lại xong, mô hình mới đang được đưa vào phục vụ."),
+}
+
+
+def write_retraining_status(stage, status_path=RETRAINING_STATUS_PATH, **details):
+    """Ghi trạng thái huấn luyện lại (bước, tỉ lệ tiến độ, thông điệp) ra file JSON nhỏ (nguyên tử)."""
+    fraction, message = RETRAINING_STAGES[stage]
+    status = {'stage': stage, 'fraction': fraction, 'message': message, 'updated_at': time.time(), **details}
+    directory = os.path.dirname(status_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{status_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False)
+    os.replace(tmp_path, status_path)
+
+
+def read_retraining_status(status_path=RETRAINING_STATUS_PATH):
+    """Trạng thái huấn luyện lại gần nhất (dict); None nếu chưa có hoặc file đang hỏng."""
+    try:
+        with open(status_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def run_retraining(trip_data_path=YELLOW_TAXI_DATA_FILE, backend=MODEL_BACKEND, status_path=RETRAINING_STATUS_PATH):
+    """
+    Huấn luyện lại trong tiến trình riêng bằng đúng quy trình của train_model.py (train_and_save_model: gộp tốc độ,
+    huấn luyện và đánh giá, lưu bundle và bảng tốc độ, dựng lại 168 lớp travel_time và kho đồ thị dùng chung),
+    ghi tiến độ từng bước ra status_path. Trả về tên phiên bản bundle mô hình mới; ném RuntimeError nếu lỗi.
+    """
+    # Import trong tiến trình con: tiến trình phục vụ không phải nạp sklearn/pyarrow chỉ để giữ job
+    from train_model import train_and_save_model
+
+    errors = []
+
+    def on_stage(stage, **details):
+        if stage == 'failed':
+            errors.append(details.get('error'))
+        else:
+            write_retraining_status(stage, status_path, **details)
+
+    version = train_and_save_model(trip_data_path, TRIP_DATA_MONTHS, backends=backend, on_stage=on_stage)
+    if version is None:
+        raise RuntimeError(errors[-1] if errors else "Huấn luyện lại mô hình thất bại.")
+    return version
+
+
+class RetrainingJob:
+    """
+    Chạy run_retraining trong một tiến trình nền (mỗi lúc tối đa một lần) để không chặn phiên người dùng.
+    Dùng chung một đối tượng cho cả server (st.cache_resource): start() bỏ qua nếu đang chạy, status() đọc
+    tiến độ, take_result() trả về phiên bản mô hình mới đúng một lần để app đổi tài nguyên đang cache.
+    """
+
+    def __init__(self, status_path=RETRAINING_STATUS_PATH):
+        self.status_path = status_path
+        self._executor = None
+        self._future = None
+        self._result_taken = False
+        self._lock = threading.Lock()
+
+    def start(self, trip_data_path=YELLOW_TAXI_DATA_FILE, backend=MODEL_BACKEND):
+        """Bắt đầu huấn luyện lại ở tiến trình nền; False nếu đang có một lần chạy chưa xong."""
+        with self._lock:
+            if self._future is not None and not self._future.done():
+                return False
+            write_retraining_status('starting', self.status_path)
+            if self._executor is None:
+                # spawn: không fork tiến trình server đang có nhiều luồng
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            self._future = self._executor.submit(run_retraining, trip_data_path, backend, self.status_path)
+            self._result_taken = False
+            print("Đã bắt đầu huấn luyện lại mô hình ở tiến trình nền.")
+            return True
+
+    def is_running(self):
+        future = self._future
+        return future is not None and not future.done()
+
+    def status(self):
+        """
+        Trạng thái hiện tại: dict gồm 'state' ('idle', 'running', 'done' hoặc 'failed'), 'stage', 'fraction',
+        'message', 'version' (khi xong) và 'error' (khi lỗi).
+        """
+        future = self._future
+        status = read_retraining_status(self.status_path) or {'stage': None, 'fraction': 0.0, 'message': None}
+        if future is None:
+            return {**status, 'state': 'idle'}
+        if not future.done():
+            return {**status, 'state': 'running'}
+        error = future.exception()
+        if error is not None:
+            return {**status, 'state': 'failed', 'error': str(error)}
+        return {**status, 'state': 'done', 'version': future.result()}
+
+    def take_result(self):
+        """Phiên bản mô hình mới nếu lần chạy vừa xong thành công và chưa được lấy; ngược lại None."""
+        with self._lock:
+            future = self._future
+            if future is None or not future.done() or self._result_taken or future.exception() is not None:
+                return None
+            self._result_taken = True
+            return future.result()
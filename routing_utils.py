@@ -1,10 +1,16 @@
 # routing_utils.py
 import osmnx as ox
+import networkx as nx
 import numpy as np
 import pandas as pd
 import re
-import geopandas as gpd # Đã import từ trước
-from config import MPH_TO_MPS, ROAD_TYPE_SPEED_MODIFIERS
+from config import MPH_TO_MPS, ROAD_TYPE_SPEED_MODIFIERS, ROUTING_ENGINE
+from edge_zones import NO_ZONE_ID, get_edge_location_ids
+from speed_table import FEATURE_COLUMNS, lookup_zone_speeds_mph
+
+ROUTING_ENGINES = ("dijkstra", "bidirectional", "astar")
+# Hệ số an toàn cho heuristic A*: bù sai số làm tròn float32 để heuristic luôn không vượt quá chi phí thật
+ASTAR_HEURISTIC_SLACK = 0.999
 
 # --- Hàm parse_maxspeed giữ nguyên ---
 def parse_maxspeed(maxspeed_str, default_speed_mph=None):
@@ -46,6 +52,106 @@ def get_fallback_speed_mps(target_hour, median_speed_by_hour_series):
     return max(speed_mps, 0.1 * MPH_TO_MPS)
 
 
+def predict_zone_speeds_mph(ml_model, ml_preprocessor, location_ids, target_hour, target_day_numeric):
+    """Dự đoán tốc độ (mph) cho nhiều LocationID trong một lần transform/predict duy nhất."""
+    location_ids = np.asarray(location_ids, dtype=np.int64)
+    if location_ids.size == 0:
+        return np.empty(0, dtype=float)
+    X_pred_df = pd.DataFrame({
+        'PULocationID': location_ids,
+        'pickup_hour': np.full(location_ids.size, target_hour, dtype=np.int64),
+        'pickup_day_of_week': np.full(location_ids.size, target_day_numeric, dtype=np.int64),
+    }, columns=FEATURE_COLUMNS)
+    X_pred_processed = ml_preprocessor.transform(X_pred_df)
+    return np.asarray(ml_model.predict(X_pred_processed), dtype=float)
+
+
+def get_edge_speed_attributes(G):
+    """
+    Trích xuất các thuộc tính không phụ thuộc thời gian của cạnh thành mảng numpy (theo thứ tự G.edges):
+    độ dài (m), hệ số loại đường và maxspeed (m/s, NaN nếu không có).
+    """
+    num_edges = G.number_of_edges()
+    lengths_m = np.full(num_edges, np.nan, dtype=float)
+    modifiers = np.empty(num_edges, dtype=float)
+    max_speeds_mps = np.full(num_edges, np.nan, dtype=float)
+    default_modifier = ROAD_TYPE_SPEED_MODIFIERS['default']
+
+    for i, (_, _, data_edge_G) in enumerate(G.edges(data=True)):
+        length_m = data_edge_G.get('length')
+        if length_m is not None:
+            lengths_m[i] = float(length_m)
+
+        highway_attr = data_edge_G.get('highway', 'default')
+        if isinstance(highway_attr, list):
+            highway_type = highway_attr[0] if highway_attr else 'default'
+        else:
+            highway_type = highway_attr
+        modifiers[i] = ROAD_TYPE_SPEED_MODIFIERS.get(highway_type, default_modifier)
+
+        parsed_max_speed_mph = parse_maxspeed(data_edge_G.get('maxspeed'))
+        if parsed_max_speed_mph is not None and parsed_max_speed_mph > 0:
+            max_speeds_mps[i] = parsed_max_speed_mph * MPH_TO_MPS
+
+    return lengths_m, modifiers, max_speeds_mps
+
+
+def compute_travel_times_from_base_speeds(base_speed_mph, lengths_m, modifiers, max_speeds_mps):
+    """Tính travel_time (giây) cho mọi cạnh từ tốc độ cơ sở (mph), hệ số loại đường và maxspeed."""
+    min_speed_mps = 0.1 * MPH_TO_MPS
+    base_speed_mps = np.maximum(np.asarray(base_speed_mph, dtype=float) * MPH_TO_MPS, min_speed_mps)
+    effective_speed_mps = base_speed_mps * modifiers
+    has_max_speed = ~np.isnan(max_speeds_mps)
+    effective_speed_mps[has_max_speed] = np.minimum(max_speeds_mps[has_max_speed], effective_speed_mps[has_max_speed])
+    effective_speed_mps[~(effective_speed_mps > 0)] = min_speed_mps
+
+    travel_times = lengths_m / effective_speed_mps
+    travel_times[np.isnan(travel_times)] = float('inf') # Cạnh không có 'length'
+    return travel_times
+
+
+def compute_base_speeds_mph(
+    edge_location_ids,
+    target_hour,
+    target_day_numeric,
+    fallback_median_speed_by_hour,
+    speed_table=None,
+    ml_model=None,
+    ml_preprocessor=None
+):
+    """
+    Tính tốc độ cơ sở (mph) cho từng cạnh từ mảng LocationID của cạnh: tra bảng tốc độ (hoặc dự đoán
+    trong một lần gọi model) cho các LocationID duy nhất, dùng fallback speed cho các cạnh còn lại.
+    Trả về (mảng tốc độ, số cạnh dùng tốc độ ML).
+    """
+    fallback_speed_mph = get_fallback_speed_mps(target_hour, fallback_median_speed_by_hour) / MPH_TO_MPS
+    base_speed_mph_by_edge = np.full(len(edge_location_ids), fallback_speed_mph, dtype=float)
+    has_zone_mask = edge_location_ids != NO_ZONE_ID
+    if (speed_table is None and ml_model is None) or not has_zone_mask.any():
+        return base_speed_mph_by_edge, 0
+
+    unique_location_ids, edge_to_unique = np.unique(
+        edge_location_ids[has_zone_mask], return_inverse=True
+    )
+    try:
+        if speed_table is not None:
+            predicted_speeds_mph = lookup_zone_speeds_mph(
+                speed_table, unique_location_ids, target_hour, target_day_numeric
+            )
+        else:
+            predicted_speeds_mph = predict_zone_speeds_mph(
+                ml_model, ml_preprocessor, unique_location_ids, target_hour, target_day_numeric
+            )
+    except Exception as e_predict:
+        print(f"Lỗi khi dự đoán tốc độ theo lô: {e_predict}. Dùng fallback speed cho toàn bộ các cạnh.")
+        return base_speed_mph_by_edge, 0
+
+    predicted_by_edge = predicted_speeds_mph[edge_to_unique]
+    has_prediction = ~np.isnan(predicted_by_edge) # LocationID không có trong bảng -> fallback
+    base_speed_mph_by_edge[np.flatnonzero(has_zone_mask)[has_prediction]] = predicted_by_edge[has_prediction]
+    return base_speed_mph_by_edge, int(has_prediction.sum())
+
+
 def add_travel_times_to_graph(
     G, 
     target_hour, 
@@ -53,65 +159,20 @@ def add_travel_times_to_graph(
     ml_model,                 
     ml_preprocessor,          
     taxi_zones_gdf_input, # Đổi tên để phân biệt với bản đã reproject     
-    fallback_median_speed_by_hour 
+    fallback_median_speed_by_hour,
+    speed_table=None # Bảng tốc độ tính sẵn (speed_table.py); nếu có thì không cần ml_model/ml_preprocessor
 ):
-    if G is None or ml_model is None or ml_preprocessor is None or taxi_zones_gdf_input is None:
-        print("Lỗi: Thiếu đồ thị G, mô hình ML, preprocessor hoặc taxi_zones_gdf_input.")
+    has_speed_source = speed_table is not None or (ml_model is not None and ml_preprocessor is not None)
+    if G is None or not has_speed_source or taxi_zones_gdf_input is None:
+        print("Lỗi: Thiếu đồ thị G, bảng tốc độ (hoặc mô hình ML và preprocessor) hoặc taxi_zones_gdf_input.")
         return G 
 
-    print(f"\nĐang cập nhật 'travel_time' sử dụng mô hình ML cho giờ {target_hour}, ngày {target_day_numeric}...")
+    speed_source_name = "bảng tốc độ tính sẵn" if speed_table is not None else "mô hình ML"
+    print(f"\nĐang cập nhật 'travel_time' sử dụng {speed_source_name} cho giờ {target_hour}, ngày {target_day_numeric}...")
 
-    # 1. Chuẩn bị gdf_edges và taxi_zones_gdf cho spatial join
+    # 1-2. Lấy LocationID của từng cạnh (spatial join chỉ chạy một lần cho mỗi cặp đồ thị/shapefile)
     try:
-        # Lấy GeoDataFrame của các cạnh từ đồ thị G
-        # G.graph['crs'] thường là EPSG:4326 (WGS84 Geographic)
-        current_graph_crs = G.graph.get('crs')
-        if current_graph_crs is None:
-            print("Cảnh báo: Đồ thị G không có thông tin CRS. Giả định là EPSG:4326.")
-            current_graph_crs = "EPSG:4326"
-
-        # Chuyển đổi G sang GeoDataFrames cho các cạnh
-        # Quan trọng: không lấy nodes ở đây để tránh thay đổi G.graph['crs'] nếu G được chiếu
-        _ , gdf_edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
-        gdf_edges = gdf_edges.set_crs(current_graph_crs, allow_override=True) # Đảm bảo gdf_edges có CRS
-
-        # Chọn một Projected CRS phù hợp cho NYC (ví dụ: UTM Zone 18N, đơn vị mét)
-        PROJECTED_CRS = "EPSG:32618"
-
-        # Reproject gdf_edges và taxi_zones_gdf_input sang PROJECTED_CRS
-        print(f"Đang reproject dữ liệu sang CRS: {PROJECTED_CRS}...")
-        gdf_edges_proj = gdf_edges.to_crs(PROJECTED_CRS)
-        taxi_zones_gdf_proj = taxi_zones_gdf_input.to_crs(PROJECTED_CRS)
-        print("Reproject hoàn tất.")
-
-        # Tính tâm điểm (centroid) trên dữ liệu đã reproject -> sẽ chính xác hơn
-        gdf_edges_proj['centroid'] = gdf_edges_proj.geometry.centroid
-        
-        # Tạo GeoDataFrame chỉ chứa centroid để thực hiện spatial join
-        edges_centroids_gdf_proj = gpd.GeoDataFrame(
-            gdf_edges_proj.drop(columns=['geometry']), # Bỏ cột geometry cũ (LineString)
-            geometry=gdf_edges_proj['centroid'],      # Sử dụng cột centroid mới làm geometry
-            crs=PROJECTED_CRS
-        )
-
-        # 2. Thực hiện Spatial Join
-        # Chỉ lấy các cột cần thiết từ taxi_zones_gdf_proj
-        zones_to_join_proj = taxi_zones_gdf_proj[['LocationID', 'geometry']]
-        print("Đang thực hiện spatial join giữa các cạnh và khu vực taxi...")
-        # 'predicate' được ưu tiên hơn 'op' trong các phiên bản GeoPandas mới
-        edges_with_zones_info = gpd.sjoin(
-            edges_centroids_gdf_proj, 
-            zones_to_join_proj, 
-            how='left', 
-            predicate='within' 
-        )
-        # `edges_with_zones_info` sẽ có index là (u,v,key) từ `gdf_edges_proj` (và `gdf_edges`)
-        # và có thêm cột 'LocationID' và 'index_right' (từ taxi_zones_gdf_proj)
-        print("Spatial join hoàn tất.")
-        # print("5 dòng đầu của edges_with_zones_info (sau sjoin):")
-        # print(edges_with_zones_info[['LocationID', 'highway']].head())
-
-
+        edge_location_ids = get_edge_location_ids(G, taxi_zones_gdf_input)
     except Exception as e_spatial_ops:
         print(f"Lỗi nghiêm trọng trong quá trình chuẩn bị không gian hoặc spatial join: {e_spatial_ops}")
         print("Không thể tiếp tục gán travel_time dựa trên model.")
@@ -127,82 +188,66 @@ def add_travel_times_to_graph(
         return G
 
 
-    # 3. Lặp qua các cạnh của G để tính toán và gán travel_time
-    num_edges_fallback_speed = 0
-    num_edges_ml_speed = 0
-    fallback_speed_mps_value = get_fallback_speed_mps(target_hour, fallback_median_speed_by_hour)
+    # 3. Tra bảng tốc độ (hoặc dự đoán trong MỘT lần gọi model) cho các LocationID duy nhất
+    base_speed_mph_by_edge, num_edges_ml_speed = compute_base_speeds_mph(
+        edge_location_ids, target_hour, target_day_numeric, fallback_median_speed_by_hour,
+        speed_table=speed_table, ml_model=ml_model, ml_preprocessor=ml_preprocessor
+    )
+    num_edges_fallback_speed = len(edge_location_ids) - num_edges_ml_speed
 
-    for u, v, key, data_edge_G in G.edges(keys=True, data=True):
-        length_m = data_edge_G.get('length')
-        base_speed_mph_for_edge = None # Tốc độ cơ sở (mph) cho cạnh này, sẽ được dự đoán hoặc fallback
-        
-        try:
-            location_id_series = edges_with_zones_info.loc[(u,v,key), 'LocationID'] if (u,v,key) in edges_with_zones_info.index else pd.Series([pd.NA])
-            
-            # sjoin có thể trả về nhiều dòng nếu centroid nằm trên biên giới của nhiều zone (hiếm)
-            # Hoặc nếu một cạnh (u,v,key) không có trong edges_with_zones_info.index (do lỗi join)
-            # Lấy giá trị LocationID đầu tiên nếu là Series, hoặc giá trị đơn nếu không phải
-            location_id = None
-            if not isinstance(location_id_series, pd.Series): # Nếu chỉ là giá trị đơn
-                 location_id = location_id_series
-            elif not location_id_series.empty:
-                 location_id = location_id_series.iloc[0]
-
-
-            if pd.notna(location_id) and location_id is not None:
-                location_id = int(location_id)
-                X_pred_df = pd.DataFrame(
-                    [[location_id, target_hour, target_day_numeric]],
-                    columns=['PULocationID', 'pickup_hour', 'pickup_day_of_week']
-                )
-                X_pred_processed = ml_preprocessor.transform(X_pred_df)
-                predicted_speed_mph = ml_model.predict(X_pred_processed)[0]
-                base_speed_mph_for_edge = predicted_speed_mph
-                num_edges_ml_speed += 1
-            else: 
-                base_speed_mph_for_edge = fallback_median_speed_by_hour.loc[target_hour] if target_hour in fallback_median_speed_by_hour.index else fallback_median_speed_by_hour.median()
-                if pd.isna(base_speed_mph_for_edge): base_speed_mph_for_edge = 10.0
-                num_edges_fallback_speed += 1
-
-            base_speed_mps_for_edge_safe = max(base_speed_mph_for_edge * MPH_TO_MPS, 0.1 * MPH_TO_MPS)
-
-            effective_speed_mps = base_speed_mps_for_edge_safe
-            highway_attr = data_edge_G.get('highway', 'default')
-            if isinstance(highway_attr, list):
-                highway_type = highway_attr[0] if highway_attr else 'default'
-            else:
-                highway_type = highway_attr
-            
-            modifier = ROAD_TYPE_SPEED_MODIFIERS.get(highway_type, ROAD_TYPE_SPEED_MODIFIERS['default'])
-            speed_after_modifier_mps = base_speed_mps_for_edge_safe * modifier
-            
-            maxspeed_str = data_edge_G.get('maxspeed')
-            parsed_max_speed_mph = parse_maxspeed(maxspeed_str)
-
-            if parsed_max_speed_mph is not None and parsed_max_speed_mph > 0:
-                max_speed_mps_from_osm = parsed_max_speed_mph * MPH_TO_MPS
-                effective_speed_mps = min(max_speed_mps_from_osm, speed_after_modifier_mps)
-            else:
-                effective_speed_mps = speed_after_modifier_mps
-            
-            if effective_speed_mps <= 0:
-                effective_speed_mps = 0.1 * MPH_TO_MPS
+    # 4. Tính travel_time bằng numpy và gán ngược lại cho các cạnh của G
+    lengths_m, modifiers, max_speeds_mps = get_edge_speed_attributes(G)
+    travel_times = compute_travel_times_from_base_speeds(
+        base_speed_mph_by_edge, lengths_m, modifiers, max_speeds_mps
+    )
+    for (_, _, data_edge_G), travel_time in zip(G.edges(data=True), travel_times.tolist()):
+        data_edge_G['travel_time'] = travel_time
 
-            if length_m is not None:
-                length_m = float(length_m)
-                data_edge_G['travel_time'] = length_m / effective_speed_mps
-            else:
-                data_edge_G['travel_time'] = float('inf')
-
-        except Exception as e_edge_loop:
-            # print(f"Lỗi khi xử lý cạnh ({u},{v},{key}): {e_edge_loop}. Gán travel_time là vô cực.")
-            data_edge_G['travel_time'] = float('inf')
-            
     print(f"Hoàn tất cập nhật 'travel_time'. Số cạnh dùng ML speed: {num_edges_ml_speed}, dùng fallback speed: {num_edges_fallback_speed}")
     return G
 
-# --- Hàm calculate_eta_for_route giữ nguyên ---
-def calculate_eta_for_route(G_with_times, origin_node, destination_node):
+def max_edge_speed_mps(lengths_m, travel_times):
+    """
+    Tốc độ lớn nhất (m/s) trên mọi cạnh của một lớp travel_time (length / travel_time).
+    Chia khoảng cách đường chim bay cho giá trị này cho heuristic A* chấp nhận được (admissible).
+    Trả về inf nếu không có cạnh hợp lệ (heuristic khi đó bằng 0, A* trở thành Dijkstra).
+    """
+    lengths_m = np.asarray(lengths_m, dtype=np.float64)
+    travel_times = np.asarray(travel_times, dtype=np.float64)
+    valid = np.isfinite(travel_times) & (travel_times > 0) & np.isfinite(lengths_m)
+    if not valid.any():
+        return float('inf')
+    return float(np.max(lengths_m[valid] / travel_times[valid]))
+
+
+def find_route(G_with_times, origin_node, destination_node, method=ROUTING_ENGINE):
+    """Tìm lộ trình nhanh nhất theo 'travel_time' trên đồ thị networkx bằng thuật toán được chọn."""
+    if method == "dijkstra":
+        return ox.shortest_path(G_with_times, origin_node, destination_node, weight="travel_time")
+    try:
+        if method == "bidirectional":
+            _, route = nx.bidirectional_dijkstra(G_with_times, origin_node, destination_node, weight="travel_time")
+            return route
+        if method == "astar":
+            edge_lengths, edge_travel_times = zip(*(
+                (data.get('length', np.nan), data.get('travel_time', np.nan))
+                for _, _, data in G_with_times.edges(data=True)
+            ))
+            max_speed_mps = max_edge_speed_mps(edge_lengths, edge_travel_times) / ASTAR_HEURISTIC_SLACK
+            node_ids, node_y, node_x = zip(*((node, data['y'], data['x']) for node, data in G_with_times.nodes(data=True)))
+            dest_data = G_with_times.nodes[destination_node]
+            straight_line_m = ox.distance.great_circle(np.array(node_y), np.array(node_x), dest_data['y'], dest_data['x'])
+            lower_bound_seconds = dict(zip(node_ids, (straight_line_m / max_speed_mps).tolist()))
+            return nx.astar_path(
+                G_with_times, origin_node, destination_node,
+                heuristic=lambda node, _target: lower_bound_seconds[node], weight="travel_time"
+            )
+    except nx.NetworkXNoPath:
+        return None
+    raise ValueError(f"Thuật toán tìm đường không hợp lệ: '{method}'. Chọn một trong {ROUTING_ENGINES}.")
+
+
+def calculate_eta_for_route(G_with_times, origin_node, destination_node, method=ROUTING_ENGINE):
     # ... (Nội dung hàm giữ nguyên như lần sửa trước) ...
     if G_with_times is None or origin_node is None or destination_node is None:
         print("Lỗi: Thiếu thông tin đồ thị hoặc điểm đầu/cuối để tính ETA.")
@@ -212,7 +257,7 @@ def calculate_eta_for_route(G_with_times, origin_node, destination_node):
         return None, None
     try:
         print(f"Đang tìm lộ trình từ {origin_node} đến {destination_node} (sử dụng 'travel_time' làm trọng số)...")
-        route = ox.shortest_path(G_with_times, origin_node, destination_node, weight="travel_time")
+        route = find_route(G_with_times, origin_node, destination_node, method=method)
         if route:
             print("Tìm thấy lộ trình!")
             route_edges_gdf = ox.routing.route_to_gdf(G_with_times, route)
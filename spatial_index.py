@@ -0,0 +1,131 @@
+# spatial_index.py
+import numpy as np
+import osmnx as ox
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_M = 6371009 # Cùng bán kính với ox.distance.great_circle
+METERS_PER_DEGREE = EARTH_RADIUS_M * np.pi / 180
+
+
+class SpatialIndex:
+    """
+    Chỉ mục KD-tree trên toạ độ nút (và các đoạn hình học của cạnh) của một CompactGraph.
+    Toạ độ được chiếu phẳng (equirectangular, đơn vị mét) quanh vĩ độ trung bình của đồ thị -
+    sai số không đáng kể trong phạm vi một thành phố. Dựng một lần rồi dùng chung cho mọi truy vấn.
+    """
+
+    def __init__(self, compact_graph):
+        self.compact_graph = compact_graph
+        self.origin_lat = float(np.mean(compact_graph.node_y)) if compact_graph.num_nodes else 0.0
+        self.origin_lon = float(np.mean(compact_graph.node_x)) if compact_graph.num_nodes else 0.0
+        self.node_tree = cKDTree(self.project(compact_graph.node_y, compact_graph.node_x))
+        self._segments = None # Chỉ mục đoạn cạnh, dựng khi cần cho snap_to_edges
+
+    def project(self, lats, lons):
+        """Chiếu (lat, lon) sang toạ độ phẳng (mét), trả về mảng N × 2."""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        x = (lons - self.origin_lon) * np.cos(np.radians(self.origin_lat)) * METERS_PER_DEGREE
+        y = (lats - self.origin_lat) * METERS_PER_DEGREE
+        return np.column_stack((np.atleast_1d(x), np.atleast_1d(y)))
+
+    def snap_points(self, lats, lons):
+        """
+        Nút gần nhất cho nhiều toạ độ cùng lúc.
+        Trả về (mảng OSM node id int64, mảng khoảng cách snap theo đường tròn lớn, đơn vị mét).
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        _, node_indices = self.node_tree.query(self.project(lats, lons))
+        compact_graph = self.compact_graph
+        distances_m = ox.distance.great_circle(
+            lats, lons, compact_graph.node_y[node_indices], compact_graph.node_x[node_indices]
+        )
+        return compact_graph.node_ids[node_indices], np.asarray(distances_m, dtype=np.float64)
+
+    def _segment_index(self):
+        """KD-tree trên trung điểm các đoạn hình học của cạnh (mỗi cạnh gồm một hay nhiều đoạn)."""
+        if self._segments is None:
+            compact_graph = self.compact_graph
+            if compact_graph.geometry_indptr is not None:
+                geometry_xy = np.asarray(compact_graph.geometry_xy)
+                geometry_indptr = np.asarray(compact_graph.geometry_indptr, dtype=np.int64)
+                points = self.project(geometry_xy[:, 1], geometry_xy[:, 0])
+                point_edges = np.repeat(np.arange(compact_graph.num_edges), np.diff(geometry_indptr))
+                # Đoạn (i, i + 1) hợp lệ khi hai điểm thuộc cùng một cạnh
+                starts = np.flatnonzero(point_edges[:-1] == point_edges[1:])
+                segment_edges = point_edges[starts]
+                segment_starts, segment_ends = points[starts], points[starts + 1]
+            else:
+                node_points = self.project(compact_graph.node_y, compact_graph.node_x)
+                segment_edges = np.arange(compact_graph.num_edges)
+                segment_starts = node_points[compact_graph.edge_sources]
+                segment_ends = node_points[compact_graph.edge_targets]
+            segment_lengths = np.hypot(*(segment_ends - segment_starts).T)
+            # Quãng đường (mét, theo hình chiếu) từ đầu cạnh tới đầu mỗi đoạn
+            cumulative = np.cumsum(segment_lengths)
+            edge_first_segment = np.searchsorted(segment_edges, segment_edges, side='left')
+            offset_before = cumulative - segment_lengths - (cumulative[edge_first_segment] - segment_lengths[edge_first_segment])
+            edge_projected_lengths = np.bincount(segment_edges, weights=segment_lengths, minlength=compact_graph.num_edges)
+            self._segments = {
+                'tree': cKDTree((segment_starts + segment_ends) / 2),
+                'edges': segment_edges,
+                'starts': segment_starts,
+                'ends': segment_ends,
+                'lengths': segment_lengths,
+                'offset_before': offset_before,
+                'edge_projected_lengths': edge_projected_lengths,
+                'max_half_length': float(segment_lengths.max() / 2) if segment_lengths.size else 0.0,
+            }
+        return self._segments
+
+    def snap_to_edges(self, lats, lons):
+        """
+        Cạnh gần nhất cho nhiều toạ độ, kèm vị trí chiếu vuông góc trên cạnh.
+        Trả về dict các mảng: 'edge_indices' (chỉ số cạnh CSR), 'u'/'v' (OSM id hai đầu cạnh),
+        'offset_m' (quãng đường dọc cạnh từ u tới điểm chiếu, theo chiều dài OSM của cạnh),
+        'fraction' (0..1), 'distance_m' (khoảng cách snap) và 'snapped_lat'/'snapped_lon'.
+        """
+        segments = self._segment_index()
+        compact_graph = self.compact_graph
+        points = self.project(np.atleast_1d(lats), np.atleast_1d(lons))
+        num_points = points.shape[0]
+        edge_indices = np.full(num_points, -1, dtype=np.int64)
+        projected_offsets = np.zeros(num_points)
+        distances = np.full(num_points, np.inf)
+        snapped_points = np.zeros((num_points, 2))
+        if segments['edges'].size:
+            # Đoạn gần nhất chắc chắn nằm trong bán kính (khoảng cách tới trung điểm gần nhất + nửa đoạn dài nhất)
+            nearest_mid_distances, _ = segments['tree'].query(points)
+            for i, point in enumerate(points):
+                candidates = np.asarray(
+                    segments['tree'].query_ball_point(point, nearest_mid_distances[i] + segments['max_half_length'])
+                )
+                starts, ends = segments['starts'][candidates], segments['ends'][candidates]
+                directions = ends - starts
+                squared_lengths = np.maximum((directions ** 2).sum(axis=1), 1e-12)
+                t = np.clip(((point - starts) * directions).sum(axis=1) / squared_lengths, 0.0, 1.0)
+                projections = starts + t[:, None] * directions
+                candidate_distances = np.hypot(*(projections - point).T)
+                best = int(np.argmin(candidate_distances))
+                segment = candidates[best]
+                edge_indices[i] = segments['edges'][segment]
+                projected_offsets[i] = segments['offset_before'][segment] + t[best] * segments['lengths'][segment]
+                distances[i] = candidate_distances[best]
+                snapped_points[i] = projections[best]
+
+        valid = edge_indices >= 0
+        safe_edges = np.where(valid, edge_indices, 0)
+        projected_lengths = segments['edge_projected_lengths'][safe_edges]
+        fraction = np.where(projected_lengths > 0, projected_offsets / np.maximum(projected_lengths, 1e-12), 0.0)
+        cos_lat = np.cos(np.radians(self.origin_lat))
+        return {
+            'edge_indices': edge_indices,
+            'u': np.where(valid, compact_graph.node_ids[compact_graph.edge_sources[safe_edges]], -1),
+            'v': np.where(valid, compact_graph.node_ids[compact_graph.edge_targets[safe_edges]], -1),
+            'offset_m': fraction * compact_graph.lengths_m[safe_edges].astype(np.float64),
+            'fraction': fraction,
+            'distance_m': distances,
+            'snapped_lat': self.origin_lat + snapped_points[:, 1] / METERS_PER_DEGREE,
+            'snapped_lon': self.origin_lon + snapped_points[:, 0] / (METERS_PER_DEGREE * cos_lat),
+        }
@@ -0,0 +1,388 @@
+# speed_aggregates.py
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from config import (
+    YELLOW_TAXI_DATA_FILE, TRIP_DATA_MONTHS, TRIP_DATA_BATCH_SIZE, DATA_PREPARATION_WORKERS,
+    MIN_AVG_SPEED_MPH, MAX_AVG_SPEED_MPH, SPEED_AGGREGATES_PATH
+)
+from data_loader import (
+    iter_row_group_batches, resolve_trip_data_files, trip_data_month, trip_data_row_group_counts
+)
+
+SPEED_BIN_WIDTH_MPH = 0.1 # Trung vị ước lượng từ histogram sai lệch dưới một bin (mỗi phần tử giữa chỉ biết nằm trong bin nào)
+NUM_SPEED_BINS = int(np.ceil((MAX_AVG_SPEED_MPH - MIN_AVG_SPEED_MPH) / SPEED_BIN_WIDTH_MPH)) + 1
+NUM_ZONE_IDS = 266 # LocationID của TLC: 1..265
+HOURS_PER_DAY = 24
+DAYS_PER_WEEK = 7
+# Tên các chiều nhóm, trùng tên cột trong dữ liệu huấn luyện ML
+GROUP_COLUMNS = ('PULocationID', 'pickup_hour', 'pickup_day_of_week')
+_GROUP_SIZES = (NUM_ZONE_IDS, HOURS_PER_DAY, DAYS_PER_WEEK)
+SPEED_AGGREGATES_VERSION = 1 # Tăng khi đổi định dạng kho hoặc cách chia bin
+
+
+class SpeedHistogram:
+    """
+    Histogram tốc độ trung bình (mph) theo ô (zone đón, giờ, ngày trong tuần) với các bin cố định.
+    Chỉ lưu các ô/bin có chuyến (khóa int64 đã sắp xếp + số chuyến), nên kích thước không phụ thuộc
+    số chuyến đã gộp. Hai histogram cộng được với nhau (merge), vì vậy có thể gộp dần từng lô, từng tháng
+    rồi trả lời trung vị theo bất kỳ tổ hợp chiều nào mà không cần giữ chuyến đi thô.
+    source_files: tên file dữ liệu -> tháng ("YYYY-MM" hoặc None) của các file đã gộp vào histogram.
+    """
+
+    def __init__(self, cell_keys=None, counts=None, source_files=None):
+        self.cell_keys = np.empty(0, dtype=np.int64) if cell_keys is None else np.asarray(cell_keys, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.source_files = dict(source_files or {})
+
+    @property
+    def num_trips(self):
+        return int(self.counts.sum())
+
+    @property
+    def months(self):
+        """Các tháng (đã sắp xếp) của những file đã gộp vào histogram."""
+        return sorted({month for month in self.source_files.values() if month})
+
+    def add_trips(self, df_trips):
+        """
+        Cộng một lô chuyến đi đã làm sạch (cần PULocationID, average_speed_mph và pickup_hour/pickup_day_of_week
+        hoặc tpep_pickup_datetime).
+        """
+        if df_trips is None or df_trips.empty:
+            return self
+        if 'pickup_hour' in df_trips.columns and 'pickup_day_of_week' in df_trips.columns:
+            hours = df_trips['pickup_hour'].to_numpy(dtype=np.int64)
+            days = df_trips['pickup_day_of_week'].to_numpy(dtype=np.int64)
+        else:
+            pickup_times = pd.to_datetime(df_trips['tpep_pickup_datetime'])
+            hours = pickup_times.dt.hour.to_numpy(dtype=np.int64)
+            days = pickup_times.dt.dayofweek.to_numpy(dtype=np.int64)
+        zones = df_trips['PULocationID'].to_numpy(dtype=np.int64)
+        speeds = df_trips['average_speed_mph'].to_numpy(dtype=np.float64)
+        valid = (zones >= 0) & (zones < NUM_ZONE_IDS) & np.isfinite(speeds)
+        speed_bins = np.clip(
+            np.floor((speeds[valid] - MIN_AVG_SPEED_MPH) / SPEED_BIN_WIDTH_MPH), 0, NUM_SPEED_BINS - 1
+        ).astype(np.int64)
+        cells = self._cell_index(zones[valid], hours[valid], days[valid])
+        keys, counts = np.unique(cells * NUM_SPEED_BINS + speed_bins, return_counts=True)
+        return self._add_counts(keys, counts)
+
+    def merge(self, other):
+        """Cộng dồn histogram khác vào histogram này."""
+        self.source_files.update(other.source_files)
+        return self._add_counts(other.cell_keys, other.counts)
+
+    @classmethod
+    def merged(cls, histograms):
+        """Tổng của nhiều histogram, gộp một lượt."""
+        histograms = list(histograms)
+        if not histograms:
+            return cls()
+        source_files = {}
+        for histogram in histograms:
+            source_files.update(histogram.source_files)
+        return cls(source_files=source_files)._add_counts(
+            np.concatenate([histogram.cell_keys for histogram in histograms]),
+            np.concatenate([histogram.counts for histogram in histograms])
+        )
+
+    def _add_counts(self, keys, counts):
+        all_keys = np.concatenate((self.cell_keys, keys))
+        all_counts = np.concatenate((self.counts, counts))
+        self.cell_keys, inverse = np.unique(all_keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=all_counts, minlength=self.cell_keys.size).astype(np.int64)
+        return self
+
+    @staticmethod
+    def _cell_index(zones, hours, days):
+        return (zones * HOURS_PER_DAY + hours) * DAYS_PER_WEEK + days
+
+    def _decode(self):
+        """Tách khóa thành (zone, giờ, ngày, bin tốc độ)."""
+        cells, speed_bins = np.divmod(self.cell_keys, NUM_SPEED_BINS)
+        zone_hours, days = np.divmod(cells, DAYS_PER_WEEK)
+        zones, hours = np.divmod(zone_hours, HOURS_PER_DAY)
+        return {'PULocationID': zones, 'pickup_hour': hours, 'pickup_day_of_week': days}, speed_bins
+
+    def medians(self, by=GROUP_COLUMNS):
+        """
+        Trung vị tốc độ (mph) cho từng nhóm theo các chiều trong by (tập con của GROUP_COLUMNS),
+        ước lượng từ bin chứa trung vị. Trả về Series (MultiIndex nếu nhiều chiều).
+        """
+        by = list(by)
+        if self.cell_keys.size == 0:
+            return pd.Series(dtype='float64')
+        dimensions, speed_bins = self._decode()
+        group_keys = np.zeros(self.cell_keys.size, dtype=np.int64)
+        for column in by:
+            group_keys = group_keys * _GROUP_SIZES[GROUP_COLUMNS.index(column)] + dimensions[column]
+
+        # Gộp số chuyến theo (nhóm, bin) rồi tính tích luỹ trong từng nhóm (khóa đã sắp xếp theo nhóm, bin)
+        group_bin_keys, inverse = np.unique(group_keys * NUM_SPEED_BINS + speed_bins, return_inverse=True)
+        bin_counts = np.bincount(inverse, weights=self.counts)
+        groups, bins = np.divmod(group_bin_keys, NUM_SPEED_BINS)
+        unique_groups, group_starts, group_sizes = np.unique(groups, return_index=True, return_counts=True)
+        cumulative = np.cumsum(bin_counts)
+        before_group = np.repeat(cumulative[group_starts] - bin_counts[group_starts], group_sizes)
+        cumulative_in_group = cumulative - before_group
+        group_totals = cumulative[group_starts + group_sizes - 1] - before_group[group_starts]
+
+        # Như pandas: trung vị là phần tử giữa (số chuyến lẻ) hoặc trung bình hai phần tử giữa (số chuyến chẵn);
+        # phần tử thứ k trong một bin có c chuyến được ước lượng ở vị trí (k - 0.5) / c của bin
+        medians = (
+            self._rank_values(np.floor((group_totals + 1) / 2), groups, bins, bin_counts, cumulative_in_group, group_sizes)
+            + self._rank_values(np.ceil((group_totals + 1) / 2), groups, bins, bin_counts, cumulative_in_group, group_sizes)
+        ) / 2
+
+        columns = {}
+        remaining = unique_groups
+        for column in reversed(by):
+            remaining, columns[column] = np.divmod(remaining, _GROUP_SIZES[GROUP_COLUMNS.index(column)])
+        if len(by) == 1:
+            index = pd.Index(columns[by[0]], name=by[0])
+        else:
+            index = pd.MultiIndex.from_arrays([columns[column] for column in by], names=by)
+        return pd.Series(np.minimum(medians, MAX_AVG_SPEED_MPH), index=index, name='median_speed_mph')
+
+    @staticmethod
+    def _rank_values(ranks, groups, bins, bin_counts, cumulative_in_group, group_sizes):
+        """Giá trị (mph) ước lượng của phần tử hạng ranks[g] (tính từ 1) trong từng nhóm g."""
+        reached = np.flatnonzero(cumulative_in_group >= np.repeat(ranks, group_sizes))
+        _, first = np.unique(groups[reached], return_index=True)
+        rows = reached[first]
+        below = cumulative_in_group[rows] - bin_counts[rows]
+        return MIN_AVG_SPEED_MPH + SPEED_BIN_WIDTH_MPH * (bins[rows] + (ranks - below - 0.5) / bin_counts[rows])
+
+    def median_speed_by_hour(self):
+        """Tốc độ trung vị theo giờ (0-23), như kết quả đầu tiên của calculate_median_speed_by_time."""
+        return self.medians(['pickup_hour'])
+
+    def training_frame(self):
+        """Dữ liệu huấn luyện ML giống create_ml_training_data: trung vị theo (PULocationID, giờ, ngày)."""
+        medians = self.medians(GROUP_COLUMNS)
+        if medians.empty:
+            return pd.DataFrame()
+        return medians.rename('target_median_speed_mph').reset_index()
+
+
+def _aggregate_shard(file_path, row_groups, location_ids, batch_size):
+    """Histogram tốc độ của một phần việc (vài row group của một file); chạy được trong tiến trình con."""
+    histogram = SpeedHistogram()
+    for df_batch in iter_row_group_batches(file_path, row_groups, location_ids, batch_size):
+        histogram.add_trips(df_batch)
+    return histogram
+
+
+def aggregate_files(file_paths, location_ids=None, workers=DATA_PREPARATION_WORKERS, batch_size=TRIP_DATA_BATCH_SIZE,
+                    on_file_done=None):
+    """
+    Histogram tốc độ riêng cho từng file Parquet. Mỗi row group của mọi file là một phần việc; với workers > 1
+    (None = số lõi CPU) các phần việc chạy song song trên một pool tiến trình, mỗi tiến trình đọc theo lô và trả về
+    histogram của phần mình, rồi được cộng vào histogram của file tương ứng. Bộ nhớ đỉnh ~ workers × một lô.
+    on_file_done(file_path, histogram) được gọi ngay khi một file xong. Trả về dict file_path -> SpeedHistogram
+    (file đọc lỗi bị bỏ qua kèm thông báo).
+    """
+    row_group_counts = trip_data_row_group_counts(file_paths)
+    shards = [(file_path, [row_group]) for file_path, count in row_group_counts.items() for row_group in range(count)]
+    remaining = {file_path: count for file_path, count in row_group_counts.items()}
+    partials = {file_path: [] for file_path in row_group_counts}
+    failed = set()
+    results = {}
+
+    def collect(file_path, histogram=None, error=None):
+        if error is not None:
+            print(f"Lỗi khi đọc file dữ liệu taxi {file_path}: {error}")
+            failed.add(file_path)
+        else:
+            partials[file_path].append(histogram)
+        remaining[file_path] -= 1
+        if remaining[file_path] == 0 and file_path not in failed:
+            results[file_path] = SpeedHistogram.merged(partials.pop(file_path))
+            results[file_path].source_files = {os.path.basename(file_path): trip_data_month(file_path)}
+            print(f"Đã gộp tốc độ của {results[file_path].num_trips} chuyến đi từ {os.path.basename(file_path)}.")
+            if on_file_done is not None:
+                on_file_done(file_path, results[file_path])
+
+    for file_path in [file_path for file_path, count in row_group_counts.items() if count == 0]:
+        remaining[file_path] = 1 # File không có dòng nào: coi như một phần việc rỗng
+        collect(file_path, SpeedHistogram())
+
+    workers = (os.cpu_count() or 1) if workers is None else max(int(workers), 1)
+    if workers == 1 or len(shards) <= 1:
+        for file_path, row_groups in shards:
+            try:
+                collect(file_path, _aggregate_shard(file_path, row_groups, location_ids, batch_size))
+            except Exception as e:
+                collect(file_path, error=e)
+    else:
+        workers = min(workers, len(shards))
+        print(f"Đang chuẩn bị dữ liệu song song: {len(shards)} row group trên {workers} tiến trình...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_aggregate_shard, file_path, row_groups, location_ids, batch_size): file_path
+                for file_path, row_groups in shards
+            }
+            for future in as_completed(futures):
+                try:
+                    collect(futures[future], future.result())
+                except Exception as e:
+                    collect(futures[future], error=e)
+    return results
+
+
+def aggregate_trip_speeds(trip_data_path=YELLOW_TAXI_DATA_FILE, location_ids=None, months=TRIP_DATA_MONTHS,
+                          batch_size=TRIP_DATA_BATCH_SIZE, workers=DATA_PREPARATION_WORKERS):
+    """
+    Gộp tốc độ các chuyến đi (file, thư mục hoặc glob nhiều tháng) vào một SpeedHistogram, từng lô một
+    (song song theo row group nếu workers khác 1): bộ nhớ chỉ phụ thuộc kích thước lô và số ô histogram.
+    Trả về None nếu không đọc được dữ liệu.
+    """
+    file_paths = resolve_trip_data_files(trip_data_path, months)
+    if not file_paths:
+        print(f"LỖI: Không tìm thấy file taxi nào tại {trip_data_path}" + (f" trong các tháng {months}." if months else "."))
+        return None
+    file_histograms = aggregate_files(file_paths, location_ids, workers, batch_size)
+    if not file_histograms:
+        return None
+    histogram = SpeedHistogram.merged(file_histograms.values())
+    print(f"Đã gộp tốc độ của {histogram.num_trips} chuyến đi vào {histogram.cell_keys.size} bin histogram.")
+    return histogram
+
+
+class SpeedAggregateStore:
+    """
+    Kho histogram tốc độ lưu trên đĩa: một SpeedHistogram cho mỗi file dữ liệu (thường là một tháng) đã gộp,
+    kèm kích thước/thời điểm sửa file để biết file nào mới hoặc đã thay đổi. Thêm tháng mới chỉ cần đọc file
+    của tháng đó; trung vị được tính từ histogram, không cần chuyến đi thô (file gốc có thể đã bị xoá).
+    """
+
+    def __init__(self, location_ids=None, file_info=None, file_histograms=None):
+        self.location_ids = None if location_ids is None else sorted({int(location_id) for location_id in location_ids})
+        self.file_info = dict(file_info or {}) # tên file -> {'month', 'size', 'mtime_ns'}
+        self.file_histograms = dict(file_histograms or {}) # tên file -> SpeedHistogram
+
+    @classmethod
+    def load(cls, path=SPEED_AGGREGATES_PATH):
+        """Đọc kho từ file .npz; None nếu chưa có, hỏng hoặc khác phiên bản."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                if meta.get('version') != SPEED_AGGREGATES_VERSION or meta.get('bin_width_mph') != SPEED_BIN_WIDTH_MPH:
+                    print(f"Cảnh báo: Kho tốc độ tại {path} khác phiên bản, sẽ gộp lại từ đầu.")
+                    return None
+                file_histograms = {
+                    info['name']: SpeedHistogram(data[f"cell_keys_{i}"], data[f"counts_{i}"], {info['name']: info['month']})
+                    for i, info in enumerate(meta['files'])
+                }
+        except Exception as e:
+            print(f"Cảnh báo: Không đọc được kho tốc độ ({path}): {e}")
+            return None
+        file_info = {info['name']: {key: info[key] for key in ('month', 'size', 'mtime_ns')} for info in meta['files']}
+        return cls(meta['location_ids'], file_info, file_histograms)
+
+    def save(self, path=SPEED_AGGREGATES_PATH):
+        """Ghi kho ra file .npz (ghi file tạm rồi đổi tên)."""
+        names = sorted(self.file_histograms)
+        meta = {
+            'version': SPEED_AGGREGATES_VERSION,
+            'bin_width_mph': SPEED_BIN_WIDTH_MPH,
+            'location_ids': self.location_ids,
+            'files': [dict(name=name, **self.file_info[name]) for name in names],
+        }
+        arrays = {'meta': np.array(json.dumps(meta))}
+        for i, name in enumerate(names):
+            arrays[f"cell_keys_{i}"] = self.file_histograms[name].cell_keys
+            arrays[f"counts_{i}"] = self.file_histograms[name].counts
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _file_signature(file_path):
+        stat = os.stat(file_path)
+        return {'month': trip_data_month(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def is_current(self, file_path):
+        """File đã được gộp và không thay đổi kể từ đó."""
+        return self.file_info.get(os.path.basename(file_path)) == self._file_signature(file_path)
+
+    def add_file_histogram(self, file_path, histogram):
+        """Thay histogram của một file dữ liệu trong kho (kèm chữ ký hiện tại của file)."""
+        name = os.path.basename(file_path)
+        self.file_histograms[name] = histogram
+        self.file_info[name] = self._file_signature(file_path)
+
+    def histogram(self, months=None, names=None):
+        """
+        Histogram tổng của các file đã gộp: chỉ các file có tháng trong months=(đầu, cuối) và có tên trong
+        names (nếu truyền vào). source_files của kết quả cho biết chính xác các file/tháng đã được cộng.
+        """
+        selected_names = [
+            name for name, info in self.file_info.items()
+            if (months is None or (info['month'] is not None and months[0] <= info['month'] <= months[1]))
+            and (names is None or name in names)
+        ]
+        return SpeedHistogram.merged(self.file_histograms[name] for name in selected_names)
+
+
+def update_speed_aggregates(trip_data_path=YELLOW_TAXI_DATA_FILE, location_ids=None, months=TRIP_DATA_MONTHS,
+                            store_path=SPEED_AGGREGATES_PATH, batch_size=TRIP_DATA_BATCH_SIZE,
+                            workers=DATA_PREPARATION_WORKERS):
+    """
+    Gộp vào kho các file dữ liệu (file, thư mục hoặc glob) mới hoặc đã thay đổi (song song theo row group,
+    xem aggregate_files), lưu kho sau mỗi file xong, rồi trả về SpeedHistogram chỉ của các file tìm thấy
+    tại trip_data_path trong khoảng months (kho có thể còn giữ file của lần chạy khác, chúng không được cộng;
+    xem source_files của kết quả). File đã gộp và không đổi không bị đọc lại.
+    Kho dựng cho bộ location_ids khác sẽ được gộp lại từ đầu. Trả về None nếu kho rỗng và không đọc được dữ liệu.
+    """
+    store = SpeedAggregateStore.load(store_path) if store_path else None
+    requested_ids = None if location_ids is None else sorted({int(location_id) for location_id in location_ids})
+    if store is not None and store.location_ids != requested_ids:
+        print("LƯU Ý: Kho tốc độ được gộp cho bộ LocationID khác, sẽ gộp lại từ đầu.")
+        store = None
+    if store is None:
+        store = SpeedAggregateStore(requested_ids)
+
+    file_paths = resolve_trip_data_files(trip_data_path, months)
+    pending_files = [file_path for file_path in file_paths if not store.is_current(file_path)]
+
+    def fold_into_store(file_path, histogram):
+        store.add_file_histogram(file_path, histogram)
+        if store_path:
+            try:
+                store.save(store_path)
+            except OSError as e:
+                print(f"Cảnh báo: Không lưu được kho tốc độ: {e}")
+
+    if pending_files:
+        print(f"Đang gộp {len(pending_files)} file mới/đã thay đổi vào kho tốc độ...")
+        aggregate_files(pending_files, store.location_ids, workers, batch_size, on_file_done=fold_into_store)
+    if not pending_files and store.file_histograms:
+        print(f"Kho tốc độ đã cập nhật ({len(store.file_info)} file), không cần đọc dữ liệu chuyến đi.")
+
+    # File đọc lỗi (chưa gộp được bản hiện tại) bị loại khỏi kết quả
+    requested_names = {os.path.basename(file_path) for file_path in file_paths if store.is_current(file_path)}
+    if not requested_names:
+        print(f"LỖI: Chưa có dữ liệu tốc độ nào cho {trip_data_path}.")
+        return None
+    return store.histogram(months, requested_names)
+
+
+if __name__ == '__main__':
+    # Gộp các tháng mới vào kho tốc độ (chạy mỗi khi có thêm file dữ liệu tháng)
+    from data_loader import load_taxi_zones
+    from data_processor import filter_taxi_zones_by_borough
+
+    _, manhattan_ids_store = filter_taxi_zones_by_borough(load_taxi_zones())
+    speed_histogram_store = update_speed_aggregates(location_ids=manhattan_ids_store)
+    if speed_histogram_store is not None:
+        print(f"Kho tốc độ gồm {speed_histogram_store.num_trips} chuyến đi.")
+        print("Tốc độ trung vị theo giờ (mph):\n", speed_histogram_store.median_speed_by_hour())
@@ -0,0 +1,193 @@
+# speed_table.py
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import joblib
+from config import MODEL_PATH, PREPROCESSOR_PATH, SPEED_TABLE_PATH, FALLBACK_SPEEDS_PATH, MODEL_REGISTRY_DIR
+
+HOURS_PER_DAY = 24
+DAYS_PER_WEEK = 7
+FEATURE_COLUMNS = ['PULocationID', 'pickup_hour', 'pickup_day_of_week']
+FALLBACK_SPEEDS_VERSION = 1 # Tăng khi đổi định dạng file tốc độ fallback
+DEFAULT_FALLBACK_SPEED_MPH = 10.0
+
+
+def build_speed_table(ml_model, ml_preprocessor, location_ids):
+    """
+    Đánh giá mô hình ML trên toàn bộ miền (LocationID × giờ × ngày trong tuần) bằng một lần predict
+    và trả về bảng tốc độ dạng mảng: {'location_ids': (Z,), 'speeds_mph': (Z, 24, 7)}.
+    """
+    zone_ids = np.unique(np.asarray(location_ids, dtype=np.int64))
+    if zone_ids.size == 0:
+        print("Lỗi: Không có LocationID nào để xây dựng bảng tốc độ.")
+        return None
+
+    zone_grid, hour_grid, day_grid = np.meshgrid(
+        zone_ids, np.arange(HOURS_PER_DAY), np.arange(DAYS_PER_WEEK), indexing='ij'
+    )
+    X_domain_df = pd.DataFrame({
+        'PULocationID': zone_grid.ravel(),
+        'pickup_hour': hour_grid.ravel(),
+        'pickup_day_of_week': day_grid.ravel(),
+    }, columns=FEATURE_COLUMNS)
+    print(f"Đang dự đoán tốc độ cho {len(X_domain_df)} tổ hợp (zone, giờ, ngày)...")
+    predicted_speeds_mph = ml_model.predict(ml_preprocessor.transform(X_domain_df))
+
+    speed_table = {
+        'location_ids': zone_ids.astype(np.int16),
+        'speeds_mph': np.asarray(predicted_speeds_mph, dtype=np.float32).reshape(
+            zone_ids.size, HOURS_PER_DAY, DAYS_PER_WEEK
+        ),
+    }
+    return _with_zone_index(speed_table)
+
+
+def _with_zone_index(speed_table):
+    """Thêm mảng tra cứu trực tiếp LocationID -> vị trí trong bảng (-1 nếu không có)."""
+    location_ids = speed_table['location_ids'].astype(np.int64)
+    zone_index = np.full(int(location_ids.max()) + 1, -1, dtype=np.int16)
+    zone_index[location_ids] = np.arange(location_ids.size, dtype=np.int16)
+    speed_table['zone_index'] = zone_index
+    return speed_table
+
+
+def save_speed_table(speed_table, path=SPEED_TABLE_PATH):
+    """Lưu bảng tốc độ ra file .npz (chỉ lưu location_ids và speeds_mph)."""
+    np.savez(path, location_ids=speed_table['location_ids'], speeds_mph=speed_table['speeds_mph'])
+    print(f"Đã lưu bảng tốc độ ({speed_table['speeds_mph'].shape}) vào file: {path}")
+
+
+def load_speed_table(path=SPEED_TABLE_PATH):
+    """Tải bảng tốc độ đã tính trước từ file .npz."""
+    try:
+        with np.load(path) as data:
+            speed_table = {'location_ids': data['location_ids'], 'speeds_mph': data['speeds_mph']}
+        return _with_zone_index(speed_table)
+    except FileNotFoundError:
+        print(f"LƯU Ý: Không tìm thấy bảng tốc độ tại {path}.")
+        return None
+    except Exception as e:
+        print(f"Lỗi khi đọc bảng tốc độ: {e}")
+        return None
+
+
+def lookup_zone_speeds_mph(speed_table, location_ids, target_hour, target_day_numeric):
+    """Tra tốc độ (mph) của nhiều LocationID bằng chỉ số mảng; NaN nếu LocationID không có trong bảng."""
+    location_ids = np.asarray(location_ids, dtype=np.int64)
+    zone_index = speed_table['zone_index']
+    positions = np.full(location_ids.shape, -1, dtype=np.int64)
+    in_range = (location_ids >= 0) & (location_ids < zone_index.size)
+    positions[in_range] = zone_index[location_ids[in_range]]
+
+    speeds_mph = np.full(location_ids.shape, np.nan, dtype=float)
+    found = positions >= 0
+    speeds_mph[found] = speed_table['speeds_mph'][positions[found], target_hour, target_day_numeric]
+    return speeds_mph
+
+
+def load_trained_model(registry_dir=MODEL_REGISTRY_DIR, model_path=MODEL_PATH, preprocessor_path=PREPROCESSOR_PATH):
+    """
+    (mô hình, preprocessor) từ bundle hiện tại của registry; nếu registry chưa có bundle thì đọc
+    file joblib rời theo định dạng cũ (ném FileNotFoundError nếu cũng không có).
+    """
+    from model_registry import load_model_bundle # Import muộn: model_registry dùng hằng số của module này
+    bundle = load_model_bundle(registry_dir=registry_dir)
+    if bundle is not None:
+        return bundle['model'], bundle['preprocessor']
+    print(f"LƯU Ý: Registry '{registry_dir}' chưa có bundle hợp lệ, đọc file mô hình cũ '{model_path}'.")
+    return joblib.load(model_path), joblib.load(preprocessor_path)
+
+
+def load_or_build_speed_table(location_ids, path=SPEED_TABLE_PATH, registry_dir=MODEL_REGISTRY_DIR):
+    """
+    Tải bảng tốc độ; nếu chưa có thì tải mô hình ML một lần để xây dựng và lưu bảng.
+    Mô hình không được giữ lại trong bộ nhớ sau khi xây dựng xong.
+    """
+    speed_table = load_speed_table(path)
+    if speed_table is not None:
+        return speed_table
+
+    print("Đang xây dựng bảng tốc độ từ mô hình ML đã huấn luyện...")
+    ml_model, ml_preprocessor = load_trained_model(registry_dir)
+    speed_table = build_speed_table(ml_model, ml_preprocessor, location_ids)
+    if speed_table is not None:
+        save_speed_table(speed_table, path)
+    return speed_table
+
+
+def default_fallback_speeds():
+    """Tốc độ fallback mặc định (mph) cho 24 giờ khi chưa có dữ liệu."""
+    return pd.Series([DEFAULT_FALLBACK_SPEED_MPH] * HOURS_PER_DAY, index=range(HOURS_PER_DAY))
+
+
+def speed_sources_fingerprint(speed_table, median_speed_by_hour):
+    """
+    Dấu vân tay (sha1) của bảng tốc độ và tốc độ fallback theo giờ - các nguồn tốc độ quyết định giá trị
+    các lớp travel_time. Tốc độ fallback được chuẩn hoá như khi lưu file (24 giờ, giờ thiếu nhận mặc định)
+    nên Series trong bộ nhớ và bản đọc lại từ file cho cùng một kết quả.
+    """
+    hasher = hashlib.sha1()
+    if speed_table is not None:
+        hasher.update(np.ascontiguousarray(speed_table['location_ids'], dtype=np.int64).tobytes())
+        hasher.update(np.ascontiguousarray(speed_table['speeds_mph'], dtype=np.float64).tobytes())
+    if median_speed_by_hour is not None:
+        hasher.update(np.array([
+            float(median_speed_by_hour.get(hour, DEFAULT_FALLBACK_SPEED_MPH)) for hour in range(HOURS_PER_DAY)
+        ], dtype=np.float64).tobytes())
+    return hasher.hexdigest()
+
+
+def current_speed_sources_fingerprint(speed_table_path=SPEED_TABLE_PATH, fallback_speeds_path=FALLBACK_SPEEDS_PATH):
+    """speed_sources_fingerprint của bảng tốc độ và tốc độ fallback đang lưu trên đĩa (mặc định nếu chưa có file)."""
+    fallback_speeds = load_fallback_speeds(fallback_speeds_path)
+    if fallback_speeds is None:
+        fallback_speeds = default_fallback_speeds()
+    return speed_sources_fingerprint(load_speed_table(speed_table_path), fallback_speeds)
+
+
+def save_fallback_speeds(median_speed_by_hour, path=FALLBACK_SPEEDS_PATH, source=None):
+    """
+    Lưu tốc độ trung vị theo giờ (Series index 0-23, mph) ra file JSON nhỏ có phiên bản.
+    Giờ không có dữ liệu nhận tốc độ mặc định. source: mô tả dữ liệu nguồn (ghi kèm để tra cứu).
+    """
+    speeds = [
+        float(median_speed_by_hour.get(hour, DEFAULT_FALLBACK_SPEED_MPH)) for hour in range(HOURS_PER_DAY)
+    ]
+    artifact = {'version': FALLBACK_SPEEDS_VERSION, 'source': source, 'speeds_mph': speeds}
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    print(f"Đã lưu tốc độ fallback theo giờ vào file: {path}")
+
+
+def load_fallback_speeds(path=FALLBACK_SPEEDS_PATH):
+    """Tải tốc độ fallback theo giờ (Series index 0-23, mph); None nếu chưa có file, hỏng hoặc khác phiên bản."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            artifact = json.load(f)
+    except FileNotFoundError:
+        print(f"LƯU Ý: Không tìm thấy file tốc độ fallback tại {path}. Chạy train_model.py để tạo.")
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Lỗi khi đọc file tốc độ fallback: {e}")
+        return None
+    speeds = artifact.get('speeds_mph') if isinstance(artifact, dict) else None
+    if (not isinstance(speeds, list) or len(speeds) != HOURS_PER_DAY
+            or artifact.get('version') != FALLBACK_SPEEDS_VERSION):
+        print(f"Cảnh báo: File tốc độ fallback tại {path} khác phiên bản hoặc không hợp lệ.")
+        return None
+    return pd.Series(speeds, index=range(HOURS_PER_DAY), dtype='float64')
+
+
+if __name__ == '__main__':
+    # Xây dựng lại bảng tốc độ từ mô hình đã lưu (chạy sau train_model.py)
+    from data_loader import load_taxi_zones
+
+    # Miền gồm mọi LocationID trong shapefile để mọi cạnh (kể cả ở zone giáp ranh) đều tra được tốc độ
+    taxi_zones_gdf = load_taxi_zones()
+    speed_table_built = build_speed_table(*load_trained_model(), taxi_zones_gdf['LocationID'])
+    if speed_table_built is not None:
+        save_speed_table(speed_table_built)
@@ -1,140 +1,289 @@
 # train_model.py
+import io
+import sys
+import time
 import pandas as pd
 import numpy as np
 import joblib
 from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 from sklearn.compose import ColumnTransformer
-from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
 
 # Import các hàm cần thiết từ các module khác
-from config import YELLOW_TAXI_DATA_FILE # Để có đường dẫn file dữ liệu taxi
-from data_loader import load_taxi_zones, load_taxi_trip_data
-from data_processor import (
-    filter_taxi_zones_by_borough,
-    initial_trip_data_cleaning,
-    filter_trips_by_location_ids,
-    create_ml_training_data # Hàm quan trọng để tạo dữ liệu ML
+from config import (
+    YELLOW_TAXI_DATA_FILE, TRIP_DATA_MONTHS, DATA_PREPARATION_WORKERS, # Để có đường dẫn file (thư mục/glob) dữ liệu taxi
+    MODEL_BACKEND, MODEL_MAE_BUDGET_MPH
 )
+from data_loader import load_road_network, load_taxi_zones
+from data_processor import filter_taxi_zones_by_borough
+from speed_aggregates import update_speed_aggregates
+from speed_table import FEATURE_COLUMNS, build_speed_table, save_speed_table, save_fallback_speeds
+from model_registry import save_model_bundle, activate_model_bundle, load_model_bundle
+from compact_graph import CompactGraph
+from weight_layers import TravelTimeLayers
+from graph_store import save_graph_store
 
-def train_and_save_model():
+MODEL_BACKENDS = ('random_forest', 'hist_gradient_boosting')
+METRIC_COLUMNS = ['mae_test', 'rmse_test', 'r2_test', 'size_mb', 'load_ms', 'single_predict_ms']
+LATENCY_REPEATS = 20 # Số lần gọi predict một dòng để đo độ trễ
+HGB_MAX_CATEGORIES = 255
+
+def build_model_pipeline(backend=MODEL_BACKEND):
+    """Preprocessor và mô hình (chưa fit) cho một backend; ném ValueError nếu backend không hợp lệ."""
+    if backend == 'random_forest':
+        preprocessor = ColumnTransformer(
+            transformers=[
+                ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=False), ['PULocationID'])
+            ],
+            remainder='passthrough'
+        )
+        model = RandomForestRegressor(
+            n_estimators=100, random_state=42, n_jobs=-1, oob_score=True,
+            max_depth=20, min_samples_split=5, min_samples_leaf=2
+        )
+    elif backend == 'hist_gradient_boosting':
+        # Zone -> mã 0..n-1 (HGB nhận tối đa 255 giá trị phân loại; zone hiếm nhất được gộp lại nếu vượt),
+        # zone chưa gặp -> NaN (giá trị thiếu)
+        preprocessor = ColumnTransformer(
+            transformers=[
+                ('cat', OrdinalEncoder(handle_unknown='use_encoded_value', unknown_value=np.nan,
+                                       max_categories=HGB_MAX_CATEGORIES), ['PULocationID'])
+            ],
+            remainder='passthrough'
+        )
+        model = HistGradientBoostingRegressor(
+            categorical_features=[0], max_iter=300, learning_rate=0.1, random_state=42
+        )
+    else:
+        raise ValueError(f"Backend mô hình không hợp lệ: '{backend}'. Chọn một trong {MODEL_BACKENDS}.")
+    return preprocessor, model
+
+def measure_model_costs(model, preprocessor, X_sample):
+    """
+    Chi phí phục vụ của mô hình: kích thước file joblib (mô hình + preprocessor), thời gian nạp lại,
+    thời gian predict cả X_sample một lượt và độ trễ predict một dòng (trung vị của LATENCY_REPEATS lần).
+    """
+    buffer = io.BytesIO()
+    joblib.dump((model, preprocessor), buffer)
+    size_bytes = buffer.tell()
+    buffer.seek(0)
+    start = time.perf_counter()
+    joblib.load(buffer)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.predict(preprocessor.transform(X_sample))
+    batch_seconds = time.perf_counter() - start
+
+    single_row = X_sample.iloc[:1]
+    single_row_seconds = []
+    for _ in range(LATENCY_REPEATS):
+        start = time.perf_counter()
+        model.predict(preprocessor.transform(single_row))
+        single_row_seconds.append(time.perf_counter() - start)
+    return {
+        'size_mb': size_bytes / 1e6,
+        'load_ms': load_seconds * 1e3,
+        'batch_predict_ms': batch_seconds * 1e3,
+        'single_predict_ms': float(np.median(single_row_seconds)) * 1e3,
+    }
+
+def fit_and_evaluate(backend, X_train, X_test, y_train, y_test):
+    """Huấn luyện một backend, trả về dict gồm mô hình, preprocessor, các chỉ số đánh giá và chi phí phục vụ."""
+    preprocessor, model = build_model_pipeline(backend)
+    print(f"\nĐang huấn luyện mô hình '{backend}' ({type(model).__name__})...")
+    start = time.perf_counter()
+    X_train_processed = preprocessor.fit_transform(X_train)
+    model.fit(X_train_processed, y_train)
+    fit_seconds = time.perf_counter() - start
+    if getattr(model, 'oob_score_', None): # Chỉ RandomForest có oob_score_
+        print(f"Out-of-Bag R^2 score: {model.oob_score_:.4f}")
+
+    y_pred_train = model.predict(X_train_processed)
+    y_pred_test = model.predict(preprocessor.transform(X_test))
+    result = {
+        'backend': backend,
+        'model': model,
+        'preprocessor': preprocessor,
+        'fit_seconds': fit_seconds,
+        'mae_train': mean_absolute_error(y_train, y_pred_train),
+        'r2_train': r2_score(y_train, y_pred_train),
+        'mae_test': mean_absolute_error(y_test, y_pred_test),
+        'rmse_test': np.sqrt(mean_squared_error(y_test, y_pred_test)),
+        'r2_test': r2_score(y_test, y_pred_test),
+    }
+    result.update(measure_model_costs(model, preprocessor, X_test))
+    return result
+
+def report_model_results(results):
+    """In bảng so sánh độ chính xác và chi phí phục vụ của các backend."""
+    columns = ['mae_train', 'r2_train', 'mae_test', 'rmse_test', 'r2_test',
+               'size_mb', 'load_ms', 'batch_predict_ms', 'single_predict_ms', 'fit_seconds']
+    report = pd.DataFrame([{column: result[column] for column in columns} for result in results],
+                          index=[result['backend'] for result in results])
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.max_columns', None, 'display.width', 250):
+        print(report)
+
+def select_model(results, mae_budget_mph=MODEL_MAE_BUDGET_MPH):
+    """
+    Mô hình nhanh nhất (thời gian nạp + predict một lượt) trong số các mô hình có MAE kiểm thử
+    không vượt MAE tốt nhất quá mae_budget_mph.
+    """
+    best_mae = min(result['mae_test'] for result in results)
+    candidates = [result for result in results if result['mae_test'] <= best_mae + mae_budget_mph]
+    return min(candidates, key=lambda result: result['load_ms'] + result['batch_predict_ms'])
+
+def save_trained_model(ml_model, preprocessor, speed_histogram, location_ids, trip_data_path, months, backend,
+                       metrics=None):
+    """
+    Lưu mô hình đã huấn luyện thành bundle mới trong registry (kèm tốc độ fallback theo giờ và khoảng
+    dữ liệu huấn luyện), tính sẵn và lưu bảng tốc độ cho location_ids cùng file tốc độ fallback riêng cho app/main,
+    rồi mới đánh dấu bundle là phiên bản hiện tại: nếu bước nào lỗi, registry vẫn trỏ tới mô hình cũ khớp với
+    bảng tốc độ cũ. Khoảng dữ liệu lấy từ các file đã thực sự gộp vào speed_histogram (source_files).
+    Trả về (tên phiên bản bundle, bảng tốc độ); (None, None) nếu không xây dựng được bảng tốc độ.
+    """
+    fallback_speeds = speed_histogram.median_speed_by_hour()
+    data_months = speed_histogram.months
+    training_data = {
+        'trip_data_path': trip_data_path,
+        'months': list(months) if months is not None else None,
+        'first_month': data_months[0] if data_months else None,
+        'last_month': data_months[-1] if data_months else None,
+        'files': sorted(speed_histogram.source_files),
+        'num_trips': speed_histogram.num_trips,
+    }
+    version = save_model_bundle(ml_model, preprocessor, fallback_speeds, training_data=training_data,
+                                metrics=metrics, backend=backend, make_current=False)
+    # Bảng tốc độ cho toàn bộ miền (zone × giờ × ngày) để phục vụ ETA không cần mô hình
+    speed_table = build_speed_table(ml_model, preprocessor, location_ids)
+    if speed_table is None:
+        print(f"Lỗi: Không xây dựng được bảng tốc độ; bundle '{version}' được lưu nhưng không được dùng.")
+        return None, None
+    save_speed_table(speed_table)
+    # Tốc độ trung vị theo giờ cho các cạnh không tra được bảng tốc độ: app/main chỉ cần đọc file nhỏ này
+    save_fallback_speeds(fallback_speeds, source=training_data)
+    activate_model_bundle(version)
+    return version, speed_table
+
+def train_and_save_model(trip_data_path=YELLOW_TAXI_DATA_FILE, months=TRIP_DATA_MONTHS, workers=DATA_PREPARATION_WORKERS,
+                         backends=MODEL_BACKEND, on_stage=None):
     """
     Hàm chính để tải dữ liệu, xử lý, huấn luyện mô hình ML,
-    đánh giá và lưu mô hình cùng preprocessor.
+    đánh giá và lưu mô hình cùng preprocessor, bảng tốc độ và kho đồ thị dùng chung mới.
+    Dùng chung cho cả train_model.py và job huấn luyện lại chạy nền (retraining.run_retraining).
+    trip_data_path có thể là một file, thư mục hoặc glob nhiều tháng; months giới hạn khoảng tháng cần đọc;
+    workers: số tiến trình chuẩn bị dữ liệu song song theo row group (None = số lõi CPU, 1 = tuần tự).
+    backends: tên một backend mô hình hoặc danh sách backend; với nhiều backend, mô hình được lưu là
+    mô hình nhanh nhất trong ngưỡng MAE (select_model).
+    on_stage(stage, **details): gọi khi bắt đầu mỗi bước ('aggregating', 'training', 'saving', 'building_layers',
+    'done') và với 'failed' (details['error']) khi dừng vì lỗi.
+    Trả về tên phiên bản bundle mô hình mới; None nếu lỗi.
     """
+    def report(stage, **details):
+        if on_stage is not None:
+            on_stage(stage, **details)
+
+    def stop(message):
+        print(f"{message} Kết thúc huấn luyện.")
+        report('failed', error=message)
+
+    backends = [backends] if isinstance(backends, str) else list(backends)
+    for backend in backends:
+        build_model_pipeline(backend) # Báo lỗi backend sai trước khi đọc dữ liệu
+
     print("Bắt đầu quy trình huấn luyện mô hình dự đoán tốc độ...")
+    report('aggregating')
 
     # --- 1. Tải dữ liệu cơ bản ---
     # (Tương tự như trong main.py, nhưng chỉ lấy những gì cần cho việc tạo ml_training_df)
     print("\n--- Bước 1: Tải dữ liệu ---")
     taxi_zones_gdf = load_taxi_zones()
-    raw_taxi_trips_df = load_taxi_trip_data(YELLOW_TAXI_DATA_FILE) # Sử dụng đường dẫn từ config
-
-    if taxi_zones_gdf is None or raw_taxi_trips_df is None:
-        print("Lỗi tải dữ liệu đầu vào (taxi zones hoặc raw taxi trips). Kết thúc huấn luyện.")
-        return
+    if taxi_zones_gdf is None:
+        return stop("Lỗi tải dữ liệu đầu vào (taxi zones).")
 
-    # --- 2. Xử lý dữ liệu để có manhattan_trips_df ---
-    print("\n--- Bước 2: Xử lý dữ liệu để lấy các chuyến đi trong Manhattan ---")
-    _, manhattan_location_ids = filter_taxi_zones_by_borough(taxi_zones_gdf) # Mặc định là Manhattan từ config
+    # --- 2. Đọc và gộp dần tốc độ các chuyến đi trong Manhattan ---
+    print("\n--- Bước 2: Đọc theo lô và gộp tốc độ các chuyến đi trong Manhattan ---")
+    manhattan_zones_gdf, manhattan_location_ids = filter_taxi_zones_by_borough(taxi_zones_gdf) # Mặc định là Manhattan từ config
     if not manhattan_location_ids:
-        print("Không tìm thấy LocationID nào cho Manhattan. Kết thúc huấn luyện.")
-        return
-        
-    cleaned_taxi_trips_df = initial_trip_data_cleaning(raw_taxi_trips_df)
-    if cleaned_taxi_trips_df is None or cleaned_taxi_trips_df.empty:
-        print("Không có dữ liệu taxi sau khi làm sạch ban đầu. Kết thúc huấn luyện.")
-        return
-
-    manhattan_trips_df = filter_trips_by_location_ids(cleaned_taxi_trips_df, manhattan_location_ids)
-    if manhattan_trips_df.empty:
-        print("Không có chuyến đi nào hoàn toàn trong Manhattan để huấn luyện. Kết thúc huấn luyện.")
-        return
-    print(f"Đã lọc được {len(manhattan_trips_df)} chuyến đi trong Manhattan.")
+        return stop("Không tìm thấy LocationID nào cho Manhattan.")
+
+    # Các tháng đã có trong kho tốc độ không phải đọc lại; tháng mới được đọc theo lô (chỉ các cột cần thiết,
+    # lọc LocationID ngay khi đọc) và cộng vào histogram, nên bộ nhớ không tăng theo số tháng dữ liệu
+    speed_histogram = update_speed_aggregates(trip_data_path, manhattan_location_ids, months, workers=workers)
+    if speed_histogram is None:
+        return stop("Lỗi tải dữ liệu chuyến đi taxi.")
+    if speed_histogram.num_trips == 0:
+        return stop("Không có chuyến đi nào hoàn toàn trong Manhattan để huấn luyện.")
+    print(f"Đã gộp được {speed_histogram.num_trips} chuyến đi trong Manhattan.")
 
     # --- 3. Tạo Dữ liệu Huấn luyện ML ---
     print("\n--- Bước 3: Tạo Dữ liệu Huấn luyện cho Mô hình ML ---")
-    ml_training_df = create_ml_training_data(manhattan_trips_df)
+    ml_training_df = speed_histogram.training_frame()
 
     if ml_training_df.empty:
-        print("Không thể tạo dữ liệu huấn luyện ML. Kết thúc huấn luyện.")
-        return
+        return stop("Không thể tạo dữ liệu huấn luyện ML.")
     
     print(f"Dữ liệu huấn luyện ML được tạo với {len(ml_training_df)} mẫu.")
     print("5 dòng đầu của dữ liệu huấn luyện ML:")
     print(ml_training_df.head())
 
-    # --- 4. Tiền xử lý Dữ liệu ---
-    print("\n--- Bước 4: Tiền xử lý Dữ liệu cho Học máy ---")
-    X = ml_training_df[['PULocationID', 'pickup_hour', 'pickup_day_of_week']]
+    # --- 4. Chia Dữ liệu ---
+    print("\n--- Bước 4: Chia Dữ liệu Huấn luyện/Kiểm thử ---")
+    X = ml_training_df[FEATURE_COLUMNS]
     y = ml_training_df['target_median_speed_mph']
-
-    categorical_features = ['PULocationID']
-    # numerical_features = ['pickup_hour', 'pickup_day_of_week'] # Có thể scale nếu muốn
-
-    preprocessor = ColumnTransformer(
-        transformers=[
-            ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=False), categorical_features)
-        ],
-        remainder='passthrough' 
-    )
-
-    # Chia dữ liệu
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
+
     print(f"Kích thước tập huấn luyện X: {X_train.shape}")
     print(f"Kích thước tập kiểm thử X: {X_test.shape}")
 
-    # Fit preprocessor trên X_train và transform cả X_train, X_test
-    X_train_processed = preprocessor.fit_transform(X_train)
-    X_test_processed = preprocessor.transform(X_test)
-    
-    print("Tiền xử lý dữ liệu hoàn tất.")
+    # --- 5 & 6. Huấn luyện và Đánh giá (độ chính xác + chi phí phục vụ) ---
+    report('training', num_trips=speed_histogram.num_trips, num_samples=len(ml_training_df))
+    print(f"\n--- Bước 5 & 6: Huấn luyện và Đánh giá Mô hình ({', '.join(backends)}) ---")
+    results = [fit_and_evaluate(backend, X_train, X_test, y_train, y_test) for backend in backends]
+    print("\nKết quả đánh giá (MAE/RMSE theo mph; kích thước file, thời gian nạp và độ trễ predict trên tập kiểm thử):")
+    report_model_results(results)
+    selected = select_model(results)
+    if len(results) > 1:
+        print(f"Chọn mô hình '{selected['backend']}': nhanh nhất trong ngưỡng MAE +{MODEL_MAE_BUDGET_MPH} mph so với mô hình tốt nhất.")
+    ml_model, preprocessor = selected['model'], selected['preprocessor']
 
-    # --- 5. Huấn luyện Mô hình ---
-    print("\n--- Bước 5: Huấn luyện Mô hình (RandomForestRegressor) ---")
-    rf_model = RandomForestRegressor(
-        n_estimators=100, random_state=42, n_jobs=-1, oob_score=True,
-        max_depth=20, min_samples_split=5, min_samples_leaf=2
+    # --- 7 & 8. Lưu bundle Mô hình (mô hình, preprocessor, tốc độ fallback, schema, hash) và Bảng tốc độ ---
+    # Bundle chỉ thành phiên bản hiện tại sau khi bảng tốc độ cho toàn bộ miền (zone × giờ × ngày) đã được lưu
+    print("\n--- Bước 7 & 8: Lưu bundle Mô hình vào registry và tính sẵn Bảng tốc độ cho việc phục vụ ETA ---")
+    report('saving')
+    version, speed_table = save_trained_model(
+        ml_model, preprocessor, speed_histogram, taxi_zones_gdf['LocationID'], trip_data_path, months,
+        selected['backend'], metrics={column: float(selected[column]) for column in METRIC_COLUMNS}
+    )
+    if version is None:
+        return stop("Không xây dựng được bảng tốc độ từ mô hình mới.")
+    # Thời gian cold start khi phục vụ: nạp lại bundle vừa lưu từ đĩa (kiểm tra hash + mmap)
+    load_model_bundle(version)
+
+    # --- 9. Dựng 168 lớp travel_time và ghi kho đồ thị dùng chung mới ---
+    # Con trỏ CURRENT của kho đổi nguyên tử: worker khởi động sau mở thẳng kho mới bằng mmap
+    print("\n--- Bước 9: Dựng các lớp travel_time và kho đồ thị dùng chung ---")
+    report('building_layers', version=version)
+    G_manhattan = load_road_network()
+    if G_manhattan is None:
+        return stop("Không tải được bản đồ Manhattan để dựng kho đồ thị (mô hình mới đã được lưu).")
+    travel_time_layers = TravelTimeLayers(
+        CompactGraph.from_networkx(G_manhattan, taxi_zones_gdf), speed_histogram.median_speed_by_hour(),
+        speed_table=speed_table
+    )
+    travel_time_layers.load_or_build_all()
+    bounds_array = manhattan_zones_gdf.to_crs("EPSG:4326").total_bounds
+    save_graph_store(
+        travel_time_layers,
+        bounds=[[float(bounds_array[1]), float(bounds_array[0])], [float(bounds_array[3]), float(bounds_array[2])]]
     )
-    
-    print("Đang huấn luyện mô hình...")
-    rf_model.fit(X_train_processed, y_train)
-    print("Huấn luyện mô hình hoàn tất.")
-    if hasattr(rf_model, 'oob_score_') and rf_model.oob_score_: # Kiểm tra oob_score_ có tồn tại không
-        print(f"Out-of-Bag R^2 score: {rf_model.oob_score_:.4f}")
-
-    # --- 6. Đánh giá Mô hình ---
-    print("\n--- Bước 6: Đánh giá Mô hình ---")
-    y_pred_train = rf_model.predict(X_train_processed)
-    y_pred_test = rf_model.predict(X_test_processed)
-
-    mae_train = mean_absolute_error(y_train, y_pred_train)
-    r2_train = r2_score(y_train, y_pred_train)
-    mae_test = mean_absolute_error(y_test, y_pred_test)
-    rmse_test = np.sqrt(mean_squared_error(y_test, y_pred_test))
-    r2_test = r2_score(y_test, y_pred_test)
-
-    print("\nKết quả đánh giá trên tập Huấn luyện:")
-    print(f"  Mean Absolute Error (MAE): {mae_train:.2f} mph")
-    print(f"  R-squared (R2): {r2_train:.4f}")
-    print("\nKết quả đánh giá trên tập Kiểm thử:")
-    print(f"  Mean Absolute Error (MAE): {mae_test:.2f} mph")
-    print(f"  Root Mean Squared Error (RMSE): {rmse_test:.2f} mph")
-    print(f"  R-squared (R2): {r2_test:.4f}")
-
-    # --- 7. Lưu Mô hình và Preprocessor ---
-    print("\n--- Bước 7: Lưu Mô hình và Preprocessor ---")
-    model_filename = 'trained_rf_model.joblib'
-    preprocessor_filename = 'data_preprocessor.joblib'
-    
-    joblib.dump(rf_model, model_filename)
-    joblib.dump(preprocessor, preprocessor_filename)
-    print(f"Đã lưu mô hình vào file: {model_filename}")
-    print(f"Đã lưu preprocessor vào file: {preprocessor_filename}")
 
     print("\nQuy trình huấn luyện và lưu mô hình hoàn tất.")
+    report('done', version=version)
+    return version
 
 if __name__ == '__main__':
-    train_and_save_model()
\ No newline at end of file
+    # python train_model.py [backend ...]: ví dụ "python train_model.py random_forest hist_gradient_boosting" để so sánh
+    train_and_save_model(backends=sys.argv[1:] or MODEL_BACKEND)
\ No newline at end of file
@@ -0,0 +1,139 @@
+# weight_layers.py
+import os
+import hashlib
+import threading
+import numpy as np
+from config import GRAPH_CACHE_DIR
+
+HOURS_PER_DAY = 24
+DAYS_PER_WEEK = 7
+NUM_TIME_SLOTS = HOURS_PER_DAY * DAYS_PER_WEEK # 168 lớp (giờ, ngày)
+SECONDS_PER_SLOT = 3600
+
+
+def time_slot_index(target_hour, target_day_numeric):
+    """Chỉ số lớp trong ma trận 168 × num_edges: ngày * 24 + giờ (giờ thứ mấy trong tuần, Thứ Hai 0h = 0)."""
+    return int(target_day_numeric) * HOURS_PER_DAY + int(target_hour)
+
+
+def departure_week_seconds(target_hour, target_day_numeric, departure_minute=0):
+    """Thời điểm khởi hành tính bằng giây kể từ 0h Thứ Hai (cùng gốc với time_slot_index)."""
+    return time_slot_index(target_hour, target_day_numeric) * SECONDS_PER_SLOT + float(departure_minute) * 60
+
+
+def build_all_travel_time_layers(compact_graph, fallback_median_speed_by_hour, speed_table=None):
+    """Tính toàn bộ 168 vector travel_time thành một ma trận float32 (168 × num_edges)."""
+    layers = np.empty((NUM_TIME_SLOTS, compact_graph.num_edges), dtype=np.float32)
+    for target_day_numeric in range(DAYS_PER_WEEK):
+        for target_hour in range(HOURS_PER_DAY):
+            layers[time_slot_index(target_hour, target_day_numeric)] = compact_graph.compute_travel_times(
+                target_hour, target_day_numeric, fallback_median_speed_by_hour, speed_table=speed_table
+            )
+    return layers
+
+
+def save_travel_time_layers(layers, path):
+    """Lưu ma trận lớp travel_time ra file .npy (có thể mở lại bằng mmap)."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.npy"
+    np.save(tmp_path, layers)
+    os.replace(tmp_path, path)
+    print(f"Đã lưu {layers.shape[0]} lớp travel_time ({layers.shape[1]} cạnh) vào file: {path}")
+
+
+def load_travel_time_layers(path, num_edges=None):
+    """Mở ma trận lớp travel_time bằng mmap (chỉ đọc); None nếu không có file hoặc kích thước không khớp."""
+    if not os.path.exists(path):
+        return None
+    try:
+        layers = np.load(path, mmap_mode='r')
+    except Exception as e:
+        print(f"Cảnh báo: Không đọc được file lớp travel_time ({path}): {e}")
+        return None
+    if layers.ndim != 2 or layers.shape[0] != NUM_TIME_SLOTS or (num_edges is not None and layers.shape[1] != num_edges):
+        print(f"Cảnh báo: File lớp travel_time {path} có kích thước {layers.shape} không khớp đồ thị, sẽ tính lại.")
+        return None
+    return layers
+
+
+class TravelTimeLayers:
+    """
+    Các vector travel_time (float32, theo thứ tự cạnh của CompactGraph) cho từng cặp (giờ, ngày).
+    Mỗi vector chỉ được tính một lần, sau đó được khóa chỉ đọc và dùng chung cho mọi phiên/yêu cầu,
+    nên một yêu cầu ETA chỉ cần chọn vector trọng số chứ không sao chép topo đồ thị.
+    Khi đã gọi load_or_build_all(), mọi vector là các hàng của một ma trận 168 × num_edges.
+    """
+
+    def __init__(self, compact_graph, fallback_median_speed_by_hour, speed_table=None):
+        self.compact_graph = compact_graph
+        self.fallback_median_speed_by_hour = fallback_median_speed_by_hour
+        self.speed_table = speed_table
+        self.matrix = None
+        self._fingerprint = None
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_matrix(cls, compact_graph, matrix, fingerprint=None):
+        """
+        Bộ lớp dựng từ ma trận 168 × num_edges có sẵn (ví dụ mở bằng mmap từ graph_store).
+        fingerprint: dấu vân tay đã lưu cùng ma trận (không còn bảng tốc độ để tính lại).
+        """
+        travel_time_layers = cls(compact_graph, None)
+        travel_time_layers.matrix = matrix
+        travel_time_layers._fingerprint = fingerprint
+        return travel_time_layers
+
+    def fingerprint(self):
+        """Dấu vân tay của đồ thị, bảng tốc độ và fallback speed - mọi thứ quyết định giá trị các lớp."""
+        if self._fingerprint is not None:
+            return self._fingerprint
+        hasher = hashlib.sha1(self.compact_graph.fingerprint().encode())
+        if self.speed_table is not None:
+            hasher.update(np.ascontiguousarray(self.speed_table['location_ids']).tobytes())
+            hasher.update(np.ascontiguousarray(self.speed_table['speeds_mph']).tobytes())
+        if self.fallback_median_speed_by_hour is not None:
+            hasher.update(repr(sorted(self.fallback_median_speed_by_hour.items())).encode())
+        return hasher.hexdigest()
+
+    def default_path(self, cache_dir=GRAPH_CACHE_DIR):
+        return os.path.join(cache_dir, f"travel_time_layers_{self.fingerprint()[:16]}.npy")
+
+    def load_or_build_all(self, path=None):
+        """Mở ma trận 168 lớp bằng mmap nếu đã có trên đĩa; nếu chưa thì tính toàn bộ rồi lưu lại."""
+        path = path or self.default_path()
+        matrix = load_travel_time_layers(path, self.compact_graph.num_edges)
+        if matrix is None:
+            print(f"Đang tính trước {NUM_TIME_SLOTS} lớp travel_time...")
+            matrix = build_all_travel_time_layers(
+                self.compact_graph, self.fallback_median_speed_by_hour, speed_table=self.speed_table
+            )
+            try:
+                save_travel_time_layers(matrix, path)
+            except OSError as e:
+                print(f"Cảnh báo: Không lưu được các lớp travel_time: {e}")
+            matrix.flags.writeable = False
+        else:
+            print(f"Đã mở {NUM_TIME_SLOTS} lớp travel_time bằng mmap: {path}")
+        self.matrix = matrix
+        return matrix
+
+    def get(self, target_hour, target_day_numeric):
+        """Vector travel_time chỉ đọc cho (giờ, ngày); tính và lưu lại ở lần gọi đầu tiên."""
+        if self.matrix is not None:
+            return self.matrix[time_slot_index(target_hour, target_day_numeric)]
+        key = (int(target_hour), int(target_day_numeric))
+        layer = self._layers.get(key)
+        if layer is not None:
+            return layer
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is None:
+                print(f"Đang tính vector travel_time cho giờ {key[0]}, ngày {key[1]}...")
+                layer = self.compact_graph.compute_travel_times(
+                    key[0], key[1], self.fallback_median_speed_by_hour, speed_table=self.speed_table
+                )
+                layer.flags.writeable = False
+                self._layers[key] = layer
+        return layer
+